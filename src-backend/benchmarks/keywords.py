@@ -0,0 +1,87 @@
+"""
+Times reading and writing the keywords of an image with hundreds of hierarchical keywords.
+
+The keywords are set in KeywordInfo and in all four flat fields, the way most tools write them, so reading
+merges the same paths five times over.  Each operation is timed for the current keyword trie and for the
+baseline, the implementation before it.  The baseline expand only writes some of the paths from a root to a
+leaf, so it does less work than the trie, which writes all of them.
+
+    python -m benchmarks.keywords [--keywords N] [--repeat N]
+"""
+
+import argparse
+import random
+import timeit
+from pathlib import Path
+
+from benchmarks import keywords_baseline
+from scansteward.imageops.metadata import combine_keyword_structures
+from scansteward.imageops.metadata import expand_keyword_structures
+from scansteward.imageops.models import ImageMetadata
+from scansteward.imageops.models import KeywordInfoModel
+from scansteward.imageops.models import KeywordStruct
+
+
+def keyword_paths(count: int, *, seed: int = 42) -> list[list[str]]:
+    """
+    Builds count distinct keyword paths, 2 to 5 levels deep, which share their upper levels like real ones
+    """
+    rng = random.Random(seed)  # noqa: S311
+    paths: set[tuple[str, ...]] = set()
+    while len(paths) < count:
+        depth = rng.randint(2, 5)
+        paths.add(tuple(f"Level {level} - {rng.randint(0, 6)}" for level in range(depth)))
+    return [list(path) for path in sorted(paths)]
+
+
+def as_tree(paths: list[list[str]]) -> list[KeywordStruct]:
+    roots: dict[str, KeywordStruct] = {}
+    for path in paths:
+        node = roots.setdefault(path[0], KeywordStruct(Keyword=path[0]))
+        for keyword in path[1:]:
+            child = next((x for x in node.Children if x.Keyword == keyword), None)
+            if child is None:
+                child = KeywordStruct(Keyword=keyword)
+                node.Children.append(child)
+            node = child
+    return list(roots.values())
+
+
+def build_metadata(paths: list[list[str]]) -> ImageMetadata:
+    return ImageMetadata(
+        SourceFile=Path(__file__),
+        KeywordInfo=KeywordInfoModel(Hierarchy=as_tree(paths)),
+        HierarchicalSubject=["|".join(x) for x in paths],
+        CatalogSets=["|".join(x) for x in paths],
+        TagsList=["/".join(x) for x in paths],
+        LastKeywordXMP=["/".join(x) for x in paths],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keywords", type=int, default=500, help="Number of distinct keyword paths")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of times to time each operation")
+    args = parser.parse_args()
+
+    paths = keyword_paths(args.keywords)
+    written = build_metadata(paths)
+    written.HierarchicalSubject = written.CatalogSets = written.TagsList = written.LastKeywordXMP = None
+
+    for name, combine, expand in [
+        ("baseline", keywords_baseline.combine_keyword_structures, keywords_baseline.expand_keyword_structures),
+        ("trie", combine_keyword_structures, expand_keyword_structures),
+    ]:
+        for operation_name, operation in [
+            ("combine (read)", lambda combine=combine: combine(build_metadata(paths))),
+            ("expand (write)", lambda expand=expand: expand(written.model_copy(deep=True))),
+        ]:
+            best = min(timeit.repeat(operation, number=1, repeat=args.repeat))
+            print(f"{name:>8} {operation_name:>16}: {best * 1000:8.2f} ms")  # noqa: T201
+
+    best = min(timeit.repeat(lambda: build_metadata(paths), number=1, repeat=args.repeat))
+    print(f"{'':>8} {'build input only':>16}: {best * 1000:8.2f} ms")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
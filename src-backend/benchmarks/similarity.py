@@ -0,0 +1,69 @@
+"""
+Times the phash similarity index on a synthetic library.
+
+Most phashes are random, with a share of them scanned again, differing by a few bits, the way double scanned
+prints do.
+
+    python -m benchmarks.similarity [--images N] [--duplicates FRACTION] [--distance N]
+"""
+
+import argparse
+import os
+import random
+import time
+
+import django
+
+# The index module loads the models, so Django is set up first
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "scansteward.settings")
+django.setup()
+
+from scansteward.imageops.similarity import PHASH_BITS  # noqa: E402
+from scansteward.imageops.similarity import PhashIndex  # noqa: E402
+
+
+def library_phashes(count: int, duplicates: float, *, seed: int = 42) -> list[int]:
+    """
+    Builds count phashes, where the given fraction of them are near copies of an earlier one
+    """
+    rng = random.Random(seed)  # noqa: S311
+    phashes: list[int] = []
+    for _ in range(count):
+        if phashes and rng.random() < duplicates:
+            phash = rng.choice(phashes)
+            for bit in rng.sample(range(PHASH_BITS), rng.randint(0, 4)):
+                phash ^= 1 << bit
+        else:
+            phash = rng.getrandbits(PHASH_BITS)
+        phashes.append(phash)
+    return phashes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=500_000, help="Number of images in the library")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="Fraction of the images which are rescans")
+    parser.add_argument("--distance", type=int, default=6, help="Maximum Hamming distance of a match")
+    args = parser.parse_args()
+
+    phashes = library_phashes(args.images, args.duplicates)
+
+    start = time.perf_counter()
+    index = PhashIndex()
+    for image_id, phash in enumerate(phashes, start=1):
+        index.add(image_id, phash)
+    print(f"{'build':>10}: {time.perf_counter() - start:8.3f} s")  # noqa: T201
+
+    queries = phashes[:: max(1, len(phashes) // 1000)]
+    start = time.perf_counter()
+    for phash in queries:
+        index.search(phash, args.distance)
+    print(f"{'search':>10}: {(time.perf_counter() - start) / len(queries) * 1000:8.3f} ms each")  # noqa: T201
+
+    start = time.perf_counter()
+    clusters = index.clusters(args.distance)
+    print(f"{'clusters':>10}: {time.perf_counter() - start:8.3f} s, {len(clusters)} found")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 from functools import lru_cache
 
 from scansteward.config.settings import DjangoSettings
+from scansteward.config.settings import FileServingSettings
+from scansteward.config.settings import ImageOpsSettings
 from scansteward.config.settings import PathSettings
 
 
@@ -12,3 +14,13 @@ def get_django_settings() -> DjangoSettings:
 @lru_cache(maxsize=1)
 def get_path_settings() -> PathSettings:
     return PathSettings()
+
+
+@lru_cache(maxsize=1)
+def get_image_ops_settings() -> ImageOpsSettings:
+    return ImageOpsSettings()
+
+
+@lru_cache(maxsize=1)
+def get_file_serving_settings() -> FileServingSettings:
+    return FileServingSettings()
@@ -7,6 +7,7 @@ from pydantic_settings import BaseSettings
 from pydantic_settings import SettingsConfigDict
 
 from scansteward.config.types import DatabaseChoices
+from scansteward.config.types import FileServingChoices
 
 
 class AppBaseSettings(BaseSettings):
@@ -22,3 +23,45 @@ class DjangoSettings(AppBaseSettings):
 
 class PathSettings(AppBaseSettings):
     base_dir: Path = Path(__file__).resolve().parent.parent.parent
+
+
+class ImageOpsSettings(AppBaseSettings):
+    exiftool_pool_size: int = Field(default=2, ge=1, description="Maximum number of exiftool processes per worker")
+    exiftool_timeout: float = Field(
+        default=60.0,
+        gt=0,
+        description="Seconds per file an exiftool command may run before its process is considered hung and restarted",
+    )
+    derivative_workers: int | None = Field(
+        default=None,
+        ge=1,
+        description="Number of processes creating thumbnails and WebP versions, defaults to the number of CPUs",
+    )
+    auto_sync: bool = Field(default=True, description="Periodically sync dirty images to their files")
+    auto_sync_delay: int = Field(
+        default=60,
+        ge=0,
+        description="Seconds an image must be left unchanged before it is automatically synced",
+    )
+    sync_batch_size: int = Field(default=50, ge=1, description="Number of images written to their files together")
+    sync_writers: int = Field(
+        default=2,
+        ge=1,
+        description="Number of exiftool processes writing at once when syncing, 1 suits spinning disks",
+    )
+    rendition_cache_bytes: int = Field(
+        default=1024 * 1024 * 1024,
+        ge=0,
+        description="Size in bytes the cached renditions are trimmed to every 10 minutes, least recently used first",
+    )
+
+
+class FileServingSettings(AppBaseSettings):
+    file_serving: FileServingChoices = Field(
+        default=FileServingChoices.Python,
+        description="Who sends the bytes of image files, the Python worker or the front server",
+    )
+    x_accel_redirect_prefix: str = Field(
+        default="/internal",
+        description="Internal nginx location which maps to the root of the file system, for x-accel-redirect",
+    )
@@ -6,3 +6,10 @@ class DatabaseChoices(enum.Enum):
     Sqlite3 = "sqlite3"
     Postgres = "postgres"
     MariaDB = "mariadb"
+
+
+@enum.unique
+class FileServingChoices(enum.Enum):
+    Python = "python"
+    XAccelRedirect = "x-accel-redirect"
+    XSendfile = "x-sendfile"
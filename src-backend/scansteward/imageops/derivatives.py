@@ -0,0 +1,153 @@
+import atexit
+import dataclasses
+import logging
+import multiprocessing
+import os
+from collections.abc import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from imagehash import phash
+from PIL import Image
+from PIL import ImageOps
+
+from scansteward.config import get_image_ops_settings
+from scansteward.utils import calculate_blake3_hash
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (500, 500)
+FULL_SIZE_QUALITY = 90
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DerivativeRequest:
+    """
+    Where to read an original from and where to write its thumbnail and full size WebP.
+
+    Only paths are sent to the worker processes, which read the original themselves, so the contents of an
+    original are never copied between processes
+    """
+
+    original: Path
+    thumbnail: Path
+    full_size: Path
+    hash_threads: int = 4
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DerivativeResult:
+    """
+    The checksums of the generated files, and the perceptual hash and dimensions of the original
+    """
+
+    thumbnail: Path
+    full_size: Path
+    thumbnail_checksum: str
+    full_size_checksum: str
+    phash: str
+    width: int
+    height: int
+
+
+def generate_derivatives(request: DerivativeRequest) -> DerivativeResult:
+    """
+    Decodes the original once, then creates the full size WebP and the thumbnail from the same
+    decoded image.  The perceptual hash is calculated from the decoded original as well.
+
+    This does not touch the database, so it is safe to run in a worker process
+    """
+    with Image.open(request.original) as im_file:
+        im_file.load()
+        image_phash = str(phash(im_file))
+        width, height = im_file.size
+
+        transposed = ImageOps.exif_transpose(im_file)
+        if TYPE_CHECKING:
+            assert transposed is not None
+
+        transposed.save(request.full_size, quality=FULL_SIZE_QUALITY)
+
+        # thumbnail works in place, and the full size has already been written
+        transposed.thumbnail(THUMBNAIL_SIZE)
+        transposed.save(request.thumbnail)
+
+    return DerivativeResult(
+        thumbnail=request.thumbnail,
+        full_size=request.full_size,
+        thumbnail_checksum=calculate_blake3_hash(request.thumbnail, hash_threads=request.hash_threads),
+        full_size_checksum=calculate_blake3_hash(request.full_size, hash_threads=request.hash_threads),
+        phash=image_phash,
+        width=width,
+        height=height,
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_process_derivative_executor(pid: int) -> ProcessPoolExecutor:  # noqa: ARG001
+    # spawn, not fork, as the worker may be running threads (the exiftool pipe readers for instance)
+    executor = ProcessPoolExecutor(
+        max_workers=get_image_ops_settings().derivative_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    atexit.register(executor.shutdown, cancel_futures=True)
+    return executor
+
+
+def get_derivative_executor() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for generating derivatives, created on first use
+    """
+    return _get_process_derivative_executor(os.getpid())
+
+
+def bulk_generate_derivatives(requests: list[DerivativeRequest]) -> list[DerivativeResult]:
+    """
+    Generates the derivatives for all the given requests, in parallel across the derivative process pool.
+    Results are returned in the same order as the requests, and the first failure is raised
+    """
+    results: list[DerivativeResult] = []
+    for outcome in start_generating_derivatives(requests):
+        if isinstance(outcome, Exception):
+            raise outcome
+        results.append(outcome)
+    return results
+
+
+def _generate_or_error(request: DerivativeRequest) -> DerivativeResult | Exception:
+    try:
+        return generate_derivatives(request)
+    except Exception as e:  # noqa: BLE001
+        return e
+
+
+def _result_or_error(future: Future[DerivativeResult]) -> DerivativeResult | Exception:
+    try:
+        return future.result()
+    except Exception as e:  # noqa: BLE001
+        return e
+
+
+def start_generating_derivatives(requests: list[DerivativeRequest]) -> Iterator[DerivativeResult | Exception]:
+    """
+    Submits all the given requests to the derivative process pool straight away, returning an iterator over
+    their results in the same order as the requests.  Other work can be done while the pool is busy.
+
+    A request which fails, such as an original which cannot be decoded, gives its exception in place of its
+    result, so it never costs the rest of the batch their derivatives.
+
+    A single request, or a pool limited to a single worker, is handled in this process as the results are
+    iterated, as there is nothing to gain from the pool
+    """
+    if not requests:
+        return iter([])
+    workers = get_image_ops_settings().derivative_workers
+    if len(requests) == 1 or (workers is not None and workers <= 1):
+        return (_generate_or_error(request) for request in requests)
+    logger.debug(f"Generating derivatives for {len(requests)} images in the process pool")
+    executor = get_derivative_executor()
+    futures = [executor.submit(generate_derivatives, request) for request in requests]
+    return (_result_or_error(future) for future in futures)
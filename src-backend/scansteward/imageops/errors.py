@@ -1,3 +1,11 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from scansteward.imageops.exiftool import ExifToolResult
+
+
 class ImageOperationError(Exception):
     """
     Base exception for all errors which arise from this library
@@ -20,3 +28,19 @@ class ImagePathNotFileError(ImageOperationError):
     """
     A provided image path is not a file
     """
+
+
+class ExifToolProcessError(ImageOperationError):
+    """
+    The exiftool process could not be communicated with, it may have crashed or stopped responding
+    """
+
+
+class ExifToolError(ImageOperationError):
+    """
+    exiftool ran the command, but reported it failed
+    """
+
+    def __init__(self, message: str, result: ExifToolResult) -> None:
+        super().__init__(message)
+        self.result = result
@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import atexit
+import dataclasses
+import itertools
+import logging
+import os
+import queue
+import subprocess
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import IO
+from typing import TYPE_CHECKING
+
+from scansteward.config import get_image_ops_settings
+from scansteward.imageops.constants import EXIF_TOOL_EXE
+from scansteward.imageops.errors import ExifToolError
+from scansteward.imageops.errors import ExifToolProcessError
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ExifToolResult:
+    """
+    The output of a single -execute of an exiftool process
+    """
+
+    stdout: bytes
+    stderr: bytes
+    status: int
+
+    def log_output(self) -> None:
+        """
+        Logs the output lines, with stderr as errors if the command failed
+        """
+        for line in self.stderr.decode("utf-8").splitlines():
+            if self.status != 0:
+                logger.error(f"exiftool stderr: {line}")
+            else:
+                logger.debug(f"exiftool stderr: {line}")
+        for line in self.stdout.decode("utf-8").splitlines():
+            logger.debug(f"exiftool stdout: {line}")
+
+    def check_status(self) -> None:
+        """
+        Raises ExifToolError if the command did not succeed
+        """
+        if self.status != 0:
+            msg = f"exiftool exited with status {self.status}"
+            raise ExifToolError(msg, self)
+
+
+class _StreamReader:
+    """
+    Continuously drains a pipe of the exiftool process into a buffer on a daemon thread.
+
+    Both stdout and stderr are read this way, so neither pipe can fill up and stall exiftool
+    while the other is waited on.
+    """
+
+    def __init__(self, stream: IO[bytes], name: str) -> None:
+        self._stream = stream
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            chunk = self._stream.read1(65536)  # type: ignore[attr-defined]
+            with self._condition:
+                if not chunk:
+                    self._closed = True
+                    self._condition.notify_all()
+                    return
+                self._buffer.extend(chunk)
+                self._condition.notify_all()
+
+    def read_until(self, sentinel: bytes, timeout: float | None = None) -> bytes:
+        """
+        Blocks until the sentinel is in the buffer, then returns everything before it and
+        discards the sentinel (and its line ending) from the buffer
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: sentinel in self._buffer or self._closed, timeout=timeout):
+                msg = f"Timed out waiting for exiftool to respond after {timeout}s"
+                raise ExifToolProcessError(msg)
+            index = self._buffer.find(sentinel)
+            if index == -1:
+                msg = "exiftool exited unexpectedly"
+                raise ExifToolProcessError(msg)
+            data = bytes(self._buffer[:index])
+            end = index + len(sentinel)
+            # exiftool terminates the sentinel with a newline, which may be \r\n on Windows
+            while end < len(self._buffer) and self._buffer[end] in b"\r\n":
+                end += 1
+            del self._buffer[:end]
+            return data
+
+
+class ExifToolProcess:
+    """
+    A single long running exiftool process, driven through the -stay_open argument file protocol.
+
+    Each command is written to stdin as one argument per line, followed by -execute<N>.  exiftool
+    then prints {ready<N>} to stdout when it is done, and -echo4 is used to write the exit status
+    of the command to stderr, so both streams are delimited.
+
+    See https://exiftool.org/exiftool_pod.html#stay_open-FLAG
+    """
+
+    def __init__(self, executable: str = EXIF_TOOL_EXE) -> None:
+        self.executable = executable
+        self._process: subprocess.Popen[bytes] | None = None
+        self._stdout: _StreamReader | None = None
+        self._stderr: _StreamReader | None = None
+        self._sequence = itertools.count(1)
+
+    @property
+    def pid(self) -> int | None:
+        return self._process.pid if self._process is not None else None
+
+    def start(self) -> None:
+        if self.is_alive():
+            return
+        logger.debug(f"Starting exiftool process {self.executable}")
+        self._process = subprocess.Popen(
+            [self.executable, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if TYPE_CHECKING:
+            assert self._process.stdout is not None
+            assert self._process.stderr is not None
+        self._stdout = _StreamReader(self._process.stdout, f"exiftool-{self._process.pid}-stdout")
+        self._stderr = _StreamReader(self._process.stderr, f"exiftool-{self._process.pid}-stderr")
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def check_health(self, timeout: float = 10.0) -> bool:
+        """
+        Round trips a version request to the process, returning False if it did not answer correctly
+        """
+        try:
+            result = self.execute(["-ver"], timeout=timeout)
+        except ExifToolProcessError:
+            return False
+        return result.status == 0 and bool(result.stdout.strip())
+
+    def execute(self, args: list[str], *, timeout: float | None = None) -> ExifToolResult:
+        """
+        Runs a single exiftool command in the running process and returns its output
+        """
+        return self.collect(self.submit(args), timeout=timeout)
+
+    def submit(self, args: list[str]) -> int:
+        """
+        Queues a command to the running process without waiting for it, returning its sequence number.
+
+        exiftool runs queued commands in order, so several can be submitted ahead, keeping it busy while
+        earlier output is handled.  Every submitted command must then be collected, in the same order
+        """
+        if not self.is_alive():
+            msg = "exiftool process is not running"
+            raise ExifToolProcessError(msg)
+        if TYPE_CHECKING:
+            assert self._process is not None
+            assert self._process.stdin is not None
+
+        for arg in args:
+            if "\n" in arg or "\r" in arg:
+                msg = f"exiftool arguments cannot contain line breaks: {arg!r}"
+                raise ValueError(msg)
+
+        sequence = next(self._sequence)
+        command = "\n".join([*args, "-echo4", f"=${{status}}{{post{sequence}}}", f"-execute{sequence}", ""])
+
+        try:
+            self._process.stdin.write(command.encode("utf-8"))
+            self._process.stdin.flush()
+        except OSError as e:
+            msg = "Unable to write to the exiftool process"
+            raise ExifToolProcessError(msg) from e
+        return sequence
+
+    def collect(self, sequence: int, *, timeout: float | None = None) -> ExifToolResult:
+        """
+        Waits for the output of the submitted command with the given sequence number
+        """
+        if self._stdout is None or self._stderr is None:
+            msg = "exiftool process is not running"
+            raise ExifToolProcessError(msg)
+
+        stdout = self._stdout.read_until(f"{{ready{sequence}}}".encode(), timeout=timeout)
+        stderr = self._stderr.read_until(f"{{post{sequence}}}".encode(), timeout=timeout)
+
+        # The stderr ends with =<status>, with any actual error output before it
+        stderr, _, raw_status = stderr.rpartition(b"=")
+        try:
+            status = int(raw_status.strip())
+        except ValueError:  # pragma: no cover
+            status = -1
+
+        return ExifToolResult(stdout=stdout, stderr=stderr, status=status)
+
+    def terminate(self, timeout: float = 5.0) -> None:
+        if self._process is None:
+            return
+        if self.is_alive():
+            if TYPE_CHECKING:
+                assert self._process.stdin is not None
+            try:
+                self._process.stdin.write(b"-stay_open\nFalse\n")
+                self._process.stdin.flush()
+                self._process.stdin.close()
+                self._process.wait(timeout=timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+        for stream in (self._process.stdin, self._process.stdout, self._process.stderr):
+            if stream is not None:
+                stream.close()
+        logger.debug(f"Stopped exiftool process {self._process.pid}")
+        self._process = None
+        self._stdout = None
+        self._stderr = None
+
+    def restart(self) -> None:
+        self.terminate()
+        self.start()
+
+
+class ExifToolPool:
+    """
+    A bounded pool of long running exiftool processes.
+
+    Processes are started lazily, up to max_size, and are reused between calls, so the cost of
+    starting the Perl interpreter is only paid once per process.  A process which has died is
+    restarted before being handed out, and a command which fails because the process crashed
+    is retried once on a fresh process.
+    """
+
+    def __init__(self, max_size: int = 2, executable: str = EXIF_TOOL_EXE, timeout: float | None = None) -> None:
+        if max_size < 1:
+            msg = "The exiftool pool must allow at least 1 process"
+            raise ValueError(msg)
+        self.max_size = max_size
+        self.executable = executable
+        # How long a command may run per file before its process is considered hung, and restarted
+        self.timeout = timeout
+        self._idle: queue.LifoQueue[ExifToolProcess] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._all: list[ExifToolProcess] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, timeout: float | None = None) -> Iterator[ExifToolProcess]:
+        """
+        Checks out a running process from the pool, blocking until one is available
+        """
+        if not self._slots.acquire(timeout=timeout):
+            msg = f"No exiftool process became available after {timeout}s"
+            raise ExifToolProcessError(msg)
+        try:
+            try:
+                process = self._idle.get_nowait()
+            except queue.Empty:
+                process = ExifToolProcess(self.executable)
+                with self._lock:
+                    self._all.append(process)
+            if not process.is_alive():
+                process.restart()
+            try:
+                yield process
+            finally:
+                self._idle.put(process)
+        finally:
+            self._slots.release()
+
+    def timeout_for(self, files: int) -> float | None:
+        """
+        How long a command on the given number of files may run, as a large batch of large files can take a
+        long time to write
+        """
+        if self.timeout is None:
+            return None
+        return self.timeout * max(1, files)
+
+    def execute(self, args: list[str], *, timeout: float | None = None, files: int = 1) -> ExifToolResult:
+        """
+        Runs the given command on a pooled process, retrying once on a new process if it crashed or hung.
+        Without a timeout, the timeout of the pool for the given number of files is used
+        """
+        if timeout is None:
+            timeout = self.timeout_for(files)
+        with self.acquire() as process:
+            try:
+                return process.execute(args, timeout=timeout)
+            except ExifToolProcessError:
+                logger.warning(f"exiftool process {process.pid} failed, restarting it")
+                process.restart()
+                return process.execute(args, timeout=timeout)
+
+    def check_health(self, timeout: float = 10.0) -> None:
+        """
+        Restarts any idle processes which are no longer answering within the timeout.
+
+        Each process is checked out with a slot, as acquire does, so while it is being checked no other process
+        can be started in its place.  Processes in use are left alone, they are busy rather than idle
+        """
+        checked: list[ExifToolProcess] = []
+        try:
+            while self._slots.acquire(blocking=False):
+                try:
+                    process = self._idle.get_nowait()
+                except queue.Empty:
+                    self._slots.release()
+                    break
+                checked.append(process)
+                if process.is_alive() and not process.check_health(timeout=timeout):
+                    logger.warning(f"exiftool process {process.pid} is unhealthy, restarting it")
+                    process.restart()
+        finally:
+            for process in checked:
+                self._idle.put(process)
+                self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            for process in self._all:
+                process.terminate()
+            self._all.clear()
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+
+@lru_cache(maxsize=1)
+def _get_process_exiftool_pool(pid: int) -> ExifToolPool:  # noqa: ARG001
+    settings = get_image_ops_settings()
+    # Every concurrent sync writer needs its own process
+    pool = ExifToolPool(
+        max_size=max(settings.exiftool_pool_size, settings.sync_writers),
+        timeout=settings.exiftool_timeout,
+    )
+    atexit.register(pool.close)
+    return pool
+
+
+def get_exiftool_pool() -> ExifToolPool:
+    """
+    Returns the exiftool pool for this process.  The pid is part of the cache key, so a forked worker
+    never shares the pipes of its parent's processes
+    """
+    return _get_process_exiftool_pool(os.getpid())
@@ -0,0 +1,91 @@
+import dataclasses
+import os
+from pathlib import Path
+
+from scansteward.models import Image as ImageModel
+from scansteward.models import ImageFingerprint
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class FileFingerprint:
+    """
+    The stat details of a file which are used to decide if it changed since it was last indexed
+    """
+
+    path: Path
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_path(cls, path: Path) -> "FileFingerprint":
+        path = path.resolve()
+        return cls.from_stat(path, path.stat())
+
+    @classmethod
+    def from_stat(cls, path: Path, stat: os.stat_result) -> "FileFingerprint":
+        return cls(path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=stat.st_ino)
+
+    def matches(self, fingerprint: ImageFingerprint) -> bool:
+        return (
+            fingerprint.size == self.size and fingerprint.mtime_ns == self.mtime_ns and fingerprint.inode == self.inode
+        )
+
+
+def find_unchanged_images(
+    fingerprints: list[FileFingerprint],
+) -> tuple[dict[Path, ImageModel], list[FileFingerprint]]:
+    """
+    Splits the given files into those which are already indexed and unchanged, mapped to their Image,
+    and those which need to be read and hashed.  This is a single query, no file contents are read.
+
+    The Image of an unchanged file may have its original elsewhere, as the file is a copy of it, or the Image
+    moved there from this file since
+    """
+    stored = {
+        fingerprint.path: fingerprint
+        for fingerprint in ImageFingerprint.objects.filter(
+            path__in=[str(x.path) for x in fingerprints],
+        ).select_related("image")
+    }
+
+    unchanged: dict[Path, ImageModel] = {}
+    changed: list[FileFingerprint] = []
+    for fingerprint in fingerprints:
+        existing = stored.get(str(fingerprint.path))
+        if existing is not None and fingerprint.matches(existing):
+            unchanged[fingerprint.path] = existing.image
+        else:
+            changed.append(fingerprint)
+    return unchanged, changed
+
+
+def save_fingerprints(indexed: list[tuple[FileFingerprint, ImageModel]], *, forget_copies: bool = False) -> None:
+    """
+    Records the fingerprints of the given files as indexed to the given Images, replacing any older fingerprint
+    of the same file.
+
+    When the originals themselves were changed, any copies recorded for their Images no longer hold the same
+    contents, so are forgotten, to be read again
+    """
+    if not indexed:
+        return
+    if forget_copies:
+        ImageFingerprint.objects.filter(image__in=[image for _, image in indexed]).exclude(
+            path__in=[str(fingerprint.path) for fingerprint, _ in indexed],
+        ).delete()
+    ImageFingerprint.objects.bulk_create(
+        [
+            ImageFingerprint(
+                image=image,
+                path=str(fingerprint.path),
+                size=fingerprint.size,
+                mtime_ns=fingerprint.mtime_ns,
+                inode=fingerprint.inode,
+            )
+            for fingerprint, image in indexed
+        ],
+        update_conflicts=True,
+        unique_fields=["path"],
+        update_fields=["image", "size", "mtime_ns", "inode", "modified"],
+    )
@@ -1,29 +1,61 @@
+import contextlib
+import dataclasses
 from datetime import date
+from logging import Logger
+from pathlib import Path
 from typing import TYPE_CHECKING
+from uuid import uuid4
 
-from PIL import Image
-from PIL import ImageOps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from scansteward.imageops.constants import DATE_KEYWORD
 from scansteward.imageops.constants import LOCATION_KEYWORD
 from scansteward.imageops.constants import PEOPLE_KEYWORD
+from scansteward.imageops.derivatives import DerivativeRequest
+from scansteward.imageops.derivatives import DerivativeResult
+from scansteward.imageops.derivatives import start_generating_derivatives
+from scansteward.imageops.ingest import IngestedImage
+from scansteward.imageops.metadata import iter_image_metadata
 from scansteward.imageops.metadata import read_image_metadata
 from scansteward.imageops.models import ImageMetadata
 from scansteward.imageops.models import KeywordStruct
+from scansteward.imageops.models import RegionStruct
+from scansteward.imageops.resolvers import EntityCache
+from scansteward.imageops.resolvers import TagTreeResolver
+from scansteward.imageops.resolvers import apply_keyword_trees
 from scansteward.models import Image as ImageModel
 from scansteward.models import Person
 from scansteward.models import PersonInImage
 from scansteward.models import Pet
 from scansteward.models import PetInImage
-from scansteward.models import RoughDate
-from scansteward.models import RoughLocation
-from scansteward.models import Tag
-from scansteward.models import TagOnImage
 from scansteward.routes.locations.utils import get_country_code_from_name
 from scansteward.routes.locations.utils import get_subdivision_code_from_name
+from scansteward.signals.batching import mark_images_dirty
+from scansteward.tasks.models import ImageIndexBatchTaskModel
 from scansteward.tasks.models import ImageIndexTaskModel
-from scansteward.utils import calculate_blake3_hash
-from scansteward.utils import calculate_image_phash
+
+# The RoughLocation country code, subdivision code, city and sub location
+LocationKey = tuple[str, str | None, str | None, str | None]
+# The RoughDate date, and if its month and day are valid
+DateKey = tuple[date, bool, bool]
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class PreparedImage:
+    """
+    A new image with everything which could be done outside the database already done
+    """
+
+    image_path: Path
+    original_checksum: str
+    file_size: int
+    metadata: ImageMetadata
+    derivatives: DerivativeResult
+    # Where the derivatives were moved to, once the Image row exists.  Removed again if the transaction fails
+    placed: list[Path] = dataclasses.field(default_factory=list)
 
 
 def handle_existing_image(
@@ -49,318 +81,467 @@ def handle_existing_image(
     pkg.logger.info(f"  {pkg.image_path.name} indexing completed")
 
 
-def handle_new_image(pkg: ImageIndexTaskModel) -> None:
+def parse_region_info(
+    images: list[tuple[ImageModel, ImageMetadata]],
+    logger: Logger,
+    cache: EntityCache,
+) -> None:
     """
-    Handles a completely new image
+    Parses the MWG regions of the given images into people and pets.
+
+    Each distinct Person and Pet is fetched or created once through the cache, and the boxes of the whole
+    batch are written with a single bulk insert per type
     """
+    faces: list[tuple[ImageModel, RegionStruct]] = []
+    pets: list[tuple[ImageModel, RegionStruct]] = []
+    for new_image, metadata in images:
+        logger.info(f"  Parsing regions for {new_image.original_path.name}")
+        if not metadata.RegionInfo:
+            continue
+        for region in metadata.RegionInfo.RegionList:
+            if region.Type == "Face" and region.Name:
+                logger.info(f"  Found face for person {region.Name}")
+                faces.append((new_image, region))
+            elif region.Type == "Pet" and region.Name:
+                logger.info(f"  Found box for pet {region.Name}")
+                pets.append((new_image, region))
+            elif not region.Name:  # pragma: no cover
+                logger.warning("  Skipping region with empty Name")
+            elif region.Type not in {"Face", "Pet"}:  # pragma: no cover
+                logger.warning(f"  Skipping region of type {region.Type}")
+
+    cache.people.resolve((region.Name,) for _, region in faces)
+    cache.pets.resolve((region.Name,) for _, region in pets)
+
+    # Update any changed descriptions, before the new boxes exist
+    for model, model_cache, regions in ((Person, cache.people, faces), (Pet, cache.pets, pets)):
+        changed: dict[int, Person | Pet] = {}
+        for _, region in regions:
+            instance = model_cache.get((region.Name,))
+            if TYPE_CHECKING:
+                assert instance is not None
+            if region.Description and instance.description != region.Description:
+                instance.description = region.Description
+                changed[instance.pk] = instance
+        if changed:
+            # auto_now is not applied by bulk_update
+            now = timezone.now()
+            for instance in changed.values():
+                instance.modified = now
+            model.objects.bulk_update(changed.values(), fields=["description", "modified"])
+            # bulk_update does not send post_save, so mark the images the description is synced to here.
+            # The images being indexed already have the new description
+            related = {Person: "people__pk__in", Pet: "pets__pk__in"}[model]
+            mark_images_dirty(
+                Q(**{related: list(changed.keys())}) & ~Q(pk__in=[new_image.pk for new_image, _ in images]),
+            )
 
-    if TYPE_CHECKING:
-        assert pkg.logger is not None
+    PersonInImage.objects.bulk_create(
+        [
+            PersonInImage(
+                person=cache.people.get((region.Name,)),
+                image=new_image,
+                center_x=region.Area.X,
+                center_y=region.Area.Y,
+                height=region.Area.H,
+                width=region.Area.W,
+            )
+            for new_image, region in faces
+        ],
+    )
+    PetInImage.objects.bulk_create(
+        [
+            PetInImage(
+                pet=cache.pets.get((region.Name,)),
+                image=new_image,
+                center_x=region.Area.X,
+                center_y=region.Area.Y,
+                height=region.Area.H,
+                width=region.Area.W,
+            )
+            for new_image, region in pets
+        ],
+    )
 
-    def parse_region_info(new_image: ImageModel, metadata: ImageMetadata):
-        """
-        Parses the MWG regions into people and pets
-        """
 
-        if TYPE_CHECKING:
-            assert pkg.logger is not None
-
-        pkg.logger.info("  Parsing regions")
-        if metadata.RegionInfo:
-            for region in metadata.RegionInfo.RegionList:
-                if region.Type == "Face" and region.Name:
-                    person, _ = Person.objects.get_or_create(name=region.Name)
-                    if region.Description:
-                        person.description = region.Description
-                        person.save()
-                    pkg.logger.info(f"  Found face for person {person.name}")
-                    _ = PersonInImage.objects.create(
-                        person=person,
-                        image=new_image,
-                        center_x=region.Area.X,
-                        center_y=region.Area.Y,
-                        height=region.Area.H,
-                        width=region.Area.W,
-                    )
-                elif region.Type == "Pet" and region.Name:
-                    pet, _ = Pet.objects.get_or_create(name=region.Name)
-                    if region.Description:
-                        pet.description = region.Description
-                        pet.save()
-
-                    pkg.logger.info(f"  Found box for pet {pet.name}")
-                    _ = PetInImage.objects.create(
-                        pet=pet,
-                        image=new_image,
-                        center_x=region.Area.X,
-                        center_y=region.Area.Y,
-                        height=region.Area.H,
-                        width=region.Area.W,
-                    )
-                elif not region.Name:  # pragma: no cover
-                    pkg.logger.warning("  Skipping region with empty Name")
-                elif region.Type not in {"Face", "Pet"}:  # pragma: no cover
-                    pkg.logger.warning(f"  Skipping region of type {region.Type}")
-
-    def parse_keywords(new_image: ImageModel, metadata: ImageMetadata):
-        """
-        Creates database Tags from the MWG keyword struct
-        """
-        if TYPE_CHECKING:
-            assert pkg.logger is not None
-
-        def maybe_create_tag_tree(
-            image_instance: ImageModel,
-            parent: Tag,
-            tree_node: KeywordStruct,
-        ):
-            existing_node, _ = Tag.objects.get_or_create(
-                name=tree_node.Keyword,
-                parent=parent,
-            )
+def parse_keywords(
+    images: list[tuple[ImageModel, ImageMetadata]],
+    logger: Logger,
+    resolver: TagTreeResolver,
+) -> None:
+    """
+    Creates database Tags from the MWG keyword structs of the given images, and attaches them.
 
-            applied_value = False
-            # If the keyword is applied, then it is applied
-            if tree_node.Applied is not None and tree_node.Applied:
-                applied_value = True
-            # If the keyword is not applied, but this is a leaf, it is applied
-            if not applied_value and not len(tree_node.Children):
-                applied_value = True
-
-            TagOnImage.objects.create(tag=existing_node, image=new_image, applied=applied_value)
-
-            # Process children
-            for node_child in tree_node.Children:
-                maybe_create_tag_tree(image_instance, existing_node, node_child)
-
-        pkg.logger.info("  Parsing keywords")
-        if metadata.KeywordInfo:
-            for keyword in metadata.KeywordInfo.Hierarchy:
-                # Skip keywords with dedicated processing
-                if keyword.Keyword.lower() in {
-                    PEOPLE_KEYWORD.lower(),
-                    DATE_KEYWORD.lower(),
-                    LOCATION_KEYWORD.lower(),
-                }:
-                    continue
-                existing_root_tag, _ = Tag.objects.get_or_create(
-                    name=keyword.Keyword,
-                    parent=None,
-                )
-                applied_value = False
-                # If the keyword is applied, then it is applied
-                if keyword.Applied is not None and keyword.Applied:
-                    applied_value = True
-                # If the keyword is not applied, but this is a leaf, it is applied
-                if not applied_value and not len(keyword.Children):
-                    applied_value = True
-                TagOnImage.objects.create(tag=existing_root_tag, image=new_image, applied=applied_value)
-
-                # Process any children
-                for child in keyword.Children:
-                    maybe_create_tag_tree(new_image, existing_root_tag, child)
-        else:  # pragma: no cover
-            pkg.logger.info("  No keywords")
-
-    def parse_location(new_image: ImageModel, metadata: ImageMetadata):
-        """
-        Creates a RoughLocation from a given ImageMetadata object and adds it to the given image.
-        """
-        if TYPE_CHECKING:
-            assert pkg.logger is not None
-        if metadata.Country:
-            country_alpha_2 = get_country_code_from_name(metadata.Country)
-            if country_alpha_2:
-                pkg.logger.info(f"  Got country {country_alpha_2} from {metadata.Country}")
-                subdivision_code = None
-                if metadata.State:
-                    subdivision_code = get_subdivision_code_from_name(
-                        country_alpha_2,
-                        metadata.State,
-                    )
-                    if not subdivision_code:
-                        pkg.logger.warning(f"  No subdivision code found from {metadata.State}")
-                    else:
-                        pkg.logger.info(f"  Got subdivision code {subdivision_code} from {metadata.State}")
-                location, _ = RoughLocation.objects.get_or_create(
-                    country_code=country_alpha_2,
-                    subdivision_code=subdivision_code,
-                    city=metadata.City,
-                    sub_location=metadata.Location,
+    The whole batch is handled together, so Tags and TagOnImage rows are created in bulk
+    """
+    trees: list[tuple[ImageModel, list[KeywordStruct]]] = []
+    for new_image, metadata in images:
+        logger.info(f"  Parsing keywords for {new_image.original_path.name}")
+        if not metadata.KeywordInfo:  # pragma: no cover
+            logger.info("  No keywords")
+            continue
+        trees.append(
+            (
+                new_image,
+                [
+                    keyword
+                    for keyword in metadata.KeywordInfo.Hierarchy
+                    # Skip keywords with dedicated processing
+                    if keyword.Keyword.lower()
+                    not in {
+                        PEOPLE_KEYWORD.lower(),
+                        DATE_KEYWORD.lower(),
+                        LOCATION_KEYWORD.lower(),
+                    }
+                ],
+            ),
+        )
+    apply_keyword_trees(resolver, trees)
+
+
+def parse_location(metadata: ImageMetadata, logger: Logger) -> LocationKey | None:
+    """
+    Parses the RoughLocation fields from the MWG location of a given ImageMetadata object
+    """
+    if metadata.Country:
+        country_alpha_2 = get_country_code_from_name(metadata.Country)
+        if country_alpha_2:
+            logger.info(f"  Got country {country_alpha_2} from {metadata.Country}")
+            subdivision_code = None
+            if metadata.State:
+                subdivision_code = get_subdivision_code_from_name(
+                    country_alpha_2,
+                    metadata.State,
                 )
-                new_image.location = location
-                new_image.save()
-                pkg.logger.info(f"  Location is {location}")
-            else:
-                pkg.logger.warning(f"  No country code found from {metadata.Country}")
-        else:  # pragma: no cover
-            pkg.logger.info("  No country set, will try keywords")
-
-    def parse_location_from_keywords(new_image: ImageModel, metadata: ImageMetadata):
-        """
-        If the MWG location information is not set, attempts to parse from the keywords
-
-        Looks for a keyword structure like:
-        - Locations
-            - Country Name
-            - Subdivision Name
-                - City Name
-                    - Sub-location Name
-
-        If the subdivison doesn't match anything within the country, it is assumed to be a city instead
-
-        """
-        if TYPE_CHECKING:
-            assert pkg.logger is not None
-        if (
-            metadata.KeywordInfo
-            and (location_tree := metadata.KeywordInfo.get_root_by_name(LOCATION_KEYWORD))
-            and location_tree
-            and location_tree.Children
-        ):
-            country_node = location_tree.Children[0]
-            country_alpha2 = get_country_code_from_name(country_node.Keyword)
-            if country_alpha2:
-                subdivision_code = None
-                city = None
-                location = None
-                if len(country_node.Children) > 0:
-                    subdivision_node = country_node.Children[0]
-                    subdivision_code = get_subdivision_code_from_name(
-                        country_alpha2,
-                        subdivision_node.Keyword,
-                    )
-                    if not subdivision_code:
-                        # Assume this is a city instead
-                        city = subdivision_node.Keyword
-                    elif len(subdivision_node.Children) > 0:
-                        # If possible, use the first child as the city
-                        city_node = subdivision_node.Children[0]
-                        city = city_node.Keyword
-                        if len(city_node.Children) > 0:
-                            location = city_node.Children[0].Keyword
-
-                location, _ = RoughLocation.objects.get_or_create(
-                    country_code=country_alpha2,
-                    subdivision_code=subdivision_code,
-                    city=city,
-                    sub_location=location,
+                if not subdivision_code:
+                    logger.warning(f"  No subdivision code found from {metadata.State}")
+                else:
+                    logger.info(f"  Got subdivision code {subdivision_code} from {metadata.State}")
+            return (country_alpha_2, subdivision_code, metadata.City, metadata.Location)
+        logger.warning(f"  No country code found from {metadata.Country}")
+    else:  # pragma: no cover
+        logger.info("  No country set, will try keywords")
+    return None
+
+
+def parse_location_from_keywords(metadata: ImageMetadata, logger: Logger) -> LocationKey | None:
+    """
+    If the MWG location information is not set, attempts to parse from the keywords
+
+    Looks for a keyword structure like:
+    - Locations
+        - Country Name
+        - Subdivision Name
+            - City Name
+                - Sub-location Name
+
+    If the subdivison doesn't match anything within the country, it is assumed to be a city instead
+    """
+    if (
+        metadata.KeywordInfo
+        and (location_tree := metadata.KeywordInfo.get_root_by_name(LOCATION_KEYWORD))
+        and location_tree
+        and location_tree.Children
+    ):
+        country_node = location_tree.Children[0]
+        country_alpha2 = get_country_code_from_name(country_node.Keyword)
+        if country_alpha2:
+            subdivision_code = None
+            city = None
+            location = None
+            if len(country_node.Children) > 0:
+                subdivision_node = country_node.Children[0]
+                subdivision_code = get_subdivision_code_from_name(
+                    country_alpha2,
+                    subdivision_node.Keyword,
                 )
-                new_image.location = location
-                new_image.save()
-                pkg.logger.info(f"  RoughLocation is {location}")
-
-    def parse_dates_from_keywords(new_image: ImageModel, metadata: ImageMetadata):
-        """
-        Looks for a keyword structure like:
-        - Dates and Times
-            - 1980
-            - 12 - December
-                - 25
-
-        Which will convert into a date like: 1980-12-25
-
-        If no month is found, no day will be looked for.  It is possible to have a rough date of just a year,
-        just a month and year or a year, month, day fully built
-        """
-        if TYPE_CHECKING:
-            assert pkg.logger is not None
-        if (
-            metadata.KeywordInfo
-            and metadata.KeywordInfo
-            and (date_and_time_tree := metadata.KeywordInfo.get_root_by_name(DATE_KEYWORD))
-            and len(date_and_time_tree.Children) > 0
-        ):
-            year_node = date_and_time_tree.Children[0]
-            month = 1
-            month_valid = False
+                if not subdivision_code:
+                    # Assume this is a city instead
+                    city = subdivision_node.Keyword
+                elif len(subdivision_node.Children) > 0:
+                    # If possible, use the first child as the city
+                    city_node = subdivision_node.Children[0]
+                    city = city_node.Keyword
+                    if len(city_node.Children) > 0:
+                        location = city_node.Children[0].Keyword
+
+            logger.info(f"  Got location {country_alpha2}, {subdivision_code}, {city}, {location} from keywords")
+            return (country_alpha2, subdivision_code, city, location)
+    return None
+
+
+def parse_dates_from_keywords(metadata: ImageMetadata, logger: Logger) -> DateKey | None:
+    """
+    Looks for a keyword structure like:
+    - Dates and Times
+        - 1980
+        - 12 - December
+            - 25
+
+    Which will convert into a date like: 1980-12-25
+
+    If no month is found, no day will be looked for.  It is possible to have a rough date of just a year,
+    just a month and year or a year, month, day fully built
+    """
+    if (
+        metadata.KeywordInfo
+        and metadata.KeywordInfo
+        and (date_and_time_tree := metadata.KeywordInfo.get_root_by_name(DATE_KEYWORD))
+        and len(date_and_time_tree.Children) > 0
+    ):
+        year_node = date_and_time_tree.Children[0]
+        month = 1
+        month_valid = False
+        day = 1
+        day_valid = False
+        if len(year_node.Children) > 0:
+            month_node = year_node.Children[0]
             day = 1
             day_valid = False
-            if len(year_node.Children) > 0:
-                month_node = year_node.Children[0]
-                day = 1
-                day_valid = False
-                if len(month_node.Children) > 0:
-                    day_node = month_node.Children[0]
-                    try:
-                        day = int(day_node.Keyword)
-                        day_valid = True
-                    except ValueError:
-                        pass
+            if len(month_node.Children) > 0:
+                day_node = month_node.Children[0]
                 try:
-                    month = int(month_node.Keyword.split("-")[0])
-                    month_valid = True
+                    day = int(day_node.Keyword)
+                    day_valid = True
                 except ValueError:
                     pass
             try:
-                year = int(year_node.Keyword)
-
-                rough_date, _ = RoughDate.objects.get_or_create(
-                    date=date(year=year, month=month, day=day),
-                    month_valid=month_valid,
-                    day_valid=day_valid,
-                )
-                pkg.logger.info(f"  Set rough date of {rough_date}")
-                new_image.date = rough_date
-                new_image.save()
+                month = int(month_node.Keyword.split("-")[0])
+                month_valid = True
             except ValueError:
                 pass
+        try:
+            year = int(year_node.Keyword)
+            rough_date = date(year=year, month=month, day=day)
+        except ValueError:
+            return None
+        logger.info(f"  Got rough date of {rough_date} (month valid: {month_valid}, day valid: {day_valid})")
+        return (rough_date, month_valid, day_valid)
+    return None
+
+
+def parse_locations_and_dates(
+    images: list[tuple[ImageModel, ImageMetadata]],
+    logger: Logger,
+    cache: EntityCache,
+) -> None:
+    """
+    Sets the RoughLocation and RoughDate of the given images, preferring the MWG location over the keywords.
+    Each distinct location and date is fetched or created once through the cache.
 
-    metadata = read_image_metadata(pkg.image_path)
-
-    new_img = ImageModel.objects.create(
-        file_size=pkg.image_path.stat().st_size,
-        original=str(pkg.image_path.resolve()),
-        source=pkg.source,
-        orientation=metadata.Orientation or ImageModel.OrientationChoices.HORIZONTAL,
-        description=metadata.Description,
-        height=metadata.ImageHeight,
-        width=metadata.ImageWidth,
-        original_checksum=calculate_blake3_hash(pkg.image_path, hash_threads=pkg.hash_threads),
-        phash=calculate_image_phash(pkg.image_path),
-        # These are placeholders, the files do not exist yet
-        thumbnail_checksum="A",
-        full_size_checksum="B",
-        # This time cannot be dirty
-        is_dirty=False,
+    The images are not saved, that is left to the caller
+    """
+    locations: list[tuple[ImageModel, LocationKey]] = []
+    dates: list[tuple[ImageModel, DateKey]] = []
+    for new_image, metadata in images:
+        location_key = parse_location(metadata, logger) or parse_location_from_keywords(metadata, logger)
+        if location_key is not None:
+            locations.append((new_image, location_key))
+        date_key = parse_dates_from_keywords(metadata, logger)
+        if date_key is not None:
+            dates.append((new_image, date_key))
+
+    cache.locations.resolve(key for _, key in locations)
+    cache.dates.resolve(key for _, key in dates)
+
+    for new_image, location_key in locations:
+        new_image.location = cache.locations.get(location_key)
+        logger.info(f"  {new_image.original_path.name} RoughLocation is {new_image.location}")
+    for new_image, date_key in dates:
+        rough_date = cache.dates.get(date_key)
+        if rough_date is None:  # pragma: no cover
+            logger.warning(f"  Unable to use rough date {date_key[0]}, it exists with a different precision")
+            continue
+        new_image.date = rough_date
+        logger.info(f"  {new_image.original_path.name} RoughDate is {rough_date}")
+
+
+def staged_derivative_request(ingested: IngestedImage, *, hash_threads: int = 4) -> DerivativeRequest:
+    """
+    The derivatives are generated before the Image row exists, so before there is a primary key to name them by.
+    They are written next to their final location under a unique name, and moved into place once the row is created
+    """
+    if TYPE_CHECKING:
+        assert isinstance(settings.THUMBNAIL_DIR, Path)
+        assert isinstance(settings.FULL_SIZE_DIR, Path)
+    staged_name = f"staging-{uuid4().hex}.webp"
+    return DerivativeRequest(
+        original=ingested.path,
+        thumbnail=(settings.THUMBNAIL_DIR / staged_name).resolve(),
+        full_size=(settings.FULL_SIZE_DIR / staged_name).resolve(),
+        hash_threads=hash_threads,
     )
 
-    pkg.logger.info("  Creating thumbnail")
-    with Image.open(pkg.image_path) as im_file:
-        img_copy = ImageOps.exif_transpose(im_file)
-        if TYPE_CHECKING:
-            assert img_copy is not None
-        img_copy.thumbnail((500, 500))
-        img_copy.save(new_img.thumbnail_path)
 
-    pkg.logger.info("  Creating WebP version")
-    with Image.open(pkg.image_path) as im_file:
-        img_copy = ImageOps.exif_transpose(im_file)
+def prepare_new_images(
+    pkg: ImageIndexBatchTaskModel,
+    new_images: list[IngestedImage],
+) -> tuple[list[PreparedImage], dict[Path, Exception]]:
+    """
+    Does all the work for new images which does not need the database.
+
+    Each original is decoded once, by a worker of the derivative process pool, to create its derivatives.
+    While the pool works, the metadata for the whole batch is streamed from a single exiftool process.
+
+    A file which fails, such as one which cannot be decoded or has vanished, is left out of the prepared
+    images and returned with its error instead, so it never fails the rest of the batch
+    """
+    if TYPE_CHECKING:
+        assert pkg.logger is not None
+
+    pkg.logger.info(f"Creating thumbnails and WebP versions for {len(new_images)} images")
+    requests = [staged_derivative_request(ingested, hash_threads=pkg.hash_threads) for ingested in new_images]
+    derivatives = start_generating_derivatives(requests)
+
+    failed: dict[Path, Exception] = {}
+    try:
+        metadata_by_path = read_batch_metadata([ingested.path for ingested in new_images], pkg.logger, failed)
+        results = list(derivatives)
+    except Exception:
+        # Let the pool finish with the batch, so nothing is written after the staged files are removed
+        with contextlib.suppress(Exception):
+            for _ in derivatives:
+                pass
+        for request in requests:
+            request.thumbnail.unlink(missing_ok=True)
+            request.full_size.unlink(missing_ok=True)
+        raise
+
+    prepared: list[PreparedImage] = []
+    for ingested, request, derivative in zip(new_images, requests, results, strict=True):
+        if isinstance(derivative, Exception):
+            pkg.logger.error(f"Failed to create the derivatives of {ingested.path}: {derivative}")
+            failed.setdefault(ingested.path, derivative)
+        if ingested.path in failed:
+            request.thumbnail.unlink(missing_ok=True)
+            request.full_size.unlink(missing_ok=True)
+            continue
         if TYPE_CHECKING:
-            assert img_copy is not None
-        img_copy.save(new_img.full_size_path, quality=90)
+            assert isinstance(derivative, DerivativeResult)
+        prepared.append(
+            PreparedImage(
+                image_path=ingested.path,
+                original_checksum=ingested.checksum,
+                file_size=ingested.size,
+                metadata=metadata_by_path[ingested.path],
+                derivatives=derivative,
+            ),
+        )
+    return prepared, failed
+
+
+def read_batch_metadata(images: list[Path], logger: Logger, failed: dict[Path, Exception]) -> dict[Path, ImageMetadata]:
+    """
+    Reads the metadata of the batch with a single streamed read.  If that fails, the files it did not get to
+    are read one at a time, and any file which still cannot be read is added to failed, with its error
+    """
+    metadata_by_path: dict[Path, ImageMetadata] = {}
+    try:
+        for metadata in iter_image_metadata(images):
+            metadata_by_path[metadata.SourceFile.resolve()] = metadata
+    except Exception:
+        logger.exception("Failed to read the metadata of the batch, reading the remaining images one at a time")
+
+    for image_path in images:
+        if image_path in metadata_by_path:
+            continue
+        try:
+            metadata = read_image_metadata(image_path)
+        except Exception as e:
+            logger.exception(f"Failed to read the metadata of {image_path}")
+            failed[image_path] = e
+        else:
+            metadata_by_path[image_path] = metadata
+    return metadata_by_path
+
+
+def discard_prepared_images(prepared: list[PreparedImage]) -> None:
+    """
+    Removes the derivatives of images whose transaction failed, both those still staged and those already
+    moved to the name of an Image row which was rolled back.  The primary key of such a row may never be used
+    again, so nothing else would remove them
+    """
+    for item in prepared:
+        item.derivatives.thumbnail.unlink(missing_ok=True)
+        item.derivatives.full_size.unlink(missing_ok=True)
+        for path in item.placed:
+            path.unlink(missing_ok=True)
+        item.placed.clear()
+
+
+def handle_new_image(pkg: ImageIndexTaskModel, ingested: IngestedImage) -> None:
+    """
+    Handles a completely new image.  The metadata read and derivatives are done before the
+    transaction is opened, so it is only held for the database writes
+    """
+
+    if TYPE_CHECKING:
+        assert pkg.logger is not None
 
-    del img_copy, im_file
+    batch = ImageIndexBatchTaskModel([pkg.image_path], pkg.hash_threads, pkg.source, pkg.logger)
+    prepared, failed = prepare_new_images(batch, [ingested])
+    if failed:
+        raise failed[ingested.path]
+    try:
+        with transaction.atomic():
+            handle_new_images(batch, prepared)
+    except Exception:
+        discard_prepared_images(prepared)
+        raise
 
-    # Update the file hashes, now that the files exist
-    new_img.thumbnail_checksum = calculate_blake3_hash(new_img.thumbnail_path, hash_threads=pkg.hash_threads)
-    new_img.full_size_checksum = calculate_blake3_hash(new_img.full_size_path, hash_threads=pkg.hash_threads)
-    new_img.save()
 
-    # Parse Faces/pets/regions
-    parse_region_info(new_img, metadata)
+def handle_new_images(pkg: ImageIndexBatchTaskModel, prepared: list[PreparedImage]) -> list[ImageModel]:
+    """
+    Writes a batch of prepared new images to the database.  The Image rows are created in bulk, the staged
+    derivatives moved to their final names and then the related objects parsed from the metadata.
+
+    The caller is expected to provide the transaction.  The created Images are returned, in the same order
+    """
+    if TYPE_CHECKING:
+        assert pkg.logger is not None
+
+    # bulk_create does not send post_save, so these are not marked as dirty
+    created = ImageModel.objects.bulk_create(
+        [
+            ImageModel(
+                file_size=item.file_size,
+                original=str(item.image_path),
+                source=pkg.source,
+                orientation=item.metadata.Orientation or ImageModel.OrientationChoices.HORIZONTAL,
+                description=item.metadata.Description,
+                # The metadata uses -1 when it has no dimensions
+                height=item.metadata.ImageHeight if item.metadata.ImageHeight > 0 else item.derivatives.height,
+                width=item.metadata.ImageWidth if item.metadata.ImageWidth > 0 else item.derivatives.width,
+                original_checksum=item.original_checksum,
+                phash=item.derivatives.phash,
+                thumbnail_checksum=item.derivatives.thumbnail_checksum,
+                full_size_checksum=item.derivatives.full_size_checksum,
+                # This time cannot be dirty
+                is_dirty=False,
+            )
+            for item in prepared
+        ],
+    )
+
+    for new_img, item in zip(created, prepared, strict=True):
+        pkg.logger.info(f"Indexing {new_img.original_path.stem}")
+        item.derivatives.thumbnail.replace(new_img.thumbnail_path)
+        item.placed.append(new_img.thumbnail_path)
+        item.derivatives.full_size.replace(new_img.full_size_path)
+        item.placed.append(new_img.full_size_path)
 
-    # Parse Keywords
-    parse_keywords(new_img, metadata)
+    if pkg.tag_resolver is None:
+        pkg.tag_resolver = TagTreeResolver()
+    if pkg.entity_cache is None:
+        pkg.entity_cache = EntityCache()
 
-    # Parse Location
-    parse_location(new_img, metadata)
-    if not new_img.location:
-        parse_location_from_keywords(new_img, metadata)
+    # Related objects are parsed for the whole batch at once
+    images = [(new_img, item.metadata) for new_img, item in zip(created, prepared, strict=True)]
+    parse_region_info(images, pkg.logger, pkg.entity_cache)
+    parse_keywords(images, pkg.logger, pkg.tag_resolver)
+    parse_locations_and_dates(images, pkg.logger, pkg.entity_cache)
 
-    # Parse date information from keywords?
-    parse_dates_from_keywords(new_img, metadata)
+    ImageModel.objects.bulk_update(created, fields=["location", "date"])
+    pkg.logger.info(f"Indexed {len(created)} new images")
 
-    # And done.  Image cannot be dirty, use update to avoid getting marked as such
-    new_img.mark_as_clean()
-    pkg.logger.info("  indexing completed")
+    return created
@@ -0,0 +1,29 @@
+import dataclasses
+from pathlib import Path
+
+from blake3 import blake3
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class IngestedImage:
+    """
+    An original image file which has been hashed.  Only what was learned from it is kept, never its contents,
+    so a batch of large originals does not sit in memory
+    """
+
+    path: Path
+    checksum: str
+    size: int
+
+
+def ingest_image(image_path: Path, *, hash_threads: int = 4) -> IngestedImage:
+    """
+    Calculates the BLAKE3 hash and size of the file.  The file is memory mapped and hashed in place, so its
+    pages are read by the operating system as they are hashed and can be dropped again straight away, however
+    large it is
+    """
+    image_path = image_path.resolve()
+    size = image_path.stat().st_size
+    hasher = blake3(max_threads=hash_threads)
+    hasher.update_mmap(image_path)
+    return IngestedImage(path=image_path, checksum=hasher.hexdigest(), size=size)
@@ -0,0 +1,59 @@
+import logging
+from collections.abc import Iterator
+from pathlib import Path
+
+from django.utils import timezone
+
+from scansteward.models import IndexJob
+from scansteward.models import IndexJobItem
+
+logger = logging.getLogger(__name__)
+
+_UNFINISHED = (IndexJobItem.StateChoices.PENDING, IndexJobItem.StateChoices.FAILED)
+
+
+def record_job_items(job: IndexJob, paths: list[Path]) -> list[IndexJobItem]:
+    """
+    Records the given paths as discovered by the job, with a single bulk insert.  Paths the job already knows
+    are left alone.  Returns the items for the given paths which still need indexing
+    """
+    IndexJobItem.objects.bulk_create(
+        [IndexJobItem(job=job, path=str(path)) for path in paths],
+        ignore_conflicts=True,
+    )
+    return list(IndexJobItem.objects.filter(job=job, path__in=[str(path) for path in paths], state__in=_UNFINISHED))
+
+
+def iter_unfinished_items(job: IndexJob, batch_size: int) -> Iterator[list[IndexJobItem]]:
+    """
+    Yields the pending and failed items of the job in batches, in the order they were discovered.
+
+    Each batch is fetched after the previous one was handled, continuing from the last primary key seen,
+    so items finishing in the meantime never shift the batches
+    """
+    last_pk = 0
+    while True:
+        batch = list(IndexJobItem.objects.filter(job=job, state__in=_UNFINISHED, pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def mark_items_done(item_ids: list[int]) -> None:
+    IndexJobItem.objects.filter(pk__in=item_ids).update(state=IndexJobItem.StateChoices.DONE, error=None)
+
+
+def mark_items_failed(item_ids: list[int], error: str) -> None:
+    IndexJobItem.objects.filter(pk__in=item_ids).update(state=IndexJobItem.StateChoices.FAILED, error=error)
+
+
+def finish_job(job: IndexJob) -> int:
+    """
+    Marks the job as finished if all its items are done.  Returns the number of items which are not
+    """
+    unfinished = job.items.filter(state__in=_UNFINISHED).count()  # type: ignore[attr-defined]
+    if not unfinished:
+        job.finished_at = timezone.now()
+        job.save(update_fields=["finished_at", "modified"])
+    return unfinished
@@ -0,0 +1,114 @@
+from collections import deque
+from collections.abc import Iterable
+from collections.abc import Iterator
+
+from scansteward.imageops.models import KeywordStruct
+
+
+class KeywordNode:
+    """
+    A node of a keyword trie, with its children keyed by keyword.
+
+    The keyword trees of an image are merged, deduplicated and flattened in this form, and only turned into
+    KeywordStructs at the edges, as building the pydantic models is far slower than these plain nodes.
+    Children keep the order they were first seen in
+    """
+
+    __slots__ = ("applied", "children", "keyword")
+
+    def __init__(self, keyword: str, applied: bool | None = None) -> None:
+        self.keyword = keyword
+        self.applied = applied
+        self.children: dict[str, KeywordNode] = {}
+
+    def merge_applied(self, applied: bool | None) -> None:
+        """
+        A keyword applied by any of its copies is applied.  Otherwise an explicit False wins over unknown
+        """
+        if applied is None or self.applied:
+            return
+        self.applied = applied
+
+    def child(self, keyword: str, applied: bool | None = None) -> "KeywordNode":
+        """
+        Returns the child with the given keyword, creating it if needed
+        """
+        node = self.children.get(keyword)
+        if node is None:
+            node = self.children[keyword] = KeywordNode(keyword, applied)
+        else:
+            node.merge_applied(applied)
+        return node
+
+    def add_struct(self, struct: KeywordStruct) -> None:
+        """
+        Merges the given keyword tree in as a child of this node
+        """
+        # Breadth first, so siblings are added in their original order
+        pending: deque[tuple[KeywordNode, KeywordStruct]] = deque([(self, struct)])
+        while pending:
+            parent, current = pending.popleft()
+            node = parent.child(current.Keyword, current.Applied)
+            pending.extend((node, child) for child in current.Children)
+
+    def add_structs(self, structs: Iterable[KeywordStruct]) -> None:
+        for struct in structs:
+            self.add_struct(struct)
+
+    def add_path(self, keywords: Iterable[str]) -> None:
+        """
+        Merges a single path of keywords in below this node, walking the nodes which already exist and only
+        creating the missing ones.
+
+        Example:
+            Root|Child|ChildChild
+            Root|OtherChild
+
+            becomes
+
+            Root -->
+              Child -->
+                ChildChild
+              OtherChild
+        """
+        node = self
+        # The flat fields cannot say if a keyword is applied, so it is left unknown, where a leaf counts as
+        # applied.  Setting it would also override an explicit False from KeywordInfo for the same keyword
+        for keyword in keywords:
+            node = node.child(keyword)
+
+    def iter_paths(self) -> Iterator[list[str]]:
+        """
+        Yields the keywords along the path to every leaf below this node, in order
+        """
+        stack: list[tuple[KeywordNode, list[str]]] = [
+            (child, [child.keyword]) for child in reversed(self.children.values())
+        ]
+        while stack:
+            node, path = stack.pop()
+            if not node.children:
+                yield path
+                continue
+            stack.extend((child, [*path, child.keyword]) for child in reversed(node.children.values()))
+
+    def to_struct(self) -> KeywordStruct:
+        return KeywordStruct(
+            Keyword=self.keyword,
+            Applied=self.applied,
+            Children=[child.to_struct() for child in self.children.values()],
+        )
+
+    def to_structs(self) -> list[KeywordStruct]:
+        """
+        The children of this node as KeywordStructs, for a root which only groups the trees
+        """
+        return [child.to_struct() for child in self.children.values()]
+
+
+def keyword_trie(structs: Iterable[KeywordStruct] = ()) -> KeywordNode:
+    """
+    Creates a trie rooted at a node which only holds the given keyword trees
+    """
+    root = KeywordNode("")
+    root.add_structs(structs)
+    return root
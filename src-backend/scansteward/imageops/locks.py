@@ -0,0 +1,100 @@
+import logging
+import sys
+import time
+import zlib
+from collections import defaultdict
+from collections.abc import Iterable
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO
+from typing import Final
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LOCK_STRIPES: Final[int] = 256
+
+# How long to wait between attempts at a held lock, where the platform cannot block on one
+_RETRY_INTERVAL: Final[float] = 0.05
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _try_lock(handle: BinaryIO, *, blocking: bool) -> bool:
+        # Windows locks a byte range, the first byte of the file stands for all of it
+        while True:
+            handle.seek(0)
+            try:
+                msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(_RETRY_INTERVAL)
+            else:
+                return True
+
+    def _unlock(handle: BinaryIO) -> None:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _try_lock(handle: BinaryIO, *, blocking: bool) -> bool:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _unlock(handle: BinaryIO) -> None:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def lock_stripe(path: Path) -> int:
+    """
+    The lock file guarding the given path.  Paths share a fixed number of lock files, so they never pile up
+    """
+    return zlib.crc32(str(path.resolve()).encode()) % LOCK_STRIPES
+
+
+@contextmanager
+def locked_files(paths: Iterable[Path], *, blocking: bool = True, namespace: str | None = None) -> Iterator[set[Path]]:
+    """
+    Locks the given original files, so no other thread or process can write them (or read them to index them)
+    at the same time.  Yields the resolved paths which were locked.
+
+    The locks are locks on lock files in the data directory (flock, or msvcrt on Windows), taken in a fixed
+    order, so two holders can never deadlock.  The operating system releases them if the process dies.  Without
+    blocking, any path whose lock is held elsewhere is left out, rather than waited for.
+
+    Files which are not originals use their own namespace, with its own lock files, so they never contend with
+    the originals sharing their stripes
+    """
+    by_stripe: defaultdict[int, list[Path]] = defaultdict(list)
+    for path in paths:
+        by_stripe[lock_stripe(path)].append(path.resolve())
+
+    lock_dir = Path(settings.DATA_DIR) / "locks"
+    if namespace is not None:
+        lock_dir = lock_dir / namespace
+    lock_dir.mkdir(parents=True, exist_ok=True)
+
+    handles: list[BinaryIO] = []
+    locked: set[Path] = set()
+    try:
+        for stripe in sorted(by_stripe):
+            handle = (lock_dir / f"{stripe:03}.lock").open("a+b")
+            if not _try_lock(handle, blocking=blocking):
+                handle.close()
+                logger.info(f"Skipping {len(by_stripe[stripe])} files which are locked elsewhere")
+                continue
+            handles.append(handle)
+            locked.update(by_stripe[stripe])
+        yield locked
+    finally:
+        for handle in handles:
+            _unlock(handle)
+            handle.close()
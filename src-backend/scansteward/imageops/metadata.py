@@ -1,24 +1,32 @@
 import logging
-import subprocess
 import tempfile
-from collections import defaultdict
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import UTC
 from datetime import datetime
 from pathlib import Path
 from typing import TYPE_CHECKING
+from typing import Final
 
 import orjson as json
 
-from scansteward.imageops.constants import EXIF_TOOL_EXE
+from scansteward.imageops.errors import ExifToolProcessError
 from scansteward.imageops.errors import ImagePathNotFileError
 from scansteward.imageops.errors import NoImageMetadataError
 from scansteward.imageops.errors import NoImagePathsError
+from scansteward.imageops.exiftool import ExifToolResult
+from scansteward.imageops.exiftool import get_exiftool_pool
+from scansteward.imageops.keywords import keyword_trie
+from scansteward.imageops.locks import locked_files
 from scansteward.imageops.models import ImageMetadata
 from scansteward.imageops.models import KeywordInfoModel
-from scansteward.imageops.models import KeywordStruct
 
 logger = logging.getLogger(__name__)
 
+# The number of files read by each exiftool command when streaming metadata
+READ_CHUNK_SIZE: Final[int] = 32
+
 
 def now_string() -> str:
     """
@@ -27,87 +35,18 @@ def now_string() -> str:
     return datetime.now(tz=UTC).strftime("%Y:%m:%d %H:%M:%S.%fZ")
 
 
-def process_separated_list(parent: KeywordStruct, remaining: list[str]):
-    """
-    Given a list of strings, build a tree structure from them, rooted at the given parent
-
-    Example:
-        Root|Child|ChildChild
-        Root|OtherChild
-
-        becomes
-
-        Root -->
-          Child -->
-            ChildChild
-          OtherChild
-    """
-    if not remaining:
-        # TODO(trenton): Should this set Applied?  Leaf nodes are assumed to be applied
-        return
-    new_parent = KeywordStruct(Keyword=remaining[0])
-
-    parent.Children.append(new_parent)
-    process_separated_list(new_parent, remaining[1:])
-
-
-def remove_duplicate_children(root: KeywordStruct):
-    """
-    Removes duplicated children, which may exist as multiple fields above contain the same data
-    """
-    if not root.Children:
-        return
-    for child in root.Children:
-        remove_duplicate_children(child)
-    root.Children = list(set(root.Children))
-
-
-def combine_same_keywords(root: KeywordStruct) -> KeywordStruct:
-    if not root.Children:
-        return root
-
-    # Group children by their "Keyword"
-    groups: dict[str, list[KeywordStruct]] = defaultdict(list)
-    for child in root.Children:
-        groups[child.Keyword].append(child)
-
-    merged_children: list[KeywordStruct] = []
-    for keyword in groups:
-        nodes = groups[keyword]
-        if len(nodes) == 1:
-            merged_children.append(combine_same_keywords(nodes[0]))
-        else:
-            # Merge children of nodes with the same keyword
-            merged_node = KeywordStruct(Keyword=keyword)
-            all_children = []
-            for node in nodes:
-                if node.Children:
-                    all_children.extend(node.Children)
-
-            if all_children:
-                merged_node.Children = all_children
-                # Recursively merge the children of the merged node
-                merged_children.append(combine_same_keywords(merged_node))
-            else:
-                merged_children.append(merged_node)
-
-    root.Children = merged_children
-    return root
-
-
 def combine_keyword_structures(metadata: ImageMetadata) -> ImageMetadata:
     """
     Reads the various other possible keyword values, and generates a tree from them,
     then combines with anything existing and removes duplicates
     """
-    keywords: list[KeywordStruct] = []
+    trie = keyword_trie()
 
     if metadata.KeywordInfo and metadata.KeywordInfo.Hierarchy:
-        keywords.extend(metadata.KeywordInfo.Hierarchy)
+        trie.add_structs(metadata.KeywordInfo.Hierarchy)
 
     # Check for other keywords which might get set as a flat structure
-    # Parse them into KeywordStruct trees
-    roots: dict[str, KeywordStruct] = {}
+    # Merge each path in as it is parsed, as the flat lists usually repeat the same paths
     for key, separation in [
         (metadata.HierarchicalSubject, "|"),
         (metadata.CatalogSets, "|"),
@@ -119,22 +58,12 @@ def combine_keyword_structures(metadata: ImageMetadata) -> ImageMetadata:
         for line in key:
             if TYPE_CHECKING:
                 assert isinstance(line, str)
-            values_list = line.split(separation)
-            root_value = values_list[0]
-            if root_value not in roots:
-                roots[root_value] = KeywordStruct(Keyword=values_list[0])
-            root = roots[root_value]
-            process_separated_list(root, values_list[1:])
-
-    keywords.extend(list(roots.values()))
-
-    for keyword in keywords:
-        remove_duplicate_children(keyword)
-        combine_same_keywords(keyword)
+            trie.add_path(line.split(separation))
 
     # Assign the parsed flat keywords in as well
-    if not keywords:
+    if not trie.children:
         return metadata
+    keywords = trie.to_structs()
     if not metadata.KeywordInfo:
         metadata.KeywordInfo = KeywordInfoModel(Hierarchy=keywords)
     else:
@@ -152,26 +81,11 @@ def expand_keyword_structures(metadata: ImageMetadata) -> ImageMetadata:
     if not metadata.KeywordInfo:
         return metadata
 
-    for keyword in metadata.KeywordInfo.Hierarchy:
-        remove_duplicate_children(keyword)
-
-    def flatten_children(internal_root: KeywordStruct, current_words: list[str]):
-        if not internal_root.Children:
-            current_words.append(internal_root.Keyword)
-        this_child_words = [internal_root.Keyword]
-        for internal_child in internal_root.Children:
-            flatten_children(internal_child, this_child_words)
-            current_words.extend(this_child_words)
-            this_child_words = [internal_root.Keyword]
+    trie = keyword_trie(metadata.KeywordInfo.Hierarchy)
+    metadata.KeywordInfo.Hierarchy = trie.to_structs()
 
-    list_of_lists: list[list[str]] = []
-
-    for root in metadata.KeywordInfo.Hierarchy:
-        current_child_words = [root.Keyword]
-        for child in root.Children:
-            flatten_children(child, current_child_words)
-            list_of_lists.append(current_child_words)
-            current_child_words = [root.Keyword]
+    # Every path from a root to a leaf
+    list_of_lists = list(trie.iter_paths())
 
     # Directly overwrite everything
     metadata.HierarchicalSubject = ["|".join(x) for x in list_of_lists]
@@ -196,9 +110,20 @@ def bulk_read_image_metadata(
     images: list[Path],
 ) -> list[ImageMetadata]:
     """
-    Reads the requested metadata for the given list of files.  This does a single subprocess call for
+    Reads the requested metadata for the given list of files.  This uses a single exiftool process for
     all images at once, resulting in a more efficient method than looping through
     """
+    return list(iter_image_metadata(images))
+
+
+def iter_image_metadata(images: list[Path], *, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[ImageMetadata]:
+    """
+    Reads the requested metadata for the given list of files, yielding each as soon as it is read, in order.
+
+    The files are read by one exiftool process, chunk_size files per command.  The next command is always
+    queued before the output of the current one is parsed, so exiftool keeps reading while the caller works
+    through the results, and only a chunk of output is ever held in memory
+    """
 
     if not images:
         msg = "No image paths were provided"
@@ -206,7 +131,6 @@ def bulk_read_image_metadata(
         raise NoImagePathsError(msg)
 
     cmd = [
-        EXIF_TOOL_EXE,
         "-use",
         "MWG",
         "-struct",
@@ -233,7 +157,8 @@ def bulk_read_image_metadata(
         "-MWG:Location",
     ]
 
-    # Add the actual images
+    # Check all the images before reading any of them
+    image_args: list[str] = []
     for image_path in images:
         if not image_path.exists():
             msg = f"{image_path} does not exist"
@@ -243,23 +168,48 @@ def bulk_read_image_metadata(
             msg = f"{image_path} is not a file"
             logger.error(msg)
             raise ImagePathNotFileError(msg)
-        cmd.append(str(image_path.resolve()))
-
-    # And run the command
-    logger.debug(f"Running command '{' '.join(cmd)}'")
-    proc = subprocess.run(cmd, check=False, capture_output=True)
-    if proc.returncode != 0:
-        for line in proc.stderr.decode("utf-8").splitlines():
-            logger.error(f"exiftool: {line}")
-        for line in proc.stdout.decode("utf-8").splitlines():
-            logger.info(f"exiftool : {line}")
+        image_args.append(str(image_path.resolve()))
+
+    chunks = [image_args[i : i + chunk_size] for i in range(0, len(image_args), chunk_size)]
+
+    pool = get_exiftool_pool()
+    # Allows for the largest chunk, the first
+    timeout = pool.timeout_for(len(chunks[0]) if chunks else 1)
+    with pool.acquire() as process:
+        pending: deque[int] = deque()
+        try:
+            for chunk in chunks:
+                logger.debug(f"Running command '{' '.join([*cmd, *chunk])}'")
+                pending.append(process.submit([*cmd, *chunk]))
+                # Keep one command queued ahead of the one being parsed
+                if len(pending) > 1:
+                    yield from _parse_read_result(process.collect(pending.popleft(), timeout=timeout))
+            while pending:
+                yield from _parse_read_result(process.collect(pending.popleft(), timeout=timeout))
+        except ExifToolProcessError:
+            # The process crashed or hung, and any output it still sends would be mistaken for the output of the
+            # next user of the process
+            logger.warning(f"exiftool process {process.pid} failed, restarting it")
+            pending.clear()
+            process.restart()
+            raise
+        finally:
+            # If the caller stopped early or something failed, the output of the queued commands still has to be
+            # drained, so it is not mistaken for the output of the next user of the process
+            try:
+                while pending:
+                    process.collect(pending.popleft(), timeout=timeout)
+            except ExifToolProcessError:  # pragma: no cover
+                process.restart()
+
+
+def _parse_read_result(result: ExifToolResult) -> Iterator[ImageMetadata]:
+    result.log_output()
 
     # Do this after logging anything
-    proc.check_returncode()
-    return [
-        combine_keyword_structures(y)
-        for y in [ImageMetadata.model_validate(x) for x in json.loads(proc.stdout.decode("utf-8"))]
-    ]
+    result.check_status()
+    for item in json.loads(result.stdout):
+        yield combine_keyword_structures(ImageMetadata.model_validate(item))
 
 
 def write_image_metadata(metadata: ImageMetadata, *, clear_existing_metadata: bool = False) -> None:
@@ -278,7 +228,7 @@ def bulk_write_image_metadata(
     """
     Updates the given SourceFiles with the given metadata.  If a field has not been set,
     there will be no change to it.
-    This does a single subprocess call, resulting is faster execution than looping
+    This does a single exiftool call, resulting is faster execution than looping
     """
     if not metadata:
         msg = "No image paths were provided"
@@ -294,7 +244,6 @@ def bulk_write_image_metadata(
 
         json_path.write_bytes(json.dumps(data))
         cmd = [
-            EXIF_TOOL_EXE,
             "-use",
             "MWG",
             "-struct",
@@ -309,14 +258,62 @@ def bulk_write_image_metadata(
         for x in metadata:
             cmd.append(str(x.SourceFile.resolve()))  # noqa: PERF401
         logger.debug(f"Running command '{' '.join(cmd)}'")
-        proc = subprocess.run(cmd, check=False, capture_output=True)
+        result = get_exiftool_pool().execute(cmd, files=len(metadata))
+
+    result.log_output()
+    result.check_status()
 
-    for line in proc.stderr.decode("utf-8").splitlines():
-        logger.debug(f"exiftool stderr: {line}")
-    for line in proc.stdout.decode("utf-8").splitlines():
-        logger.debug(f"exiftool stdout: {line}")
 
-        proc.check_returncode()
+def concurrent_write_image_metadata(metadata: list[ImageMetadata], *, writers: int) -> list[ImageMetadata]:
+    """
+    Updates the given SourceFiles with the given metadata, split across up to the given number of exiftool
+    processes writing at once.
+
+    Files locked by another writer or the indexer are skipped, as is any file which fails to write.  The
+    metadata which was written is returned, anything else is left to be tried again later
+    """
+    with locked_files([x.SourceFile for x in metadata], blocking=False) as locked:
+        writable = [x for x in metadata if x.SourceFile.resolve() in locked]
+        if not writable:
+            return []
+
+        shard_count = min(writers, len(writable))
+        if shard_count == 1:
+            return _write_shard(writable)
+
+        shards = [writable[i::shard_count] for i in range(shard_count)]
+        written: list[ImageMetadata] = []
+        with ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix="exiftool-writer") as executor:
+            for shard_written in executor.map(_write_shard, shards):
+                written.extend(shard_written)
+        return written
+
+
+def _write_shard(shard: list[ImageMetadata]) -> list[ImageMetadata]:
+    """
+    Writes the shard with a single exiftool call, returning the metadata which was written.
+
+    exiftool carries on past a file it cannot write, so when the call fails, the rest of the shard may have
+    been written anyway.  The files are then written again one at a time, so only the failing ones are left out
+    """
+    try:
+        bulk_write_image_metadata(shard)
+    except Exception:
+        logger.exception(f"Failed to write metadata to {len(shard)} files")
+        if len(shard) == 1:
+            return []
+    else:
+        return shard
+
+    written: list[ImageMetadata] = []
+    for item in shard:
+        try:
+            bulk_write_image_metadata([item])
+        except Exception:
+            logger.exception(f"Failed to write metadata to {item.SourceFile}")
+        else:
+            written.append(item)
+    return written
 
 
 def clear_existing_metadata(image: Path) -> None:
@@ -326,7 +323,6 @@ def clear_existing_metadata(image: Path) -> None:
 def bulk_clear_existing_metadata(images: list[Path]) -> None:
     logger.debug("Clearing existing metadata")
     cmd = [
-        EXIF_TOOL_EXE,
         "-overwrite_original",
         "-use",
         "MWG",
@@ -357,12 +353,8 @@ def bulk_clear_existing_metadata(images: list[Path]) -> None:
         cmd.append(str(image.resolve()))  # noqa: PERF401
 
     logger.debug(f"Running command '{' '.join(cmd)}'")
-    proc = subprocess.run(cmd, check=False, capture_output=True)
-
-    for line in proc.stderr.decode("utf-8").splitlines():
-        logger.debug(f"exiftool stderr: {line}")
-    for line in proc.stdout.decode("utf-8").splitlines():
-        logger.debug(f"exiftool stdout: {line}")
+    result = get_exiftool_pool().execute(cmd, files=len(images))
+    result.log_output()
 
     # Do this after logging anything
-    proc.check_returncode()
+    result.check_status()
@@ -0,0 +1,152 @@
+import contextlib
+import dataclasses
+import enum
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Final
+
+from django.conf import settings
+from PIL import Image
+
+from scansteward.imageops.locks import locked_files
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RENDITION_QUALITY: Final[int] = 80
+MAX_RENDITION_SIZE: Final[int] = 8192
+# Renditions used more recently than this, in seconds, may still be being sent and are never evicted
+RECENT_USE_SECONDS: Final[float] = 60.0
+# A partial rendition older than this, in seconds, was left by a worker which died while writing it
+STALE_PARTIAL_SECONDS: Final[float] = 10 * 60.0
+
+
+@enum.unique
+class RenditionFormat(enum.Enum):
+    WEBP = "webp"
+    JPEG = "jpeg"
+    PNG = "png"
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.value}"
+
+    @property
+    def lossless(self) -> bool:
+        """
+        Does the quality have no effect on this format?
+        """
+        return self is RenditionFormat.PNG
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class RenditionSpec:
+    """
+    What a rendition of an image looks like.  The image is scaled down to fit within the width and height,
+    keeping its aspect ratio, and never scaled up.  Either may be left out, to only limit the other
+    """
+
+    width: int | None
+    height: int | None
+    format: RenditionFormat = RenditionFormat.WEBP
+    quality: int = DEFAULT_RENDITION_QUALITY
+
+    def cache_name(self, source_checksum: str) -> str:
+        """
+        The name of this rendition of the source with the given checksum.  As the name holds everything the
+        rendition is made from, a cached file never needs to be invalidated, only evicted.  A lossless format
+        leaves the quality out, so any quality shares the one rendition
+        """
+        quality = 0 if self.format.lossless else self.quality
+        return f"{source_checksum}-{self.width or 0}x{self.height or 0}-q{quality}.{self.format.value}"
+
+    def cache_path(self, source_checksum: str) -> Path:
+        if TYPE_CHECKING:
+            assert isinstance(settings.RENDITION_DIR, Path)
+        # Spread over subdirectories, so no directory holds too many files
+        return (settings.RENDITION_DIR / source_checksum[:2] / self.cache_name(source_checksum)).resolve()
+
+
+def generate_rendition(source: Path, spec: RenditionSpec, target: Path) -> None:
+    """
+    Creates the rendition of the source image, written to a temporary file first, so the target only ever
+    exists complete
+    """
+    with Image.open(source) as im_file:
+        im_file.thumbnail((spec.width or MAX_RENDITION_SIZE, spec.height or MAX_RENDITION_SIZE))
+        rendition = im_file
+        if spec.format == RenditionFormat.JPEG and rendition.mode not in ("RGB", "L"):
+            rendition = rendition.convert("RGB")
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        handle, temp_name = tempfile.mkstemp(dir=target.parent, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                rendition.save(temp_file, format=spec.format.value, quality=spec.quality)
+            Path(temp_name).replace(target)
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+
+
+def get_rendition(source: Path, source_checksum: str, spec: RenditionSpec) -> Path:
+    """
+    Returns the path of the rendition of the source, generating it if it is not cached.
+
+    Requests for the same rendition are coalesced, by the file lock of its path, so whichever comes first
+    generates it and the others wait, then find it cached.  This holds across threads and processes.  Using a
+    cached rendition marks it as recently used, for evicting the least recently used ones on a schedule
+    """
+    target = spec.cache_path(source_checksum)
+    with locked_files([target], namespace="renditions"):
+        try:
+            # The modified time is the last use, as access times are often not kept
+            os.utime(target)
+        except FileNotFoundError:
+            logger.info(f"Generating rendition {target.name}")
+            generate_rendition(source, spec, target)
+    return target
+
+
+def evict_renditions(budget: int) -> int:
+    """
+    Deletes the least recently used renditions, until all of them together fit within the budget in bytes.
+    Walks the whole cache, so is run on a schedule rather than by requests.  Renditions used within the last
+    RECENT_USE_SECONDS are never deleted.  Partial renditions left behind for over STALE_PARTIAL_SECONDS are
+    deleted as well.  Returns the number of bytes freed
+    """
+    if TYPE_CHECKING:
+        assert isinstance(settings.RENDITION_DIR, Path)
+
+    now = time.time()
+    entries: list[tuple[float, int, Path]] = []
+    total = 0
+    freed = 0
+    for path in settings.RENDITION_DIR.resolve().glob("*/*"):
+        with contextlib.suppress(FileNotFoundError):
+            stat = path.stat()
+            if path.suffix == ".tmp":
+                # A rendition still being written is not in use yet, one not written to for long never will be
+                if stat.st_mtime < now - STALE_PARTIAL_SECONDS:
+                    path.unlink(missing_ok=True)
+                    freed += stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    evicted = 0
+    recent = now - RECENT_USE_SECONDS
+    # Oldest first
+    for used, size, path in sorted(entries):
+        if total - evicted <= budget or used > recent:
+            break
+        path.unlink(missing_ok=True)
+        evicted += size
+
+    freed += evicted
+    if freed:
+        logger.info(f"Evicted {freed} bytes of renditions")
+    return freed
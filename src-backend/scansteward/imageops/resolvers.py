@@ -0,0 +1,195 @@
+import logging
+from collections.abc import Iterable
+from typing import Generic
+from typing import TypeVar
+
+from django.db.models import Model
+from django.db.models import Q
+
+from scansteward.imageops.models import KeywordStruct
+from scansteward.models import Image as ImageModel
+from scansteward.models import Person
+from scansteward.models import Pet
+from scansteward.models import RoughDate
+from scansteward.models import RoughLocation
+from scansteward.models import Tag
+from scansteward.models import TagOnImage
+
+logger = logging.getLogger(__name__)
+
+_M = TypeVar("_M", bound=Model)
+
+TagKey = tuple[int | None, str]
+
+
+class TagTreeResolver:
+    """
+    An in memory copy of the Tag tree, keyed by (parent id, name), used to turn keyword trees into
+    Tags without a query per node.
+
+    All Tags are loaded with a single query the first time they are needed.  Missing Tags are created in
+    bulk, one tree level at a time, and fetched into the cache.  If the transaction the Tags were created in
+    is rolled back, clear() must be called so the cache does not refer to Tags which no longer exist.
+    """
+
+    FETCH_CHUNK_SIZE = 200
+
+    def __init__(self) -> None:
+        self._tags: dict[TagKey, Tag] | None = None
+
+    def _load(self) -> dict[TagKey, Tag]:
+        if self._tags is None:
+            self._tags = {(tag.parent_id, tag.name): tag for tag in Tag.objects.all()}  # type: ignore[attr-defined]
+            logger.debug(f"Loaded {len(self._tags)} tags")
+        return self._tags
+
+    def clear(self) -> None:
+        self._tags = None
+
+    def get(self, parent: Tag | None, name: str) -> Tag:
+        return self._load()[(parent.pk if parent is not None else None, name)]
+
+    def ensure(self, keys: Iterable[TagKey]) -> None:
+        """
+        Creates any of the given Tags which do not exist yet, with a single bulk insert.  Tags created by a
+        concurrent writer in the meantime are ignored by the insert, and all of them fetched again, so this
+        behaves as a bulk get_or_create
+        """
+        tags = self._load()
+        missing = {key for key in keys if key not in tags}
+        if not missing:
+            return
+        Tag.objects.bulk_create(
+            [Tag(parent_id=parent_id, name=name) for parent_id, name in missing],
+            ignore_conflicts=True,
+        )
+        self._fetch(missing)
+        logger.debug(f"Created {len(missing)} tags")
+
+    def _fetch(self, keys: set[TagKey]) -> None:
+        # Chunked, to stay well under the query parameter limits of the database
+        tags = self._load()
+        ordered = list(keys)
+        for start in range(0, len(ordered), self.FETCH_CHUNK_SIZE):
+            query = Q()
+            for parent_id, name in ordered[start : start + self.FETCH_CHUNK_SIZE]:
+                query |= Q(parent__isnull=True, name=name) if parent_id is None else Q(parent_id=parent_id, name=name)
+            for tag in Tag.objects.filter(query):
+                tags[(tag.parent_id, tag.name)] = tag  # type: ignore[attr-defined]
+
+
+def is_keyword_applied(node: KeywordStruct) -> bool:
+    """
+    A keyword is applied if it says it is.  If it doesn't say, but it is a leaf, it is also applied
+    """
+    if node.Applied is not None and node.Applied:
+        return True
+    return not len(node.Children)
+
+
+def apply_keyword_trees(resolver: TagTreeResolver, trees: list[tuple[ImageModel, list[KeywordStruct]]]) -> None:
+    """
+    Creates the Tags for the given keyword trees and attaches them to their images.
+
+    The trees are walked together, a level at a time, so the missing Tags of each level are created with one
+    bulk insert.  All the TagOnImage rows are then written with a single bulk insert
+    """
+    frontier: list[tuple[ImageModel, Tag | None, KeywordStruct]] = [
+        (image, None, root) for image, roots in trees for root in roots
+    ]
+    tags_on_images: list[TagOnImage] = []
+
+    while frontier:
+        resolver.ensure((parent.pk if parent is not None else None, node.Keyword) for _, parent, node in frontier)
+
+        next_frontier: list[tuple[ImageModel, Tag | None, KeywordStruct]] = []
+        for image, parent, node in frontier:
+            tag = resolver.get(parent, node.Keyword)
+            tags_on_images.append(TagOnImage(tag=tag, image=image, applied=is_keyword_applied(node)))
+            next_frontier.extend((image, tag, child) for child in node.Children)
+        frontier = next_frontier
+
+    TagOnImage.objects.bulk_create(tags_on_images)
+
+
+class KeyedModelCache(Generic[_M]):
+    """
+    An in memory cache of model instances, keyed by a tuple of the values of the given fields.
+
+    resolve() fetches all the requested keys which are not cached yet with a single query, then creates any
+    which still do not exist with a single bulk insert.  Conflicting inserts (from a concurrent writer) are
+    ignored and fetched again, so this behaves as a bulk get_or_create
+    """
+
+    FETCH_CHUNK_SIZE = 200
+
+    def __init__(self, model: type[_M], fields: tuple[str, ...]) -> None:
+        self.model = model
+        self.fields = fields
+        self._cache: dict[tuple, _M] = {}
+
+    def _key_of(self, instance: _M) -> tuple:
+        return tuple(getattr(instance, field) for field in self.fields)
+
+    def _lookup(self, keys: Iterable[tuple]) -> Q:
+        query = Q()
+        for key in keys:
+            key_query = Q()
+            for field, value in zip(self.fields, key, strict=True):
+                key_query &= Q(**{f"{field}__isnull": True}) if value is None else Q(**{field: value})
+            query |= key_query
+        return query
+
+    def _fetch(self, keys: set[tuple]) -> None:
+        # Chunked, to stay well under the query parameter limits of the database
+        ordered = list(keys)
+        for start in range(0, len(ordered), self.FETCH_CHUNK_SIZE):
+            chunk = ordered[start : start + self.FETCH_CHUNK_SIZE]
+            for instance in self.model.objects.filter(self._lookup(chunk)):  # type: ignore[attr-defined]
+                self._cache[self._key_of(instance)] = instance
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def resolve(self, keys: Iterable[tuple]) -> None:
+        missing = {key for key in keys if key not in self._cache}
+        if not missing:
+            return
+        self._fetch(missing)
+        missing = {key for key in missing if key not in self._cache}
+        if not missing:
+            return
+        self.model.objects.bulk_create(  # type: ignore[attr-defined]
+            [self.model(**dict(zip(self.fields, key, strict=True))) for key in missing],
+            ignore_conflicts=True,
+        )
+        self._fetch(missing)
+        logger.debug(f"Created {len(missing)} {self.model.__name__}")
+
+    def get(self, key: tuple) -> _M | None:
+        """
+        Returns the cached instance, or None if it could not be created (for instance, a RoughDate with the
+        same date but different validity already exists)
+        """
+        return self._cache.get(key)
+
+
+class EntityCache:
+    """
+    Caches the People, Pets, RoughLocations and RoughDates used while indexing, so each distinct one is
+    only fetched or created once.  Like the TagTreeResolver, clear() must be called if the transaction the
+    entities were created in is rolled back
+    """
+
+    def __init__(self) -> None:
+        self.people: KeyedModelCache[Person] = KeyedModelCache(Person, ("name",))
+        self.pets: KeyedModelCache[Pet] = KeyedModelCache(Pet, ("name",))
+        self.locations: KeyedModelCache[RoughLocation] = KeyedModelCache(
+            RoughLocation,
+            ("country_code", "subdivision_code", "city", "sub_location"),
+        )
+        self.dates: KeyedModelCache[RoughDate] = KeyedModelCache(RoughDate, ("date", "month_valid", "day_valid"))
+
+    def clear(self) -> None:
+        for cache in (self.people, self.pets, self.locations, self.dates):
+            cache.clear()
@@ -0,0 +1,255 @@
+import logging
+import threading
+from collections.abc import Iterable
+from collections.abc import Iterator
+from functools import lru_cache
+from itertools import combinations
+from typing import Final
+
+import numpy as np
+from django.db import DatabaseError
+
+from scansteward.models import Image
+
+logger = logging.getLogger(__name__)
+
+# A phash is 64 bits, split into 4 chunks of 16 bits for the lookup tables
+PHASH_BITS: Final[int] = 64
+_CHUNK_BITS: Final[int] = 16
+_CHUNK_COUNT: Final[int] = PHASH_BITS // _CHUNK_BITS
+_CHUNK_MASK: Final[int] = (1 << _CHUNK_BITS) - 1
+
+# Double scans of the same print are usually within this many bits of each other
+DEFAULT_MAX_DISTANCE: Final[int] = 6
+# Beyond this, every chunk probes thousands of neighbours and the matches are no longer near duplicates anyway
+MAX_SEARCH_DISTANCE: Final[int] = 15
+
+
+def phash_to_int(phash: str) -> int:
+    """
+    The stored hex string of a phash as a 64 bit integer
+    """
+    return int(phash, 16)
+
+
+@lru_cache(maxsize=_CHUNK_COUNT)
+def _flip_masks(distance: int) -> tuple[int, ...]:
+    """
+    Every chunk sized mask with at most distance bits set, from 0 up
+    """
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for count in range(distance + 1)
+        for bits in combinations(range(_CHUNK_BITS), count)
+    )
+
+
+class PhashIndex:
+    """
+    Finds the phashes within a Hamming distance of a phash, using multi-index hashing.
+
+    Each phash is split into 4 chunks of 16 bits, and every chunk value maps to the phashes containing it.  If two
+    phashes are within distance d, at least one of their chunks is within d // 4 of each other, so looking up each
+    chunk with up to d // 4 bits flipped finds every match, and only those candidates are compared in full.
+
+    The index holds distinct phashes, with the Images having each, so identical scans cost a single entry
+    """
+
+    __slots__ = ("_chunks", "_hashes", "_image_ids", "_lock", "last_pk")
+
+    def __init__(self) -> None:
+        self._chunks: list[dict[int, list[int]]] = [{} for _ in range(_CHUNK_COUNT)]
+        self._image_ids: dict[int, set[int]] = {}
+        self._hashes: dict[int, int] = {}
+        self._lock = threading.Lock()
+        # The highest Image primary key loaded from the database
+        self.last_pk = 0
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, image_id: int, phash: int) -> None:
+        """
+        Adds an Image with the given phash.  Adding the same Image again does nothing
+        """
+        with self._lock:
+            self._add(image_id, phash)
+
+    def _add(self, image_id: int, phash: int) -> None:
+        if image_id in self._hashes:
+            return
+        self._hashes[image_id] = phash
+        image_ids = self._image_ids.get(phash)
+        if image_ids is None:
+            image_ids = self._image_ids[phash] = set()
+            for index, chunks in enumerate(self._chunks):
+                chunks.setdefault((phash >> (index * _CHUNK_BITS)) & _CHUNK_MASK, []).append(phash)
+        image_ids.add(image_id)
+
+    def add_images(self, images: Iterable[tuple[int, str]]) -> None:
+        """
+        Adds the (primary key, phash string) pairs of Images
+        """
+        with self._lock:
+            for image_id, phash in images:
+                self._add(image_id, phash_to_int(phash))
+
+    def refresh(self) -> None:
+        """
+        Loads the Images created since the last refresh.  The phash of an Image is set when it is indexed, so
+        only the new ones are queried, in primary key order
+        """
+        with self._lock:
+            before = len(self._hashes)
+            for image_id, phash in (
+                Image.objects.filter(pk__gt=self.last_pk).order_by("pk").values_list("pk", "phash").iterator()
+            ):
+                self._add(image_id, phash_to_int(phash))
+                self.last_pk = image_id
+            if len(self._hashes) != before:
+                logger.debug(f"Similarity index has {len(self._hashes)} images")
+
+    def _matching_hashes(self, phash: int, max_distance: int) -> list[tuple[int, int]]:
+        """
+        The indexed phashes within max_distance of the phash, with their distance
+        """
+        masks = _flip_masks(max_distance // _CHUNK_COUNT)
+        candidates: set[int] = set()
+        for index, chunks in enumerate(self._chunks):
+            chunk = (phash >> (index * _CHUNK_BITS)) & _CHUNK_MASK
+            for mask in masks:
+                found = chunks.get(chunk ^ mask)
+                if found is not None:
+                    candidates.update(found)
+        matches = []
+        for candidate in candidates:
+            distance = (phash ^ candidate).bit_count()
+            if distance <= max_distance:
+                matches.append((candidate, distance))
+        return matches
+
+    def search(self, phash: int, max_distance: int = DEFAULT_MAX_DISTANCE) -> list[tuple[int, int]]:
+        """
+        The (image id, distance) of every Image within max_distance of the phash, closest first
+        """
+        with self._lock:
+            found = [
+                (image_id, distance)
+                for candidate, distance in self._matching_hashes(phash, max_distance)
+                for image_id in self._image_ids[candidate]
+            ]
+        return sorted(found, key=lambda item: (item[1], item[0]))
+
+    def clusters(self, max_distance: int = DEFAULT_MAX_DISTANCE) -> list[list[int]]:
+        """
+        Groups the Images into clusters, where each Image is within max_distance of at least one other Image in
+        its cluster.  Only clusters of more than one Image are returned, each sorted, ordered by their first Image
+        """
+        with self._lock:
+            phashes = np.fromiter(self._image_ids, dtype=np.uint64, count=len(self._image_ids))
+            image_ids = [sorted(ids) for ids in self._image_ids.values()]
+
+        # Union find over the positions of the distinct phashes
+        parents = list(range(len(image_ids)))
+
+        def find(position: int) -> int:
+            root = position
+            while parents[root] != root:
+                root = parents[root]
+            # Compress the path, so later lookups are direct
+            while parents[position] != root:
+                parents[position], position = root, parents[position]
+            return root
+
+        for first, second in _similar_pairs(phashes, max_distance):
+            for a, b in zip(first.tolist(), second.tolist(), strict=True):
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+
+        grouped: dict[int, list[int]] = {}
+        for position, ids in enumerate(image_ids):
+            grouped.setdefault(find(position), []).extend(ids)
+
+        return sorted((sorted(group) for group in grouped.values() if len(group) > 1), key=lambda group: group[0])
+
+
+def _expand_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    The ranges from each start, of the matching length, concatenated
+    """
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+def _similar_pairs(phashes: np.ndarray, max_distance: int) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Yields the positions of every pair of phashes within max_distance of each other, as two arrays.
+
+    This is the lookup of PhashIndex for every phash at once, vectorized, as looking up each phash in turn
+    takes minutes for a large library.  A pair close in more than one chunk is yielded more than once
+    """
+    masks = _flip_masks(max_distance // _CHUNK_COUNT)
+    for index in range(_CHUNK_COUNT):
+        chunks = ((phashes >> np.uint64(index * _CHUNK_BITS)) & np.uint64(_CHUNK_MASK)).astype(np.int64)
+        # The positions sorted by chunk value, and where each chunk value starts within them
+        order = np.argsort(chunks, kind="stable")
+        counts = np.bincount(chunks, minlength=_CHUNK_MASK + 1)
+        starts = np.cumsum(counts) - counts
+        for mask in masks:
+            if mask == 0:
+                # Pair each phash with those after it sharing the chunk value
+                ranks = np.arange(len(order))
+                sorted_chunks = chunks[order]
+                lengths = starts[sorted_chunks] + counts[sorted_chunks] - 1 - ranks
+                first = order[np.repeat(ranks, lengths)]
+                second = order[_expand_ranges(ranks + 1, lengths)]
+            else:
+                # Pair each phash with those whose chunk value differs by the mask, from the lower value only
+                targets = chunks ^ mask
+                sources = np.flatnonzero(chunks < targets)
+                lengths = counts[targets[sources]]
+                first = np.repeat(sources, lengths)
+                second = order[_expand_ranges(starts[targets[sources]], lengths)]
+            close = np.bitwise_count(phashes[first] ^ phashes[second]) <= max_distance
+            yield first[close], second[close]
+
+
+@lru_cache(maxsize=1)
+def get_phash_index() -> PhashIndex:
+    """
+    The index of this process, filled from the database on first use and refreshed before each search
+    """
+    return PhashIndex()
+
+
+def warm_phash_index() -> None:
+    """
+    Fills the index of this process from the database, so no search pays for building it.  Called as a web
+    worker starts, after which each search only loads the Images indexed since
+    """
+    index = get_phash_index()
+    try:
+        index.refresh()
+    except DatabaseError:
+        # Such as before the first migration, the first search fills it instead
+        logger.exception("Unable to load the similarity index")
+        return
+    logger.info(f"Loaded the similarity index with {len(index)} images")
+
+
+def find_similar_images(image: Image, max_distance: int = DEFAULT_MAX_DISTANCE) -> list[tuple[int, int]]:
+    """
+    The (image id, distance) of the Images which are not deleted and within max_distance of the given Image,
+    closest first.  The Image itself is left out
+    """
+    index = get_phash_index()
+    index.refresh()
+    found = index.search(phash_to_int(image.phash), max_distance)
+    # The index does not track deleting, so filter those out here
+    live = set(
+        Image.objects.filter(pk__in=[image_id for image_id, _ in found], deleted_at__isnull=True)
+        .exclude(pk=image.pk)
+        .values_list("pk", flat=True),
+    )
+    return [(image_id, distance) for image_id, distance in found if image_id in live]
@@ -1,3 +1,12 @@
+import dataclasses
+import datetime
+from collections import defaultdict
+from collections.abc import Iterable
+from collections.abc import Iterator
+
+from django.db.models import Q
+from django.db.models import QuerySet
+
 from scansteward.imageops.constants import DATE_KEYWORD
 from scansteward.imageops.models import DimensionsStruct
 from scansteward.imageops.models import ImageMetadata
@@ -10,13 +19,150 @@ from scansteward.imageops.models import XmpAreaStruct
 from scansteward.models import Image as ImageModel
 from scansteward.models import PersonInImage
 from scansteward.models import PetInImage
+from scansteward.models import RoughDate
+from scansteward.models import RoughLocation
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class RegionSnapshot:
+    name: str
+    description: str | None
+    center_x: float
+    center_y: float
+    height: float
+    width: float
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class LocationSnapshot:
+    country_name: str
+    subdivision_name: str | None
+    city: str | None
+    sub_location: str | None
+
+    @classmethod
+    def from_model(cls, location: RoughLocation) -> "LocationSnapshot":
+        return cls(
+            country_name=location.country_name,
+            subdivision_name=location.subdivision_name,
+            city=location.city,
+            sub_location=location.sub_location,
+        )
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DateSnapshot:
+    date: datetime.date
+    month_valid: bool
+    day_valid: bool
+
+    @classmethod
+    def from_model(cls, date: RoughDate) -> "DateSnapshot":
+        return cls(date=date.date, month_valid=date.month_valid, day_valid=date.day_valid)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ImageSyncSnapshot:
+    """
+    Everything about an Image which is written into its file, loaded up front so building the metadata
+    does no queries
+    """
+
+    pk: int
+    height: int
+    width: int
+    description: str | None
+    orientation: int
+    people: tuple[RegionSnapshot, ...]
+    pets: tuple[RegionSnapshot, ...]
+    location: LocationSnapshot | None
+    date: DateSnapshot | None
+
+
+def load_sync_snapshots(image_ids: Iterable[int]) -> dict[int, ImageSyncSnapshot]:
+    """
+    Loads the snapshots of the given Images, keyed by their primary key.
+
+    This is always 3 queries, no matter how many images, people or pets there are: the images with their
+    location and date, then all their people boxes and all their pet boxes
+    """
+    image_ids = list(image_ids)
+
+    people: defaultdict[int, list[RegionSnapshot]] = defaultdict(list)
+    for person_box in PersonInImage.objects.filter(image_id__in=image_ids).select_related("person").order_by("pk"):
+        people[person_box.image_id].append(  # type: ignore[attr-defined]
+            RegionSnapshot(
+                name=person_box.person.name,
+                description=person_box.person.description,
+                center_x=person_box.center_x,
+                center_y=person_box.center_y,
+                height=person_box.height,
+                width=person_box.width,
+            ),
+        )
+
+    pets: defaultdict[int, list[RegionSnapshot]] = defaultdict(list)
+    for pet_box in PetInImage.objects.filter(image_id__in=image_ids).select_related("pet").order_by("pk"):
+        pets[pet_box.image_id].append(  # type: ignore[attr-defined]
+            RegionSnapshot(
+                name=pet_box.pet.name,
+                description=pet_box.description,
+                center_x=pet_box.center_x,
+                center_y=pet_box.center_y,
+                height=pet_box.height,
+                width=pet_box.width,
+            ),
+        )
+
+    return {
+        image.pk: ImageSyncSnapshot(
+            pk=image.pk,
+            height=image.height,
+            width=image.width,
+            description=image.description,
+            orientation=image.orientation,
+            people=tuple(people[image.pk]),
+            pets=tuple(pets[image.pk]),
+            location=LocationSnapshot.from_model(image.location) if image.location is not None else None,
+            date=DateSnapshot.from_model(image.date) if image.date is not None else None,
+        )
+        for image in ImageModel.objects.filter(pk__in=image_ids).select_related("location", "date")
+    }
+
+
+def dirty_images(*, dirtied_before: datetime.datetime | None = None) -> QuerySet[ImageModel]:
+    """
+    The dirty images which need syncing.  If given a time, only those not marked dirty again since then
+    """
+    images = ImageModel.objects.filter(is_dirty=True).filter(deleted_at__isnull=True)
+    if dirtied_before is not None:
+        # Images marked dirty before the time was recorded have certainly settled
+        images = images.filter(Q(dirtied_at__isnull=True) | Q(dirtied_at__lte=dirtied_before))
+    return images
 
 
-def fill_image_metadata_from_db(image: ImageModel, image_metadata: ImageMetadata) -> bool:
+def iter_dirty_image_ids(batch_size: int, *, dirtied_before: datetime.datetime | None = None) -> Iterator[list[int]]:
     """
-    Given a dirty image, constructs a new ImageMetadata object and populates it with the data from the database.
+    Yields the primary keys of the dirty images in batches, in order.
 
-    For use in syncing the database into the image file.
+    Each batch continues from the last primary key seen, rather than an offset.  Images are marked clean as
+    they are synced, which would shift offset based pages, and every batch is a cheap index range
+    """
+    images = dirty_images(dirtied_before=dirtied_before).order_by("pk")
+    last_pk = 0
+    while True:
+        image_ids = list(images.filter(pk__gt=last_pk).values_list("pk", flat=True)[:batch_size])
+        if not image_ids:
+            return
+        yield image_ids
+        last_pk = image_ids[-1]
+
+
+def fill_image_metadata_from_db(image: ImageSyncSnapshot, image_metadata: ImageMetadata) -> bool:
+    """
+    Given the snapshot of a dirty image, populates the ImageMetadata object with the data from the database.
+
+    For use in syncing the database into the image file.  No queries are made, see load_sync_snapshots
     """
 
     def _update_description() -> bool:
@@ -30,49 +176,30 @@ def fill_image_metadata_from_db(image: ImageModel, image_metadata: ImageMetadata
         return True
 
     def _update_region_info() -> bool:
-        def _add_people_regions() -> None:
-            for person in image.people.all():
-                person_box = PersonInImage.objects.filter(image=image, person=person).get()
-                region_info.RegionList.append(
-                    RegionStruct(
-                        Name=person.name,
-                        Type="Face",
-                        Area=XmpAreaStruct(
-                            H=person_box.height,
-                            W=person_box.width,
-                            X=person_box.center_x,
-                            Y=person_box.center_y,
-                            Unit="normalized",
-                        ),
-                        Description=person.description,
-                    ),
-                )
-
-        def _add_pets_regions() -> None:
-            for pet in image.pets.all():
-                pet_box = PetInImage.objects.filter(image=image, pet=pet).get()
-                region_info.RegionList.append(
-                    RegionStruct(
-                        Name=pet.name,
-                        Type="Pet",
-                        Area=XmpAreaStruct(
-                            H=pet_box.height,
-                            W=pet_box.width,
-                            X=pet_box.center_x,
-                            Y=pet_box.center_y,
-                            Unit="normalized",
-                        ),
-                        Description=pet_box.description,
+        def _add_regions(regions: tuple[RegionSnapshot, ...], region_type: str) -> None:
+            region_info.RegionList.extend(
+                RegionStruct(
+                    Name=region.name,
+                    Type=region_type,
+                    Area=XmpAreaStruct(
+                        H=region.height,
+                        W=region.width,
+                        X=region.center_x,
+                        Y=region.center_y,
+                        Unit="normalized",
                     ),
+                    Description=region.description,
                 )
+                for region in regions
+            )
 
-        if image.people.count() > 0 or image.pets.count() > 0:
+        if image.people or image.pets:
             region_info = RegionInfoStruct(
                 AppliedToDimensions=DimensionsStruct(H=float(image.height), W=float(image.width), Unit="pixel"),
                 RegionList=[],
             )
-            _add_people_regions()
-            _add_pets_regions()
+            _add_regions(image.people, "Face")
+            _add_regions(image.pets, "Pet")
             image_metadata.RegionInfo = region_info
             return True
         return False
@@ -0,0 +1,103 @@
+import logging
+import os
+import queue
+import threading
+from collections.abc import Iterable
+from collections.abc import Iterator
+from pathlib import Path
+from typing import TypeVar
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+
+def iter_image_files(root: Path, extensions: set[str]) -> Iterator[Path]:
+    """
+    Walks the given directory tree a single time, yielding the resolved path of every file with one of the
+    given extensions (compared case insensitively) as soon as it is found.
+
+    Entries in each directory are visited in sorted order, so the walk is stable between runs.  Symlinked
+    directories are followed, but each directory is only ever visited once.
+    """
+    extensions = {extension.lower() for extension in extensions}
+    root = root.resolve()
+    if root.is_file():
+        if root.suffix.lower() in extensions:
+            yield root
+        return
+
+    visited: set[tuple[int, int]] = set()
+    pending: list[Path] = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            stat = directory.stat()
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Unable to read directory {directory}: {e}")
+            continue
+
+        subdirectories: list[Path] = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    subdirectories.append(Path(entry.path))
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:  # noqa: PTH122
+                    yield Path(entry.path).resolve()
+            except OSError as e:  # pragma: no cover
+                logger.warning(f"Unable to read {entry.path}: {e}")
+        # Reversed, so the directories are popped in sorted order
+        pending.extend(reversed(subdirectories))
+
+
+def prefetch(iterable: Iterable[_T], size: int) -> Iterator[_T]:
+    """
+    Runs the given iterable on a background thread, buffering up to size items ahead of the consumer.
+
+    A size of 0 or less does no prefetching and simply iterates
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    buffer: queue.Queue[tuple[bool, _T | BaseException | None]] = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def _put(entry: tuple[bool, _T | BaseException | None]) -> bool:
+        # Gives up once the consumer has stopped, so the producer never blocks forever on a full buffer
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _produce() -> None:
+        try:
+            for item in iterable:
+                if not _put((False, item)):
+                    return
+        except BaseException as e:  # noqa: BLE001
+            _put((True, e))
+            return
+        _put((True, None))
+
+    producer = threading.Thread(target=_produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            done, item = buffer.get()
+            if done:
+                if item is not None:
+                    raise item  # type: ignore[misc]
+                return
+            yield item  # type: ignore[misc]
+    finally:
+        stop.set()
+        producer.join()
@@ -0,0 +1,32 @@
+import logging
+from typing import Annotated
+
+from django_typer.management import TyperCommand
+from typer import Option
+
+from scansteward.imageops.similarity import DEFAULT_MAX_DISTANCE
+from scansteward.imageops.similarity import MAX_SEARCH_DISTANCE
+from scansteward.imageops.similarity import PhashIndex
+from scansteward.models import Image
+
+logger = logging.getLogger(__name__)
+
+
+class Command(TyperCommand):
+    help = "Groups the images which look nearly the same, such as a print scanned more than once"
+
+    def handle(
+        self,
+        max_distance: Annotated[
+            int,
+            Option(help="Largest Hamming distance between the perceptual hashes", min=0, max=MAX_SEARCH_DISTANCE),
+        ] = DEFAULT_MAX_DISTANCE,
+    ):
+        index = PhashIndex()
+        index.add_images(Image.objects.filter(deleted_at__isnull=True).values_list("pk", "phash").iterator())
+
+        clusters = index.clusters(max_distance)
+        for cluster in clusters:
+            self.stdout.write(" ".join(str(image_id) for image_id in cluster))
+
+        logger.info(f"Found {len(clusters)} groups of similar images among {len(index)} images")
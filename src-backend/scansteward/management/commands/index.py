@@ -1,16 +1,34 @@
+import itertools
 import logging
+from collections import deque
 from pathlib import Path
+from typing import TYPE_CHECKING
 from typing import Annotated
 from typing import Final
 from typing import Optional
 
+from django.core.management.base import CommandError
 from django_typer.management import TyperCommand
+from huey.exceptions import TaskException
 from typer import Argument
 from typer import Option
 
+from scansteward.imageops.jobs import finish_job
+from scansteward.imageops.jobs import iter_unfinished_items
+from scansteward.imageops.jobs import record_job_items
+from scansteward.imageops.resolvers import EntityCache
+from scansteward.imageops.resolvers import TagTreeResolver
+from scansteward.imageops.walk import iter_image_files
+from scansteward.imageops.walk import prefetch
 from scansteward.models import ImageSource
-from scansteward.tasks.images import index_single_image
-from scansteward.tasks.models import ImageIndexTaskModel
+from scansteward.models import IndexJob
+from scansteward.models import IndexJobItem
+from scansteward.tasks.images import index_image_batch
+from scansteward.tasks.images import index_images
+from scansteward.tasks.models import ImageIndexBatchTaskModel
+
+if TYPE_CHECKING:
+    from huey.api import Result
 
 
 class Command(TyperCommand):
@@ -27,38 +45,140 @@ class Command(TyperCommand):
 
     def handle(
         self,
-        paths: Annotated[list[Path], Argument(help="The paths to index for new images")],
+        paths: Annotated[
+            Optional[list[Path]],  # noqa: UP007
+            Argument(help="The paths to index for new images, not needed when resuming"),
+        ] = None,
         hash_threads: Annotated[int, Option(help="Number of threads to use for hashing")] = 4,
+        batch_size: Annotated[
+            int,
+            Option(help="Number of images to index together, sharing a single metadata read and transaction", min=1),
+        ] = 50,
         source: Annotated[
             Optional[str],  # noqa: UP007
             Option(help="The source of the images to attach to the image"),
         ] = None,
         *,
         synchronous: Annotated[bool, Option(help="If True, run the indexing in the same process")] = True,
+        prefetch_size: Annotated[
+            int,
+            Option(
+                "--prefetch",
+                help="Number of paths to find ahead of the indexing on a background thread, 0 to disable",
+                min=0,
+            ),
+        ] = 0,
+        rehash: Annotated[
+            bool,
+            Option(help="If True, hash every file, even those unchanged since they were last indexed"),
+        ] = False,
+        resume: Annotated[
+            bool,
+            Option(help="If True, resume the last unfinished index job, indexing only the images it did not finish"),
+        ] = False,
+        max_in_flight: Annotated[
+            int,
+            Option("--in-flight", help="Number of batches queued at once, when not synchronous", min=1),
+        ] = 4,
     ) -> None:
         logger = logging.getLogger(__name__)
 
-        if source:
-            img_src, created = ImageSource.objects.get_or_create(name=source)
-            if created:
-                logger.info(f"Created new source {source}")
-            else:
-                logger.info(f"Using existing source {source} (#{img_src.pk})")
+        if resume:
+            job = IndexJob.objects.filter(finished_at__isnull=True).order_by("-pk").select_related("source").first()
+            if job is None:
+                msg = "There is no unfinished index job to resume"
+                raise CommandError(msg)
+            if paths:
+                logger.warning(f"Resuming index job {job.pk}, the given paths are ignored")
+            logger.info(f"Resuming index job {job.pk} of {', '.join(job.roots)}")
         else:
-            img_src = None
-
-        self.image_paths: list[Path] = []
+            if not paths:
+                msg = "No paths were given to index"
+                raise CommandError(msg)
+            if source:
+                img_src, created = ImageSource.objects.get_or_create(name=source)
+                if created:
+                    logger.info(f"Created new source {source}")
+                else:
+                    logger.info(f"Using existing source {source} (#{img_src.pk})")
+            else:
+                img_src = None
+            job = IndexJob.objects.create(
+                roots=[str(path.resolve()) for path in paths],
+                source=img_src,
+                hash_threads=hash_threads,
+            )
+            logger.info(f"Created index job {job.pk}")
 
-        for path in paths:
-            for extension in self.IMAGE_EXTENSIONS:
-                for filename in path.glob(f"**/*{extension}"):
-                    self.image_paths.append(filename.resolve())
+        # Batches indexed in this process share the in memory Tags, People, Pets, locations and dates
+        tag_resolver = TagTreeResolver() if synchronous else None
+        entity_cache = EntityCache() if synchronous else None
+        in_flight: deque[Result] = deque()
 
-        logger.info(f"Found {len(self.image_paths)} images to index")
+        def _wait_oldest() -> None:  # pragma: no cover
+            try:
+                in_flight.popleft().get(blocking=True)
+            except TaskException:
+                # The task has recorded the failure on its items
+                logger.exception("Failed to index a batch")
 
-        for image_path in sorted(self.image_paths):
-            pkg = ImageIndexTaskModel(image_path, hash_threads, img_src, logger)
+        def _dispatch(items: list[IndexJobItem]) -> None:
             if synchronous:
-                index_single_image.call_local(pkg)
+                pkg = ImageIndexBatchTaskModel(
+                    [Path(item.path) for item in items],
+                    job.hash_threads,
+                    job.source,
+                    logger,
+                    use_fingerprints=not rehash,
+                    tag_resolver=tag_resolver,
+                    entity_cache=entity_cache,
+                    job_item_ids=[item.pk for item in items],
+                )
+                try:
+                    index_images(pkg)
+                except Exception:
+                    # The failure is recorded on the items, carry on with the rest
+                    logger.exception(f"Failed to index a batch of {len(items)} images")
             else:  # pragma: no cover
-                index_single_image(pkg)
+                # Bounded, so a large tree does not flood the queue faster than the workers index it
+                while len(in_flight) >= max_in_flight:
+                    _wait_oldest()
+                # Only the ids are queued, the worker loads everything else
+                in_flight.append(index_image_batch([item.pk for item in items], use_fingerprints=not rehash))
+
+        if not job.discovery_complete:
+            # Images are recorded and indexed as they are found, so the first batches are done while the tree
+            # is still being walked.  When resuming, the walk only records what the interrupted run missed
+            found = 0
+            batch: list[Path] = []
+            image_paths = itertools.chain.from_iterable(
+                iter_image_files(Path(root), self.IMAGE_EXTENSIONS) for root in job.roots
+            )
+            for image_path in prefetch(image_paths, prefetch_size):
+                found += 1
+                batch.append(image_path)
+                if len(batch) >= batch_size:
+                    items = record_job_items(job, batch)
+                    if not resume and items:
+                        _dispatch(items)
+                    batch.clear()
+            if batch:
+                items = record_job_items(job, batch)
+                if not resume and items:
+                    _dispatch(items)
+            job.discovery_complete = True
+            job.save(update_fields=["discovery_complete", "modified"])
+            logger.info(f"Found {found} images to index")
+
+        if resume:
+            for items in iter_unfinished_items(job, batch_size):
+                _dispatch(items)
+
+        while in_flight:  # pragma: no cover
+            _wait_oldest()
+
+        unfinished = finish_job(job)
+        if unfinished:
+            msg = f"{unfinished} images of index job {job.pk} were not indexed, use --resume to retry them"
+            raise CommandError(msg)
+        logger.info(f"Index job {job.pk} finished")
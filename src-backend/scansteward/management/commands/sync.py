@@ -1,11 +1,10 @@
 import logging
 from typing import Annotated
 
-from django.core.paginator import Paginator
 from django_typer.management import TyperCommand
 from typer import Option
 
-from scansteward.models import Image as ImageModel
+from scansteward.imageops.sync import iter_dirty_image_ids
 from scansteward.tasks.images import sync_metadata_to_files
 
 logger = logging.getLogger(__name__)
@@ -16,21 +15,17 @@ class Command(TyperCommand):
 
     def handle(
         self,
+        batch_size: Annotated[int, Option(help="Number of images to write together", min=1)] = 50,
         *,
         synchronous: Annotated[bool, Option(help="If True, run the writing in the same process")] = True,
     ):
-        paginator = Paginator(
-            ImageModel.objects.filter(is_dirty=True)
-            .filter(deleted_at__isnull=True)
-            .order_by("pk")
-            .prefetch_related("location", "date", "people", "pets", "tags")
-            .all(),
-            10,
-        )
-
-        for i in paginator.page_range:
-            data_chunk: list[ImageModel] = list(paginator.page(i).object_list)
+        total = 0
+        for image_ids in iter_dirty_image_ids(batch_size):
+            # Only the range is sent, so the task loads the current state of the images itself
             if synchronous:
-                sync_metadata_to_files.call_local(data_chunk)
+                sync_metadata_to_files.call_local(image_ids[0], image_ids[-1])
             else:  # pragma: no cover
-                sync_metadata_to_files(data_chunk)
+                sync_metadata_to_files(image_ids[0], image_ids[-1])
+            total += len(image_ids)
+
+        logger.info(f"Synced {total} dirty images")
@@ -0,0 +1,45 @@
+# Generated by Django 5.1 on 2026-10-18 15:28
+
+import django.db.models.deletion
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("scansteward", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageFingerprint",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                (
+                    "path",
+                    models.CharField(
+                        db_index=True,
+                        max_length=1024,
+                        verbose_name="Resolved path to the original image",
+                    ),
+                ),
+                ("size", models.PositiveBigIntegerField(verbose_name="file size in bytes")),
+                ("mtime_ns", models.BigIntegerField(verbose_name="modification time in nanoseconds")),
+                ("inode", models.PositiveBigIntegerField(verbose_name="inode number")),
+                (
+                    "image",
+                    models.OneToOneField(
+                        help_text="The Image this file was indexed as",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="fingerprint",
+                        to="scansteward.image",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 5.1 on 2026-10-18 15:48
+
+import django.db.models.deletion
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("scansteward", "0002_image_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IndexJob",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("roots", models.JSONField(default=list, help_text="The paths which were given to be indexed")),
+                ("hash_threads", models.PositiveSmallIntegerField(default=4)),
+                (
+                    "discovery_complete",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Have all the roots been walked and their images recorded?",
+                    ),
+                ),
+                (
+                    "finished_at",
+                    models.DateTimeField(
+                        blank=True,
+                        default=None,
+                        help_text="When every item of this job was indexed",
+                        null=True,
+                    ),
+                ),
+                (
+                    "source",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="The source attached to the indexed images",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="scansteward.imagesource",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="IndexJobItem",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("path", models.CharField(max_length=1024, verbose_name="Resolved path to the original image")),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+                        db_index=True,
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "error",
+                    models.TextField(
+                        blank=True,
+                        default=None,
+                        help_text="Why indexing this path failed, if it did",
+                        null=True,
+                    ),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        help_text="The job which discovered this path",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="items",
+                        to="scansteward.indexjob",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["pk"],
+                "indexes": [models.Index(fields=["job", "state"], name="scansteward_job_id_894fa4_idx")],
+                "constraints": [models.UniqueConstraint(fields=("job", "path"), name="unique-job-path")],
+            },
+        ),
+    ]
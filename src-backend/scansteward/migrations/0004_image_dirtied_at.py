@@ -0,0 +1,24 @@
+# Generated by Django 5.1 on 2026-10-18 16:06
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("scansteward", "0003_index_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="dirtied_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="When the image was last marked as dirty",
+                null=True,
+            ),
+        ),
+    ]
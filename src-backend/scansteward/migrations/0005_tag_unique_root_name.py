@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-18 17:02
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("scansteward", "0004_image_dirtied_at"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="tag",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("parent__isnull", True)),
+                fields=("name",),
+                name="unique-root-name",
+            ),
+        ),
+    ]
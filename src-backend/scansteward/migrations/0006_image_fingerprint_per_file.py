@@ -0,0 +1,38 @@
+# Generated by Django 5.1 on 2026-10-18 17:32
+
+import django.db.models.deletion
+from django.db import migrations
+from django.db import models
+from django.db.models import F
+
+
+def remove_stale_fingerprints(apps, schema_editor):  # noqa: ARG001
+    # Only the fingerprint at the current path of its Image was ever used, any other would clash with the
+    # fingerprint of the file now at that path
+    ImageFingerprint = apps.get_model("scansteward", "ImageFingerprint")
+    ImageFingerprint.objects.exclude(path=F("image__original")).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("scansteward", "0005_tag_unique_root_name"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_stale_fingerprints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="imagefingerprint",
+            name="image",
+            field=models.ForeignKey(
+                help_text="The Image this file was indexed as, or is a copy of",
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="fingerprints",
+                to="scansteward.image",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="imagefingerprint",
+            name="path",
+            field=models.CharField(max_length=1024, unique=True, verbose_name="Resolved path to the original image"),
+        ),
+    ]
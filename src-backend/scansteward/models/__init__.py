@@ -2,6 +2,9 @@ from scansteward.models.album import Album
 from scansteward.models.album import ImageInAlbum
 from scansteward.models.auth import Token
 from scansteward.models.image import Image
+from scansteward.models.image import ImageFingerprint
+from scansteward.models.jobs import IndexJob
+from scansteward.models.jobs import IndexJobItem
 from scansteward.models.metadata import ImageSource
 from scansteward.models.metadata import Person
 from scansteward.models.metadata import PersonInImage
@@ -17,7 +20,10 @@ __all__ = [
     "Album",
     "ImageInAlbum",
     "Image",
+    "ImageFingerprint",
     "ImageSource",
+    "IndexJob",
+    "IndexJobItem",
     "Person",
     "PersonInImage",
     "Pet",
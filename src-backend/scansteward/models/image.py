@@ -3,11 +3,8 @@ from __future__ import annotations
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-from blake3 import blake3
 from django.conf import settings
 from django.db import models
-from imagehash import average_hash
-from PIL import Image as PILImage
 
 from scansteward.imageops.models import RotationEnum
 from scansteward.models.abstract import AbstractTimestampMixin
@@ -20,6 +17,8 @@ from scansteward.models.metadata import RoughDate
 from scansteward.models.metadata import RoughLocation
 from scansteward.models.metadata import Tag
 from scansteward.models.metadata import TagOnImage
+from scansteward.utils import calculate_blake3_hash
+from scansteward.utils import calculate_image_phash
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
@@ -102,6 +101,14 @@ class Image(AbstractTimestampMixin, models.Model):
         help_text="The metadata is dirty and needs to be synced to the file",
     )
 
+    dirtied_at = models.DateTimeField(
+        default=None,
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="When the image was last marked as dirty",
+    )
+
     deleted_at = models.DateTimeField(
         default=None,
         null=True,
@@ -196,17 +203,43 @@ class Image(AbstractTimestampMixin, models.Model):
         Image.objects.filter(pk=self.pk).update(is_dirty=False)
 
     def update_hashes(self, *, threads=4) -> None:
-        def hash_file(filepath: Path, *, hash_threads: int = 4) -> str:
-            return blake3(
-                filepath.read_bytes(),
-                max_threads=hash_threads,
-            ).hexdigest()
+        # The same hash as indexing, so the similarity of the Image is still comparable
+        self.phash = calculate_image_phash(self.original_path)
 
-        with PILImage.open(self.original_path) as im_file:
-            self.phash = str(average_hash(im_file))
-
-        self.original_checksum = hash_file(self.original_path, hash_threads=threads)
-        self.full_size_checksum = hash_file(self.full_size_path, hash_threads=threads)
-        self.thumbnail_checksum = hash_file(self.thumbnail_path, hash_threads=threads)
+        self.original_checksum = calculate_blake3_hash(self.original_path, hash_threads=threads)
+        self.full_size_checksum = calculate_blake3_hash(self.full_size_path, hash_threads=threads)
+        self.thumbnail_checksum = calculate_blake3_hash(self.thumbnail_path, hash_threads=threads)
 
         self.save()
+
+
+class ImageFingerprint(AbstractTimestampMixin, models.Model):
+    """
+    The stat details of an original file when it was last indexed.  If none of them have changed,
+    the file is assumed to be unchanged as well and does not need to be read and hashed again.
+
+    A file which is a copy of an indexed Image has one too, pointing at that Image, so the copy is
+    skipped as well
+    """
+
+    image = models.ForeignKey(
+        Image,
+        on_delete=models.CASCADE,
+        related_name="fingerprints",
+        help_text="The Image this file was indexed as, or is a copy of",
+    )
+
+    path = models.CharField(
+        max_length=1024,
+        unique=True,
+        verbose_name="Resolved path to the original image",
+    )
+
+    size = models.PositiveBigIntegerField(verbose_name="file size in bytes")
+
+    mtime_ns = models.BigIntegerField(verbose_name="modification time in nanoseconds")
+
+    inode = models.PositiveBigIntegerField(verbose_name="inode number")
+
+    def __str__(self) -> str:
+        return f"Fingerprint of {self.path}"
@@ -0,0 +1,95 @@
+from collections.abc import Sequence
+
+from django.db import models
+
+from scansteward.models.abstract import AbstractTimestampMixin
+from scansteward.models.metadata import ImageSource
+
+
+class IndexJob(AbstractTimestampMixin, models.Model):
+    """
+    A run of the index command.  Every image path it discovers is recorded as an IndexJobItem, so an
+    interrupted run can be resumed without walking or indexing everything again
+    """
+
+    roots = models.JSONField(
+        default=list,
+        help_text="The paths which were given to be indexed",
+    )
+
+    source = models.ForeignKey(
+        ImageSource,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        help_text="The source attached to the indexed images",
+    )
+
+    hash_threads = models.PositiveSmallIntegerField(default=4)
+
+    discovery_complete = models.BooleanField(
+        default=False,
+        help_text="Have all the roots been walked and their images recorded?",
+    )
+
+    finished_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        default=None,
+        help_text="When every item of this job was indexed",
+    )
+
+    def __str__(self) -> str:
+        return f"Index job {self.pk}"
+
+
+class IndexJobItem(AbstractTimestampMixin, models.Model):
+    """
+    A single image path discovered by an IndexJob and how far it got
+    """
+
+    class StateChoices(models.TextChoices):
+        PENDING = "pending"
+        DONE = "done"
+        FAILED = "failed"
+
+    job = models.ForeignKey(
+        IndexJob,
+        on_delete=models.CASCADE,
+        related_name="items",
+        help_text="The job which discovered this path",
+    )
+
+    path = models.CharField(
+        max_length=1024,
+        verbose_name="Resolved path to the original image",
+    )
+
+    state = models.CharField(
+        max_length=10,
+        choices=StateChoices.choices,
+        default=StateChoices.PENDING,
+        db_index=True,
+    )
+
+    error = models.TextField(  # noqa: DJ001
+        null=True,
+        blank=True,
+        default=None,
+        help_text="Why indexing this path failed, if it did",
+    )
+
+    class Meta:
+        ordering: Sequence = ["pk"]
+        constraints: Sequence = [
+            models.UniqueConstraint(
+                fields=["job", "path"],
+                name="unique-job-path",
+            ),
+        ]
+        indexes: Sequence = [
+            models.Index(fields=["job", "state"]),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.path} ({self.state})"
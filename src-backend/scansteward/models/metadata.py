@@ -42,6 +42,8 @@ class Tag(AbstractTimestampMixin, models.Model):
     class Meta:
         constraints: Sequence = [
             models.UniqueConstraint(fields=["name", "parent"], name="name-to-parent"),
+            # NULL parents are all distinct to the constraint above, so root names need their own
+            models.UniqueConstraint(fields=["name"], condition=models.Q(parent__isnull=True), name="unique-root-name"),
         ]
 
     def __str__(self) -> str:
@@ -1,21 +1,30 @@
 import logging
 from http import HTTPStatus
 from mimetypes import guess_type
+from typing import Annotated
+from typing import Final
 
 from django.db import transaction
-from django.http import FileResponse
 from django.http import HttpRequest
 from django.shortcuts import aget_object_or_404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.views.decorators.http import condition
+from ninja import Query
 from ninja import Router
-from ninja.decorators import decorate_view
 from ninja.pagination import PageNumberPagination
 from ninja.pagination import paginate
 
 from scansteward.common.constants import WEBP_CONTENT_TYPE
+from scansteward.common.errors import HttpBadRequestError
 from scansteward.common.errors import HttpConflictError
+from scansteward.imageops.renditions import DEFAULT_RENDITION_QUALITY
+from scansteward.imageops.renditions import MAX_RENDITION_SIZE
+from scansteward.imageops.renditions import RenditionFormat
+from scansteward.imageops.renditions import RenditionSpec
+from scansteward.imageops.renditions import get_rendition
+from scansteward.imageops.similarity import DEFAULT_MAX_DISTANCE
+from scansteward.imageops.similarity import MAX_SEARCH_DISTANCE
+from scansteward.imageops.similarity import find_similar_images
 from scansteward.models import Image
 from scansteward.models import Person
 from scansteward.models import PersonInImage
@@ -28,10 +37,9 @@ from scansteward.models import TagOnImage
 from scansteward.routes.images.common import get_faces_from_image
 from scansteward.routes.images.common import get_image_metadata_common
 from scansteward.routes.images.common import get_pet_boxes_from_image
-from scansteward.routes.images.conditionals import full_size_etag
-from scansteward.routes.images.conditionals import image_last_modified
-from scansteward.routes.images.conditionals import original_image_etag
-from scansteward.routes.images.conditionals import thumbnail_etag
+from scansteward.routes.images.conditionals import conditional_file_response
+from scansteward.routes.images.conditionals import conditional_thumbnails_response
+from scansteward.routes.images.conditionals import get_image_for_file
 from scansteward.routes.images.filters import CommaSepIntList
 from scansteward.routes.images.schemas import ImageMetadataOutSchema
 from scansteward.routes.images.schemas import ImageMetadataUpdateInSchema
@@ -39,10 +47,14 @@ from scansteward.routes.images.schemas import PersonFaceDeleteSchema
 from scansteward.routes.images.schemas import PersonWithBoxSchema
 from scansteward.routes.images.schemas import PetBoxDeleteInSchema
 from scansteward.routes.images.schemas import PetWithBoxSchema
+from scansteward.routes.images.schemas import SimilarImageSchema
 
 router = Router(tags=["images"])
 logger = logging.getLogger(__name__)
 
+# Enough for a page of images, with room to spare
+MAX_THUMBNAIL_BATCH: Final[int] = 100
+
 
 @router.get("", response=list[int], operation_id="get_all_images")
 @paginate(PageNumberPagination)
@@ -81,6 +93,37 @@ def get_all_images(
     return qs.only("pk").all().values_list("pk", flat=True)
 
 
+@router.get(
+    "/thumbnails/",
+    openapi_extra={
+        "responses": {
+            HTTPStatus.BAD_REQUEST: {
+                "description": "Too many images requested",
+            },
+            HTTPStatus.OK: {
+                "content": {"multipart/mixed": {"schema": {"type": "string", "format": "binary"}}},
+            },
+        },
+    },
+    operation_id="get_image_thumbnails",
+)
+def get_image_thumbnails(
+    request: HttpRequest,
+    ids: CommaSepIntList,
+):
+    """
+    Get the thumbnails of many images at once, such as a page of the gallery, as one multipart/mixed response.
+    Each part is a thumbnail, in the order requested, with the image ID as its Content-ID and its own ETag.
+    Images which do not exist are left out
+    """
+    if len(ids) > MAX_THUMBNAIL_BATCH:
+        msg = f"At most {MAX_THUMBNAIL_BATCH} thumbnails can be requested at once"
+        logger.warning(msg)
+        raise HttpBadRequestError(msg)
+
+    return conditional_thumbnails_response(request, ids)
+
+
 @router.get(
     "/{image_id}/thumbnail/",
     openapi_extra={
@@ -95,16 +138,19 @@ def get_all_images(
     },
     operation_id="get_image_thumbnail",
 )
-@decorate_view(
-    condition(last_modified_func=image_last_modified, etag_func=thumbnail_etag),
-)
 def get_image_thumbnail(
-    request: HttpRequest,  # noqa: ARG001
+    request: HttpRequest,
     image_id: int,
 ):
-    img: Image = get_object_or_404(Image, id=image_id)
-
-    return FileResponse(img.thumbnail_path.open(mode="rb"), content_type=WEBP_CONTENT_TYPE)
+    img = get_image_for_file(image_id, "thumbnail_checksum")
+
+    return conditional_file_response(
+        request,
+        img.thumbnail_path,
+        checksum=img.thumbnail_checksum,
+        last_modified=img.modified,
+        content_type=WEBP_CONTENT_TYPE,
+    )
 
 
 @router.get(
@@ -121,16 +167,63 @@ def get_image_thumbnail(
     },
     operation_id="get_image_full_size",
 )
-@decorate_view(
-    condition(last_modified_func=image_last_modified, etag_func=full_size_etag),
-)
 def get_image_full_size(
-    request: HttpRequest,  # noqa: ARG001
+    request: HttpRequest,
+    image_id: int,
+):
+    img = get_image_for_file(image_id, "full_size_checksum")
+
+    return conditional_file_response(
+        request,
+        img.full_size_path,
+        checksum=img.full_size_checksum,
+        last_modified=img.modified,
+        content_type=WEBP_CONTENT_TYPE,
+    )
+
+
+@router.get(
+    "/{image_id}/rendition/",
+    openapi_extra={
+        "responses": {
+            HTTPStatus.BAD_REQUEST: {
+                "description": "Neither a width nor a height was given",
+            },
+            HTTPStatus.NOT_FOUND: {
+                "description": "Not Found Response",
+            },
+            HTTPStatus.OK: {"content": {"image/*": {"schema": {"type": "string", "format": "binary"}}}},
+        },
+    },
+    operation_id="get_image_rendition",
+)
+def get_image_rendition(
+    request: HttpRequest,
     image_id: int,
+    width: int | None = Query(None, ge=1, le=MAX_RENDITION_SIZE),
+    height: int | None = Query(None, ge=1, le=MAX_RENDITION_SIZE),
+    image_format: Annotated[RenditionFormat, Query(alias="format")] = RenditionFormat.WEBP,
+    quality: int = Query(DEFAULT_RENDITION_QUALITY, ge=1, le=100),
 ):
-    img: Image = get_object_or_404(Image, id=image_id)
+    """
+    Get the image scaled down to fit within the width and height, keeping its aspect ratio, in the given format.
+    A rendition is created from the full size image the first time it is requested, then served from a cache
+    """
+    if width is None and height is None:
+        msg = "At least one of width or height is required"
+        logger.warning(msg)
+        raise HttpBadRequestError(msg)
 
-    return FileResponse(img.full_size_path.open(mode="rb"), content_type=WEBP_CONTENT_TYPE)
+    img = get_image_for_file(image_id, "full_size_checksum")
+    spec = RenditionSpec(width=width, height=height, format=image_format, quality=quality)
+
+    return conditional_file_response(
+        request,
+        lambda: get_rendition(img.full_size_path, img.full_size_checksum, spec),
+        checksum=spec.cache_name(img.full_size_checksum),
+        last_modified=img.modified,
+        content_type=image_format.content_type,
+    )
 
 
 @router.get(
@@ -145,20 +238,23 @@ def get_image_full_size(
     },
     operation_id="get_image_original",
 )
-@decorate_view(
-    condition(last_modified_func=image_last_modified, etag_func=original_image_etag),
-)
 def get_image_original(
-    request: HttpRequest,  # noqa: ARG001
+    request: HttpRequest,
     image_id: int,
 ):
-    img: Image = get_object_or_404(Image, id=image_id)
+    img = get_image_for_file(image_id, "original_checksum", "original")
 
     mimetype, _ = guess_type(img.original_path)
     if not mimetype:  # pragma: no cover
         mimetype = "image/jpeg"
 
-    return FileResponse(img.original_path.open(mode="rb"), content_type=mimetype)
+    return conditional_file_response(
+        request,
+        img.original_path,
+        checksum=img.original_checksum,
+        last_modified=img.modified,
+        content_type=mimetype,
+    )
 
 
 @router.delete(
@@ -443,6 +539,34 @@ async def update_image_metadata(
     return await get_image_metadata_common(img)
 
 
+@router.get(
+    "/{image_id}/similar/",
+    response={HTTPStatus.OK: list[SimilarImageSchema]},
+    openapi_extra={
+        "responses": {
+            HTTPStatus.NOT_FOUND: {
+                "description": "Not Found Response",
+            },
+        },
+    },
+    operation_id="get_similar_images",
+)
+def get_similar_images(
+    request: HttpRequest,  # noqa: ARG001
+    image_id: int,
+    max_distance: int = Query(DEFAULT_MAX_DISTANCE, ge=0, le=MAX_SEARCH_DISTANCE),
+):
+    """
+    Get the images which look nearly the same as this one, such as the same print scanned twice, closest first
+    """
+    img: Image = get_object_or_404(Image.objects.only("pk", "phash"), id=image_id)
+
+    return [
+        SimilarImageSchema(image_id=similar_id, distance=distance)
+        for similar_id, distance in find_similar_images(img, max_distance)
+    ]
+
+
 @router.get(
     "/{image_id}/albums/",
     response={HTTPStatus.OK: list[int]},
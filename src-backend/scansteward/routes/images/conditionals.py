@@ -1,39 +1,129 @@
 import datetime
+from calendar import timegm
+from collections.abc import Callable
+from pathlib import Path
 
+from blake3 import blake3
 from django.http import HttpRequest
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.http import quote_etag
 
+from scansteward.common.constants import WEBP_CONTENT_TYPE
 from scansteward.models import Image
+from scansteward.routes.images.files import file_response
+from scansteward.routes.images.files import multipart_files_response
+from scansteward.routes.images.ranges import if_range_matches
 
 
-def original_image_etag(request: HttpRequest, image_id: int) -> str:  # noqa: ARG001
+def get_image_for_file(image_id: int, *fields: str) -> Image:
     """
-    Returns an ETag for the specified image based on its ID.
+    Loads the Image for serving one of its files, with a single query for only the given columns, plus those
+    every file response needs.
 
     Args:
-        request (HttpRequest): The incoming HTTP request.
-        image_id (int): The ID of the image to generate an ETag for.
+        image_id (int): The ID of the image to load.
+        fields (str): The checksum column of the file, and any column its path is built from.
     Returns:
-        str: The generated ETag.
+        Image: The partially loaded Image.
+    Raises:
+        Http404: If there is no such Image.
     """
-    return Image.objects.get(pk=image_id).original_checksum
+    return get_object_or_404(Image.objects.only("pk", "modified", *fields), pk=image_id)
 
 
-def image_last_modified(request: HttpRequest, image_id: int) -> datetime.datetime:  # noqa: ARG001
+def conditional_file_response(
+    request: HttpRequest,
+    path: Path | Callable[[], Path],
+    *,
+    checksum: str,
+    last_modified: datetime.datetime,
+    content_type: str,
+) -> HttpResponse:
     """
-    Returns the last modified date for the specified image based on its ID.
+    Returns the file, or a Not Modified response if the client already has this version of it.  Only a file
+    which is actually sent is handed to the front server, when it serves them.  A Range is honoured unless its
+    If-Range names another version of the file, so a download can be resumed by asking for the rest.
+
+    This is what Django's condition() decorator does, but using the values the view already loaded, instead
+    of ETag and Last-Modified callbacks which each query the Image again.
+
+    Args:
+        request (HttpRequest): The incoming HTTP request.
+        path (Path | Callable[[], Path]): The file to send, or a callable returning it, which is only called if
+            the file is sent, for files created on demand.
+        checksum (str): The checksum of the file, which is its ETag.
+        last_modified (datetime.datetime): When the Image was last modified.
+        content_type (str): The content type of the file.
+    Returns:
+        HttpResponse: The file, or the response to the conditional request.
     """
-    return Image.objects.get(pk=image_id).modified
+    etag = quote_etag(checksum)
+    timestamp = timegm(last_modified.utctimetuple())
+    last_modified_date = http_date(timestamp)
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        range_header = request.headers.get("Range")
+        if request.method != "GET" or not if_range_matches(request, etag=etag, last_modified=last_modified_date):
+            range_header = None
+        response = file_response(path if isinstance(path, Path) else path(), content_type, range_header=range_header)
+
+    _set_validators(request, response, etag=etag, last_modified=last_modified_date)
+
+    return response
 
 
-def thumbnail_etag(request: HttpRequest, image_id: int) -> str:  # noqa: ARG001
+def conditional_thumbnails_response(request: HttpRequest, image_ids: list[int]) -> HttpResponse:
     """
-    Returns an ETag for the specified thumbnail based on its parent image ID.
+    Returns the thumbnails of the given Images as one multipart response, or a Not Modified response if the
+    client already has this version of the batch.  The Images are loaded with a single query.
+
+    The ETag of the batch is the hash of the Images and their thumbnail checksums, in order, so it changes when
+    any thumbnail does, and the client can cache the whole batch by it.
+
+    Args:
+        request (HttpRequest): The incoming HTTP request.
+        image_ids (list[int]): The IDs of the Images, in the order their thumbnails are to be sent.  Any which do
+            not exist are left out.
+    Returns:
+        HttpResponse: The thumbnails, or the response to the conditional request.
     """
-    return Image.objects.get(pk=image_id).thumbnail_checksum
+    found = Image.objects.only("pk", "modified", "thumbnail_checksum").in_bulk(image_ids)
+    images = [found[image_id] for image_id in dict.fromkeys(image_ids) if image_id in found]
+
+    etag = quote_etag(blake3("\n".join(f"{img.pk}:{img.thumbnail_checksum}" for img in images).encode()).hexdigest())
+    timestamp = timegm(max(img.modified for img in images).utctimetuple()) if images else None
+    last_modified_date = http_date(timestamp) if timestamp is not None else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = multipart_files_response(
+            [
+                (
+                    img.thumbnail_path,
+                    {
+                        "Content-Type": WEBP_CONTENT_TYPE,
+                        "Content-ID": f"<{img.pk}>",
+                        "ETag": quote_etag(img.thumbnail_checksum),
+                    },
+                )
+                for img in images
+            ],
+        )
+
+    _set_validators(request, response, etag=etag, last_modified=last_modified_date)
+
+    return response
 
 
-def full_size_etag(request: HttpRequest, image_id: int) -> str:  # noqa: ARG001
+def _set_validators(request: HttpRequest, response: HttpResponse, *, etag: str, last_modified: str | None) -> None:
     """
-    Returns an ETag for the specified full size image based on its parent image ID.
+    Like condition(), the validators are set on every response to a safe method, including Not Modified
     """
-    return Image.objects.get(pk=image_id).full_size_checksum
+    if request.method in ("GET", "HEAD"):
+        if last_modified is not None and not response.has_header("Last-Modified"):
+            response.headers["Last-Modified"] = last_modified
+        response.headers.setdefault("ETag", etag)
@@ -0,0 +1,107 @@
+import logging
+import secrets
+from collections.abc import Iterator
+from pathlib import Path
+from urllib.parse import quote
+
+from django.http import FileResponse
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+
+from scansteward.config import get_file_serving_settings
+from scansteward.config.types import FileServingChoices
+from scansteward.routes.images.ranges import parse_range_header
+from scansteward.routes.images.ranges import ranged_file_response
+
+logger = logging.getLogger(__name__)
+
+
+def file_response(path: Path, content_type: str, *, range_header: str | None = None) -> HttpResponse:
+    """
+    Returns a response which sends the given file, by the configured file serving.
+
+    With x-accel-redirect or x-sendfile, the response has no body, only a header naming the file, and the front
+    server sends the file itself, so no Python worker is held up copying bytes.  Any checks, such as
+    authorization or conditional requests, must already be done.  The front server also applies any Range of
+    the request itself, while Python serving sends only the requested ranges of the file.
+
+    For nginx, the prefix must be an internal location aliased to the file system root, for example:
+
+        location /internal/ {
+            internal;
+            alias /;
+        }
+
+    Args:
+        path (Path): The absolute path of the file.
+        content_type (str): The content type of the file.
+        range_header (str | None): The Range of the request, if it is to be applied.
+    Returns:
+        HttpResponse: The response sending the file.
+    """
+    settings = get_file_serving_settings()
+
+    if settings.file_serving == FileServingChoices.XAccelRedirect:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = quote(f"{settings.x_accel_redirect_prefix.rstrip('/')}{path.as_posix()}")
+        return response
+
+    if settings.file_serving == FileServingChoices.XSendfile:
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = str(path)
+        return response
+
+    if range_header is not None:
+        size = path.stat().st_size
+        ranges = parse_range_header(range_header, size)
+        if ranges is not None:
+            return ranged_file_response(path, content_type, ranges, size)
+
+    response = FileResponse(path.open(mode="rb"), content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _iter_parts(parts: list[tuple[bytes, Path]], closing: bytes) -> Iterator[bytes]:
+    for part_header, path in parts:
+        yield part_header
+        yield path.read_bytes()
+    yield closing
+
+
+def multipart_files_response(files: list[tuple[Path, dict[str, str]]]) -> StreamingHttpResponse:
+    """
+    Returns a multipart/mixed response with a part for each file, in the given order, streamed from Python
+    whatever the file serving, as a front server can only send a single file.
+
+    Each part has the given headers, and a Content-Length, so a client can split the parts without searching
+    for the boundary.  Files which do not exist are left out.  Meant for many small files, as each is read whole.
+
+    Args:
+        files (list[tuple[Path, dict[str, str]]]): Each file, with the headers of its part.
+    Returns:
+        StreamingHttpResponse: The response sending the files.
+    """
+    boundary = secrets.token_hex(16)
+    parts: list[tuple[bytes, Path]] = []
+    length = 0
+    for path, headers in files:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            logger.warning(f"Leaving out missing file {path}")
+            continue
+        lines = [f"--{boundary}", *(f"{name}: {value}" for name, value in headers.items()), f"Content-Length: {size}"]
+        # Each part after the first starts on a new line
+        part_header = (b"\r\n" if parts else b"") + ("\r\n".join(lines) + "\r\n\r\n").encode()
+        parts.append((part_header, path))
+        length += len(part_header) + size
+    closing = (b"\r\n" if parts else b"") + f"--{boundary}--\r\n".encode()
+    length += len(closing)
+
+    response = StreamingHttpResponse(
+        _iter_parts(parts, closing),
+        content_type=f"multipart/mixed; boundary={boundary}",
+    )
+    response["Content-Length"] = str(length)
+    return response
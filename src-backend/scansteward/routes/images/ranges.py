@@ -0,0 +1,167 @@
+import re
+import secrets
+from collections.abc import Iterator
+from http import HTTPStatus
+from pathlib import Path
+from typing import Final
+
+from django.http import HttpRequest
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+
+# More ranges than this in one request are not worth splitting the file for, so the whole file is sent instead
+MAX_RANGES: Final[int] = 50
+
+_CHUNK_SIZE: Final[int] = 64 * 1024
+
+_RANGE_SPEC: Final = re.compile(r"^(\d*)-(\d*)$")
+
+
+def parse_range_header(header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses a Range header into the byte ranges it asks for, from a file of the given size.
+
+    Args:
+        header (str): The value of the Range header.
+        size (int): The size of the file in bytes.
+    Returns:
+        list[tuple[int, int]] | None: The satisfiable ranges, as the first and last byte positions, in order
+            and with adjacent ranges merged.  Empty if no range is satisfiable.  None if the header is not a
+            valid byte range, asks for too many ranges, or asks for any byte more than once, and so should be
+            ignored.
+    """
+    unit, separator, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not separator:
+        return None
+
+    parts = [part.strip() for part in specs.split(",") if part.strip()]
+    if not parts or len(parts) > MAX_RANGES:
+        return None
+
+    ranges: list[tuple[int, int]] = []
+    for part in parts:
+        match = _RANGE_SPEC.match(part)
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+        first, last = match.groups()
+        if not first:
+            # A suffix, of the last so many bytes
+            length = int(last)
+            if length and size:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1]:
+            # Overlapping ranges would send the same bytes again, so many of them could send the file many times
+            return None
+        if merged and first == merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def if_range_matches(request: HttpRequest, *, etag: str, last_modified: str) -> bool:
+    """
+    Is the Range of the request to be applied?  Only if it has no If-Range, or its If-Range is the current ETag
+    or Last-Modified date exactly, as the client asks for the rest of a file it already has part of.
+
+    Args:
+        request (HttpRequest): The incoming HTTP request.
+        etag (str): The quoted ETag of the file.
+        last_modified (str): The Last-Modified HTTP date of the file.
+    Returns:
+        bool: True if the Range is to be applied, False if the whole file is to be sent.
+    """
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    # A weak ETag never matches, as the bytes may differ
+    if if_range.startswith(('"', "W/")):
+        return if_range == etag
+    return if_range == last_modified
+
+
+def _iter_file_segments(path: Path, segments: list[bytes | tuple[int, int]]) -> Iterator[bytes]:
+    """
+    Yields the given segments in order, reading byte ranges from the file and passing other bytes through
+    """
+    with path.open(mode="rb") as handle:
+        for segment in segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            first, last = segment
+            handle.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = handle.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+def ranged_file_response(
+    path: Path,
+    content_type: str,
+    ranges: list[tuple[int, int]],
+    size: int,
+) -> HttpResponse:
+    """
+    Returns the Partial Content response for the given ranges of the file, or Range Not Satisfiable if there are
+    none.  A single range is sent as is, more than one as multipart/byteranges.
+
+    Args:
+        path (Path): The file to send.
+        content_type (str): The content type of the file.
+        ranges (list[tuple[int, int]]): The first and last byte positions of each range, from parse_range_header.
+        size (int): The size of the file in bytes.
+    Returns:
+        HttpResponse: The response sending the ranges.
+    """
+    if not ranges:
+        response = HttpResponse(status=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response = StreamingHttpResponse(
+            _iter_file_segments(path, [(first, last)]),
+            status=HTTPStatus.PARTIAL_CONTENT,
+            content_type=content_type,
+        )
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+        response["Content-Length"] = str(last - first + 1)
+        return response
+
+    boundary = secrets.token_hex(16)
+    segments: list[bytes | tuple[int, int]] = []
+    length = 0
+    for index, (first, last) in enumerate(ranges):
+        # Each part after the first starts on a new line
+        part_header = (b"" if index == 0 else b"\r\n") + (
+            f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {first}-{last}/{size}\r\n\r\n"
+        ).encode()
+        segments.extend([part_header, (first, last)])
+        length += len(part_header) + last - first + 1
+    closing = f"\r\n--{boundary}--\r\n".encode()
+    segments.append(closing)
+    length += len(closing)
+
+    response = StreamingHttpResponse(
+        _iter_file_segments(path, segments),
+        status=HTTPStatus.PARTIAL_CONTENT,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+    )
+    response["Content-Length"] = str(length)
+    return response
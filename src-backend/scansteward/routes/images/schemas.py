@@ -49,3 +49,8 @@ class ImageMetadataUpdateInSchema(Schema):
 
     location_id: int | None = None
     date_id: int | None = None
+
+
+class SimilarImageSchema(Schema):
+    image_id: int = Field(description="Image ID")
+    distance: int = Field(description="Hamming distance between the perceptual hashes of the images")
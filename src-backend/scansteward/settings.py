@@ -19,6 +19,7 @@ DATA_DIR = BASE_DIR / "data"
 MEDIA_ROOT = BASE_DIR / "media"
 THUMBNAIL_DIR = MEDIA_ROOT / "thumbnails"
 FULL_SIZE_DIR = MEDIA_ROOT / "fullsize"
+RENDITION_DIR = MEDIA_ROOT / "renditions"
 
 LOGGING_DIR = DATA_DIR / "logs"
 
@@ -0,0 +1,87 @@
+import dataclasses
+import logging
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from scansteward.models import Image
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(slots=True)
+class _DirtyBatch:
+    image_ids: set[int] = dataclasses.field(default_factory=set)
+    queries: list[Q] = dataclasses.field(default_factory=list)
+
+    def query(self) -> Q | None:
+        parts = list(self.queries)
+        if self.image_ids:
+            parts.append(Q(pk__in=self.image_ids))
+        if not parts:
+            return None
+        return reduce(or_, parts)
+
+
+# A ContextVar rather than a thread local, so this also follows the async views into their sync ORM threads
+_current_batch: ContextVar[_DirtyBatch | None] = ContextVar("dirty_batch", default=None)
+
+
+@contextmanager
+def batch_dirty_marking() -> Iterator[None]:
+    """
+    Collects the dirty marking done by the signal handlers within the block, instead of running an UPDATE
+    for every signal.  When the outermost block exits normally, everything collected is applied with a
+    single UPDATE.  If the block raises, nothing is applied, as any changes are assumed to be rolled back.
+    Nested blocks join the outermost block.
+    """
+    if _current_batch.get() is not None:
+        yield
+        return
+
+    batch = _DirtyBatch()
+    token = _current_batch.set(batch)
+    try:
+        yield
+    finally:
+        _current_batch.reset(token)
+
+    query = batch.query()
+    if query is not None:
+        count = set_dirty(Image.objects.filter(query))
+        logger.debug(f"Marked {count} images as dirty")
+
+
+def set_dirty(images: QuerySet[Image]) -> int:
+    """
+    Immediately marks the given Images as dirty, recording when, so syncing can wait for them to settle
+    """
+    return images.update(is_dirty=True, dirtied_at=timezone.now())
+
+
+def mark_images_dirty(query: Q) -> None:
+    """
+    Marks the Images matching the query as dirty, or records them to be marked when the current batch ends
+    """
+    batch = _current_batch.get()
+    if batch is None:
+        set_dirty(Image.objects.filter(query))
+    else:
+        batch.queries.append(query)
+
+
+def mark_image_dirty(image_id: int) -> None:
+    """
+    Marks a single Image as dirty, or records it to be marked when the current batch ends
+    """
+    batch = _current_batch.get()
+    if batch is None:
+        set_dirty(Image.objects.filter(pk=image_id))
+    else:
+        batch.image_ids.add(image_id)
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import Q
 from django.dispatch import receiver
 
 from scansteward.models import Image
@@ -8,6 +9,9 @@ from scansteward.models import Pet
 from scansteward.models import RoughDate
 from scansteward.models import RoughLocation
 from scansteward.models import UserProfile
+from scansteward.signals.batching import mark_image_dirty
+from scansteward.signals.batching import mark_images_dirty
+from scansteward.signals.batching import set_dirty
 
 
 @receiver(models.signals.post_save, sender=User)
@@ -36,7 +40,7 @@ def mark_image_as_dirty(sender, instance: Image, **kwargs):  # noqa: ARG001
     """
 
     # Use update so this doesn't loop
-    Image.objects.filter(pk=instance.pk).update(is_dirty=True)
+    mark_image_dirty(instance.pk)
 
 
 # On change
@@ -49,17 +53,23 @@ def mark_images_as_dirty_on_m2m_change(
     sender: type[Pet | Person],  # noqa: ARG001
     instance: Pet | Person,
     *args,  # noqa: ARG001
-    **kwargs,  # noqa: ARG001
+    **kwargs,
 ):
     """
     Mark the image as dirty, ie, requiring a metadata sync to the file when various
     m2m relationships are changed
     """
-
     if isinstance(instance, Person):
-        Image.objects.filter(people__pk=instance.pk).update(is_dirty=True)
+        query = Q(people__pk=instance.pk)
     elif isinstance(instance, Pet):
-        Image.objects.filter(pets__pk=instance.pk).update(is_dirty=True)
+        query = Q(pets__pk=instance.pk)
+    else:  # pragma: no cover
+        return
+    # Before a delete, the relationship will be gone by the time a batch ends, so this cannot wait
+    if kwargs.get("signal") is models.signals.pre_delete:
+        set_dirty(Image.objects.filter(query))
+    else:
+        mark_images_dirty(query)
 
 
 # On change
@@ -72,10 +82,14 @@ def mark_images_as_dirty_on_fk_change(
     sender: type[RoughLocation | RoughDate],  # noqa: ARG001
     instance: RoughLocation | RoughDate,
     *args,  # noqa: ARG001
-    **kwargs,  # noqa: ARG001
+    **kwargs,
 ):
     """
     Mark the image as dirty, ie, requiring a metadata sync to the file when various
     foreign key relationships are changed
     """
-    instance.images.all().update(is_dirty=True)
+    # Before a delete, the relationship will be gone by the time a batch ends, so this cannot wait
+    if kwargs.get("signal") is models.signals.pre_delete:
+        set_dirty(instance.images.all())
+    else:
+        mark_images_dirty(Q(**{"location" if isinstance(instance, RoughLocation) else "date": instance}))
@@ -1,19 +1,47 @@
+import dataclasses
 import logging
+from datetime import datetime
 from datetime import timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from huey import crontab
 from huey.contrib.djhuey import db_periodic_task
 from huey.contrib.djhuey import db_task
 from huey.contrib.djhuey import lock_task
+from huey.contrib.djhuey import periodic_task
 
+from scansteward.config import get_image_ops_settings
+from scansteward.imageops.exiftool import get_exiftool_pool
+from scansteward.imageops.fingerprint import FileFingerprint
+from scansteward.imageops.fingerprint import find_unchanged_images
+from scansteward.imageops.fingerprint import save_fingerprints
+from scansteward.imageops.index import PreparedImage
+from scansteward.imageops.index import discard_prepared_images
 from scansteward.imageops.index import handle_existing_image
 from scansteward.imageops.index import handle_new_image
-from scansteward.imageops.metadata import bulk_write_image_metadata
+from scansteward.imageops.index import handle_new_images
+from scansteward.imageops.index import prepare_new_images
+from scansteward.imageops.ingest import IngestedImage
+from scansteward.imageops.ingest import ingest_image
+from scansteward.imageops.jobs import mark_items_done
+from scansteward.imageops.jobs import mark_items_failed
+from scansteward.imageops.locks import locked_files
+from scansteward.imageops.metadata import concurrent_write_image_metadata
 from scansteward.imageops.models import ImageMetadata
+from scansteward.imageops.renditions import evict_renditions
+from scansteward.imageops.sync import dirty_images
 from scansteward.imageops.sync import fill_image_metadata_from_db
+from scansteward.imageops.sync import iter_dirty_image_ids
+from scansteward.imageops.sync import load_sync_snapshots
 from scansteward.models import Image as ImageModel
+from scansteward.models import ImageSource
+from scansteward.models import IndexJobItem
+from scansteward.signals.batching import batch_dirty_marking
+from scansteward.tasks.models import ImageIndexBatchTaskModel
 from scansteward.tasks.models import ImageIndexTaskModel
 from scansteward.utils import calculate_blake3_hash
 
@@ -21,54 +49,328 @@ logger = logging.getLogger(__name__)
 
 
 @db_task()
-def sync_metadata_to_files(images: list[ImageModel]) -> None:
+def sync_metadata_to_files(first_pk: int, last_pk: int, dirtied_before: datetime | None = None) -> None:
     """
-    Syncs the metadata from the database to the image file for the given models
-
-    Models are assumed to be dirty already
+    Syncs the metadata from the database to the image file for the dirty images with a primary key in the
+    given range, inclusive.  If given a time, only images not marked dirty again since then are synced
     """
-    metadata_items = []
+    started = timezone.now()
+    images = list(dirty_images(dirtied_before=dirtied_before).filter(pk__range=(first_pk, last_pk)).order_by("pk"))
+    if not images:
+        return
+
+    # Everything written to the files is loaded up front, in a fixed number of queries
+    snapshots = load_sync_snapshots(image.pk for image in images)
+
+    to_write: list[tuple[ImageMetadata, ImageModel]] = []
+    synced: list[ImageModel] = []
     for image in images:
         try:
+            snapshot = snapshots[image.pk]
             metadata = ImageMetadata(
                 SourceFile=image.original_path,
-                ImageHeight=image.height,
-                ImageWidth=image.width,
+                ImageHeight=snapshot.height,
+                ImageWidth=snapshot.width,
             )
 
-            updated = fill_image_metadata_from_db(image, metadata)
+            updated = fill_image_metadata_from_db(snapshot, metadata)
 
             if updated:
-                metadata_items.append(metadata)
+                to_write.append((metadata, image))
+            else:
+                synced.append(image)
 
         except Exception:
             # Log the error with relevant image details
             logger.exception(f"Failed to process metadata for image {image.original_path}")
 
-    if metadata_items:
-        bulk_write_image_metadata(metadata_items)
-        for image in images:
-            image.update_hashes()
-            image.mark_as_clean()
+    written: list[ImageModel] = []
+    if to_write:
+        # Locked or failed files are not returned, and their images stay dirty for the next sync
+        written_metadata = {
+            id(metadata)
+            for metadata in concurrent_write_image_metadata(
+                [metadata for metadata, _ in to_write],
+                writers=get_image_ops_settings().sync_writers,
+            )
+        }
+        written = [image for metadata, image in to_write if id(metadata) in written_metadata]
+
+    if written:
+        # Only the written originals changed, and only their bytes, never their pixels.  So the phash and the
+        # derivatives are still correct, and only the originals need hashing again.  bulk_update sends no
+        # signals, so recording the checksums does not mark the images dirty again
+        fingerprints = []
+        for image in written:
+            fingerprint = FileFingerprint.from_path(image.original_path)
+            image.original_checksum = calculate_blake3_hash(fingerprint.path)
+            image.file_size = fingerprint.size
+            fingerprints.append((fingerprint, image))
+        ImageModel.objects.bulk_update(written, ["original_checksum", "file_size"])
+        # The next index run can then skip the written files without reading them
+        save_fingerprints(fingerprints, forget_copies=True)
+        synced.extend(written)
+
+    if synced:
+        # An image edited while this was writing stays dirty, for the next sync to pick up
+        ImageModel.objects.filter(pk__in=[image.pk for image in synced]).filter(
+            Q(dirtied_at__isnull=True) | Q(dirtied_at__lt=started),
+        ).update(is_dirty=False)
 
 
 @db_task()
-def index_single_image(pkg: ImageIndexTaskModel) -> None:
-    if not pkg.logger:
-        pkg.logger = logger
+def index_single_image(image_path: str, source_id: int | None = None, hash_threads: int = 4) -> None:
+    """
+    Indexes a single image.  Only the path and the id of the source are queued, the worker loads the source
+    """
+    source = ImageSource.objects.filter(pk=source_id).first() if source_id is not None else None
+    pkg = ImageIndexTaskModel(Path(image_path), hash_threads, source, logger)
 
-    pkg.logger.info(f"Indexing {pkg.image_path.stem}")
+    logger.info(f"Indexing {pkg.image_path.stem}")
 
     # Duplicate check
-    image_hash = calculate_blake3_hash(pkg.image_path, hash_threads=pkg.hash_threads)
+    ingested = ingest_image(pkg.image_path, hash_threads=pkg.hash_threads)
 
-    # Update or create
-    with transaction.atomic():
-        existing_image = ImageModel.objects.filter(original_checksum=image_hash).first()
-        if existing_image is not None:
+    # Update or create.  A new image does its slow work before opening its own transaction
+    existing_image = ImageModel.objects.filter(original_checksum=ingested.checksum).first()
+    if existing_image is not None:
+        with transaction.atomic():
             handle_existing_image(existing_image, pkg)
+    else:
+        handle_new_image(pkg, ingested)
+
+
+@db_task()
+def index_image_batch(job_item_ids: list[int], *, use_fingerprints: bool = True) -> None:
+    """
+    Indexes the given IndexJobItems as a single batch.
+
+    Only the ids are queued.  The worker loads the paths, along with the source and settings of their job,
+    with a single query
+    """
+    items = list(
+        IndexJobItem.objects.filter(pk__in=job_item_ids).select_related("job", "job__source").order_by("pk"),
+    )
+    if not items:
+        return
+    job = items[0].job
+    index_images(
+        ImageIndexBatchTaskModel(
+            [Path(item.path) for item in items],
+            job.hash_threads,
+            job.source,
+            logger,
+            use_fingerprints=use_fingerprints,
+            job_item_ids=[item.pk for item in items],
+        ),
+    )
+
+
+def index_images(pkg: ImageIndexBatchTaskModel) -> None:
+    """
+    Indexes a batch of images together.  Metadata for all new images is read with a single exiftool call
+    and the database is updated in one transaction, with the Image rows written in bulk.
+
+    If the batch fails as a whole, its images are indexed again one at a time, so whatever failed it only
+    fails its own image.  If the batch belongs to an IndexJob, its items are marked as done along with the
+    writes, or as failed with the error of their own image
+    """
+    if not pkg.logger:
+        pkg.logger = logger
+
+    try:
+        _index_image_batch(pkg)
+    except Exception as e:
+        if len(pkg.image_paths) == 1:
+            if pkg.job_item_ids:
+                mark_items_failed(pkg.job_item_ids, f"{type(e).__name__}: {e}")
+            raise
+        pkg.logger.exception(f"Failed to index a batch of {len(pkg.image_paths)} images, retrying them one at a time")
+    else:
+        return
+
+    last_error: Exception | None = None
+    for index, image_path in enumerate(pkg.image_paths):
+        single = dataclasses.replace(
+            pkg,
+            image_paths=[image_path],
+            job_item_ids=pkg.job_item_ids[index : index + 1],
+        )
+        try:
+            _index_image_batch(single)
+        except Exception as e:
+            pkg.logger.exception(f"Failed to index {image_path}")
+            if single.job_item_ids:
+                mark_items_failed(single.job_item_ids, f"{type(e).__name__}: {e}")
+            last_error = e
+    if last_error is not None and not pkg.job_item_ids:
+        # Without items to record the failures on, they must not pass silently
+        raise last_error
+
+
+def _index_image_batch(pkg: ImageIndexBatchTaskModel) -> None:
+    if TYPE_CHECKING:
+        assert pkg.logger is not None
+
+    pkg.logger.info(f"Indexing batch of {len(pkg.image_paths)} images")
+
+    # A file which cannot be indexed is recorded here with its error, and left out of the rest of the batch
+    failed: dict[Path, Exception] = {}
+
+    # Files which have not changed since they were indexed are skipped without being read
+    fingerprints: list[FileFingerprint] = []
+    for image_path in pkg.image_paths:
+        try:
+            fingerprints.append(FileFingerprint.from_path(image_path))
+        except OSError as e:
+            pkg.logger.exception(f"Unable to index {image_path}")
+            failed[image_path.resolve()] = e
+    if pkg.use_fingerprints:
+        unchanged, fingerprints = find_unchanged_images(fingerprints)
+    else:
+        unchanged = {}
+    if unchanged:
+        pkg.logger.info(f"Skipping {len(unchanged)} unchanged images")
+
+    # The files are locked while they are read, so a sync cannot write to them at the same time
+    with locked_files([fingerprint.path for fingerprint in fingerprints]):
+        # Duplicate check.  Each file is hashed in place, its contents are never held in memory
+        ingested_images: list[tuple[FileFingerprint, IngestedImage]] = []
+        for fingerprint in fingerprints:
+            try:
+                ingested_images.append((fingerprint, ingest_image(fingerprint.path, hash_threads=pkg.hash_threads)))
+            except OSError as e:
+                pkg.logger.exception(f"Unable to read {fingerprint.path}")
+                failed[fingerprint.path] = e
+
+        existing_images = {
+            existing.original_checksum: existing
+            for existing in ImageModel.objects.filter(
+                original_checksum__in=[ingested.checksum for _, ingested in ingested_images],
+            )
+        }
+
+        new_images: dict[str, tuple[FileFingerprint, IngestedImage]] = {}
+        existing: list[tuple[FileFingerprint, ImageModel]] = []
+        # Copies of new images, by the checksum they share
+        duplicates: list[tuple[FileFingerprint, str]] = []
+        for fingerprint, ingested in ingested_images:
+            if ingested.checksum in existing_images:
+                existing.append((fingerprint, existing_images[ingested.checksum]))
+            elif ingested.checksum in new_images:
+                pkg.logger.warning(f"Skipping {ingested.path}, it is a duplicate of another image in this batch")
+                duplicates.append((fingerprint, ingested.checksum))
+            else:
+                new_images[ingested.checksum] = (fingerprint, ingested)
+        # Read the metadata and create the derivatives before the transaction, so it is only held for the writes
+        prepared: list[PreparedImage] = []
+        if new_images:
+            prepared, failed_new = prepare_new_images(pkg, [ingested for _, ingested in new_images.values()])
+            failed.update(failed_new)
+
+    try:
+        # Any dirty marking from the saves is applied with one UPDATE at the end
+        with transaction.atomic(), batch_dirty_marking():
+            for image_path, unchanged_image in unchanged.items():
+                # An unchanged copy is left alone, unless the original it copies is gone, so the Image moved here
+                moved = image_path != unchanged_image.original_path and not unchanged_image.original_path.exists()
+                if moved or (pkg.source is not None and unchanged_image.source != pkg.source):
+                    handle_existing_image(
+                        unchanged_image,
+                        ImageIndexTaskModel(
+                            image_path if moved else unchanged_image.original_path,
+                            pkg.hash_threads,
+                            pkg.source,
+                            pkg.logger,
+                        ),
+                    )
+            for fingerprint, existing_image in existing:
+                pkg.logger.info(f"Indexing {fingerprint.path.stem}")
+                handle_existing_image(
+                    existing_image,
+                    ImageIndexTaskModel(fingerprint.path, pkg.hash_threads, pkg.source, pkg.logger),
+                )
+            created = handle_new_images(pkg, prepared) if prepared else []
+            created_by_checksum = {
+                item.original_checksum: new_image for item, new_image in zip(prepared, created, strict=True)
+            }
+            save_fingerprints(
+                [
+                    *existing,
+                    *((new_images[checksum][0], new_image) for checksum, new_image in created_by_checksum.items()),
+                    # So the copies are skipped too, rather than read again on every run
+                    *(
+                        (fingerprint, created_by_checksum[checksum])
+                        for fingerprint, checksum in duplicates
+                        if checksum in created_by_checksum
+                    ),
+                ],
+            )
+            if pkg.job_item_ids:
+                mark_batch_items(pkg, failed)
+    except Exception:
+        discard_prepared_images(prepared)
+        # Anything created in the transaction is gone now
+        if pkg.tag_resolver is not None:
+            pkg.tag_resolver.clear()
+        if pkg.entity_cache is not None:
+            pkg.entity_cache.clear()
+        raise
+
+    if failed:
+        pkg.logger.warning(f"Failed to index {len(failed)} of {len(pkg.image_paths)} images in the batch")
+
+
+def mark_batch_items(pkg: ImageIndexBatchTaskModel, failed: dict[Path, Exception]) -> None:
+    """
+    Marks the IndexJobItems of the batch as done, except those of the files which failed, which are marked
+    as failed with their own error
+    """
+    done: list[int] = []
+    for image_path, item_id in zip(pkg.image_paths, pkg.job_item_ids, strict=True):
+        error = failed.get(image_path.resolve())
+        if error is None:
+            done.append(item_id)
         else:
-            handle_new_image(pkg)
+            mark_items_failed([item_id], f"{type(error).__name__}: {error}")
+    mark_items_done(done)
+
+
+@db_periodic_task(crontab(minute="*"))
+@lock_task("auto-sync")
+def auto_sync_dirty_images() -> None:
+    """
+    Syncs the images which have been dirty, and left alone, for at least the configured delay.  A burst of
+    edits is then written once it settles, in a few large batches, rather than never or once per edit
+    """
+    settings = get_image_ops_settings()
+    if not settings.auto_sync:
+        return
+    dirtied_before = timezone.now() - timedelta(seconds=settings.auto_sync_delay)
+    for image_ids in iter_dirty_image_ids(settings.sync_batch_size, dirtied_before=dirtied_before):
+        try:
+            sync_metadata_to_files.call_local(image_ids[0], image_ids[-1], dirtied_before)
+        except Exception:
+            # The images stay dirty to be tried again on the next run, the later batches still get their turn
+            logger.exception(f"Failed to sync images {image_ids[0]} to {image_ids[-1]}")
+
+
+@periodic_task(crontab(minute="*/5"))
+def check_exiftool_health() -> None:
+    """
+    Restarts any idle exiftool process of this worker which no longer answers.  A process which hangs while in
+    use is caught by the timeout of the command instead
+    """
+    get_exiftool_pool().check_health()
+
+
+@periodic_task(crontab(minute="*/10"))
+@lock_task("rendition-evict")
+def evict_cached_renditions() -> None:
+    """
+    Keeps the cached renditions within the configured size, deleting the least recently used
+    """
+    evict_renditions(get_image_ops_settings().rendition_cache_bytes)
 
 
 @db_periodic_task(crontab(minute="0", hour="0"))
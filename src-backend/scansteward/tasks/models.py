@@ -1,9 +1,15 @@
 from dataclasses import dataclass
+from dataclasses import field
 from logging import Logger
 from pathlib import Path
 
+from scansteward.imageops.resolvers import EntityCache
+from scansteward.imageops.resolvers import TagTreeResolver
 from scansteward.models import ImageSource
 
+# These hold the in process state of indexing and are never queued themselves.  The tasks are queued with
+# ids and paths only, and build these once they have loaded fresh data
+
 
 @dataclass(slots=True)
 class ImageIndexTaskModel:
@@ -11,3 +17,17 @@ class ImageIndexTaskModel:
     hash_threads: int = 4
     source: ImageSource | None = None
     logger: Logger | None = None
+
+
+@dataclass(slots=True)
+class ImageIndexBatchTaskModel:
+    image_paths: list[Path]
+    hash_threads: int = 4
+    source: ImageSource | None = None
+    logger: Logger | None = None
+    use_fingerprints: bool = True
+    # Shared between batches when indexing in process, otherwise each batch loads its own
+    tag_resolver: TagTreeResolver | None = None
+    entity_cache: EntityCache | None = None
+    # The IndexJobItems of these paths, updated once the batch is done or has failed
+    job_item_ids: list[int] = field(default_factory=list)
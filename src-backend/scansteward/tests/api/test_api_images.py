@@ -1,11 +1,22 @@
 import datetime
+import os
 from http import HTTPStatus
+from io import BytesIO
+from unittest import mock
 
 import pytest
 from django.test.client import Client
 from django.utils import timezone
+from PIL import Image as PILImage
 
+from scansteward.config.settings import FileServingSettings
+from scansteward.config.settings import ImageOpsSettings
+from scansteward.config.types import FileServingChoices
 from scansteward.imageops.models import RotationEnum
+from scansteward.imageops.renditions import RenditionSpec
+from scansteward.imageops.renditions import generate_rendition
+from scansteward.imageops.similarity import get_phash_index
+from scansteward.imageops.similarity import warm_phash_index
 from scansteward.models import Album
 from scansteward.models import Image
 from scansteward.models import ImageInAlbum
@@ -15,6 +26,7 @@ from scansteward.models import Pet
 from scansteward.models import PetInImage
 from scansteward.models import RoughDate
 from scansteward.models import RoughLocation
+from scansteward.tasks.images import evict_cached_renditions
 from scansteward.tests.mixins import FileSystemAssertsMixin
 
 
@@ -69,6 +81,379 @@ class TestImageFileReads(FileSystemAssertsMixin):
 
         self.assertFileContents(img.original_path, original_data)
 
+    @pytest.mark.parametrize(
+        ("endpoint", "checksum_field"),
+        [
+            ("thumbnail", "thumbnail_checksum"),
+            ("full", "full_size_checksum"),
+            ("original", "original_checksum"),
+        ],
+    )
+    def test_image_file_single_query(
+        self,
+        client: Client,
+        django_assert_num_queries,
+        endpoint: str,
+        checksum_field: str,
+    ):
+        img = Image.objects.get(pk=1)
+
+        with django_assert_num_queries(1):
+            resp = client.get(f"/api/image/{img.pk}/{endpoint}/")
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp["ETag"] == f'"{getattr(img, checksum_field)}"'
+        resp.close()
+
+    def test_image_file_not_modified(self, client: Client, django_assert_num_queries):
+        img = Image.objects.get(pk=1)
+
+        with django_assert_num_queries(1):
+            resp = client.get(
+                f"/api/image/{img.pk}/thumbnail/",
+                headers={"If-None-Match": f'"{img.thumbnail_checksum}"'},
+            )
+
+        assert resp.status_code == HTTPStatus.NOT_MODIFIED
+        assert resp["ETag"] == f'"{img.thumbnail_checksum}"'
+        assert resp["Last-Modified"] == img.modified.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+        resp = client.get(
+            f"/api/image/{img.pk}/full/",
+            headers={"If-Modified-Since": img.modified.strftime("%a, %d %b %Y %H:%M:%S GMT")},
+        )
+
+        assert resp.status_code == HTTPStatus.NOT_MODIFIED
+
+        # A different version of the file is sent in full
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"If-None-Match": '"not-the-checksum"'})
+
+        assert resp.status_code == HTTPStatus.OK
+        self.assertFileContents(img.original_path, b"".join(resp.streaming_content))
+
+    def test_image_file_x_accel_redirect(self, client: Client):
+        img = Image.objects.get(pk=1)
+
+        with mock.patch(
+            "scansteward.routes.images.files.get_file_serving_settings",
+            return_value=FileServingSettings(file_serving=FileServingChoices.XAccelRedirect),
+        ):
+            resp = client.get(f"/api/image/{img.pk}/thumbnail/")
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp["Content-Type"] == "image/webp"
+        assert resp["X-Accel-Redirect"] == f"/internal{img.thumbnail_path.as_posix()}"
+        assert resp["ETag"] == f'"{img.thumbnail_checksum}"'
+        assert resp.content == b""
+
+    def test_image_file_x_sendfile(self, client: Client):
+        img = Image.objects.get(pk=1)
+
+        with mock.patch(
+            "scansteward.routes.images.files.get_file_serving_settings",
+            return_value=FileServingSettings(file_serving=FileServingChoices.XSendfile),
+        ):
+            resp = client.get(f"/api/image/{img.pk}/original/")
+            not_modified = client.get(
+                f"/api/image/{img.pk}/original/",
+                headers={"If-None-Match": f'"{img.original_checksum}"'},
+            )
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp["Content-Type"] == "image/jpeg"
+        assert resp["X-Sendfile"] == str(img.original_path)
+        assert resp.content == b""
+
+        # The front server is only asked to send files which are needed
+        assert not_modified.status_code == HTTPStatus.NOT_MODIFIED
+        assert not not_modified.has_header("X-Sendfile")
+
+    def test_image_file_range(self, client: Client):
+        img = Image.objects.get(pk=1)
+        data = img.original_path.read_bytes()
+
+        resp = client.get(f"/api/image/{img.pk}/original/")
+        assert resp["Accept-Ranges"] == "bytes"
+        resp.close()
+
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": "bytes=100-199"})
+
+        assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+        assert resp["Content-Range"] == f"bytes 100-199/{len(data)}"
+        assert resp["Content-Length"] == "100"
+        assert resp["ETag"] == f'"{img.original_checksum}"'
+        assert b"".join(resp.streaming_content) == data[100:200]
+
+        # The rest of the file, from a resumed download
+        resp = client.get(
+            f"/api/image/{img.pk}/original/",
+            headers={"Range": "bytes=1000-", "If-Range": f'"{img.original_checksum}"'},
+        )
+
+        assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+        assert b"".join(resp.streaming_content) == data[1000:]
+
+        # The last bytes
+        resp = client.get(f"/api/image/{img.pk}/full/", headers={"Range": "bytes=-10"})
+
+        assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+        assert b"".join(resp.streaming_content) == img.full_size_path.read_bytes()[-10:]
+
+    def test_image_file_multiple_ranges(self, client: Client):
+        img = Image.objects.get(pk=1)
+        data = img.original_path.read_bytes()
+
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": "bytes=0-9, 50-59"})
+
+        assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+        content_type, boundary = resp["Content-Type"].split("; boundary=")
+        assert content_type == "multipart/byteranges"
+
+        body = b"".join(resp.streaming_content)
+        assert resp["Content-Length"] == str(len(body))
+        assert body == (
+            f"--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Range: bytes 0-9/{len(data)}\r\n\r\n".encode()
+            + data[0:10]
+            + f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Range: bytes 50-59/{len(data)}\r\n\r\n".encode()
+            + data[50:60]
+            + f"\r\n--{boundary}--\r\n".encode()
+        )
+
+    def test_image_file_adjacent_ranges_merged(self, client: Client):
+        img = Image.objects.get(pk=1)
+        data = img.original_path.read_bytes()
+
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": "bytes=50-59, 0-9, 10-49"})
+
+        assert resp.status_code == HTTPStatus.PARTIAL_CONTENT
+        assert resp["Content-Range"] == f"bytes 0-59/{len(data)}"
+        assert b"".join(resp.streaming_content) == data[0:60]
+
+    @pytest.mark.parametrize(
+        "ranges",
+        [
+            pytest.param("0-9, 5-14", id="overlapping"),
+            pytest.param("100-199, 0-, -10", id="contained"),
+            pytest.param(", ".join(["0-"] * 50), id="repeated"),
+        ],
+    )
+    def test_image_file_overlapping_ranges_ignored(self, client: Client, ranges: str):
+        img = Image.objects.get(pk=1)
+        data = img.original_path.read_bytes()
+
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": f"bytes={ranges}"})
+
+        assert resp.status_code == HTTPStatus.OK
+        assert b"".join(resp.streaming_content) == data
+
+    def test_image_file_range_not_applied(self, client: Client):
+        img = Image.objects.get(pk=1)
+        data = img.original_path.read_bytes()
+
+        # The client has part of another version of the file, so it needs all of this one
+        resp = client.get(
+            f"/api/image/{img.pk}/original/",
+            headers={"Range": "bytes=100-199", "If-Range": '"another-version"'},
+        )
+
+        assert resp.status_code == HTTPStatus.OK
+        assert b"".join(resp.streaming_content) == data
+
+        # A Range which cannot be parsed is ignored
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": "bytes=199-100"})
+
+        assert resp.status_code == HTTPStatus.OK
+        assert b"".join(resp.streaming_content) == data
+
+        resp = client.get(f"/api/image/{img.pk}/original/", headers={"Range": f"bytes={len(data)}-"})
+
+        assert resp.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        assert resp["Content-Range"] == f"bytes */{len(data)}"
+
+    def test_image_file_not_found(self, client: Client):
+        resp = client.get("/api/image/99/thumbnail/")
+
+        assert resp.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.usefixtures("sample_image_environment")
+@pytest.mark.django_db
+class TestImageThumbnailBatch:
+    @staticmethod
+    def split_parts(resp) -> list[tuple[dict[str, str], bytes]]:
+        content_type, boundary = resp["Content-Type"].split("; boundary=")
+        assert content_type == "multipart/mixed"
+        body = b"".join(resp.streaming_content)
+        assert resp["Content-Length"] == str(len(body))
+        assert body.endswith(f"--{boundary}--\r\n".encode())
+
+        parts = []
+        for raw in body.split(f"--{boundary}".encode())[1:-1]:
+            head, data = raw.removeprefix(b"\r\n").split(b"\r\n\r\n", 1)
+            headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+            data = data.removesuffix(b"\r\n")
+            assert headers["Content-Length"] == str(len(data))
+            parts.append((headers, data))
+        return parts
+
+    def test_thumbnail_batch(self, client: Client, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            resp = client.get("/api/image/thumbnails/", data={"ids": "3,1,99,3"})
+
+        assert resp.status_code == HTTPStatus.OK
+
+        parts = self.split_parts(resp)
+        # In the order requested, once each, without the missing image
+        assert [headers["Content-ID"] for headers, _ in parts] == ["<3>", "<1>"]
+        for (headers, data), image_id in zip(parts, [3, 1], strict=True):
+            img = Image.objects.get(pk=image_id)
+            assert headers["Content-Type"] == "image/webp"
+            assert headers["ETag"] == f'"{img.thumbnail_checksum}"'
+            assert data == img.thumbnail_path.read_bytes()
+
+    def test_thumbnail_batch_not_modified(self, client: Client):
+        resp = client.get("/api/image/thumbnails/", data={"ids": "1,2"})
+        etag = resp["ETag"]
+        resp.close()
+
+        resp = client.get("/api/image/thumbnails/", data={"ids": "1,2"}, headers={"If-None-Match": etag})
+
+        assert resp.status_code == HTTPStatus.NOT_MODIFIED
+
+        # Another batch is another version
+        resp = client.get("/api/image/thumbnails/", data={"ids": "2,1"}, headers={"If-None-Match": etag})
+
+        assert resp.status_code == HTTPStatus.OK
+        resp.close()
+
+        # As is a changed thumbnail
+        Image.objects.filter(pk=2).update(thumbnail_checksum="changed")
+
+        resp = client.get("/api/image/thumbnails/", data={"ids": "1,2"}, headers={"If-None-Match": etag})
+
+        assert resp.status_code == HTTPStatus.OK
+        resp.close()
+
+    def test_thumbnail_batch_too_large(self, client: Client):
+        resp = client.get("/api/image/thumbnails/", data={"ids": ",".join(str(x) for x in range(1, 102))})
+
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.usefixtures("sample_image_environment")
+@pytest.mark.django_db
+class TestImageRenditionApi:
+    def test_rendition_width(self, client: Client, settings):
+        img = Image.objects.get(pk=1)
+        with PILImage.open(img.full_size_path) as im_file:
+            full_width, full_height = im_file.size
+
+        resp = client.get("/api/image/1/rendition/", data={"width": 100})
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp["Content-Type"] == "image/webp"
+        with PILImage.open(BytesIO(b"".join(resp.streaming_content))) as im_file:
+            assert im_file.format == "WEBP"
+            assert im_file.width == 100
+            assert im_file.height == round(full_height * 100 / full_width)
+        resp.close()
+
+        assert (settings.RENDITION_DIR / img.full_size_checksum[:2]).is_dir()
+
+    def test_rendition_height_jpeg(self, client: Client):
+        resp = client.get("/api/image/2/rendition/", data={"height": 64, "format": "jpeg", "quality": 50})
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp["Content-Type"] == "image/jpeg"
+        with PILImage.open(BytesIO(b"".join(resp.streaming_content))) as im_file:
+            assert im_file.format == "JPEG"
+            assert im_file.height == 64
+        resp.close()
+
+    def test_rendition_cached(self, client: Client):
+        with mock.patch(
+            "scansteward.imageops.renditions.generate_rendition",
+            wraps=generate_rendition,
+        ) as generate_mock:
+            resp = client.get("/api/image/1/rendition/", data={"width": 80})
+            first = b"".join(resp.streaming_content)
+            resp.close()
+
+            resp = client.get("/api/image/1/rendition/", data={"width": 80})
+            second = b"".join(resp.streaming_content)
+            resp.close()
+
+            assert generate_mock.call_count == 1
+            assert first == second
+
+            # Any other size is another rendition
+            resp = client.get("/api/image/1/rendition/", data={"width": 81})
+            resp.close()
+
+            assert generate_mock.call_count == 2
+
+    def test_rendition_not_modified(self, client: Client):
+        resp = client.get("/api/image/1/rendition/", data={"width": 80})
+        etag = resp["ETag"]
+        resp.close()
+
+        with mock.patch("scansteward.imageops.renditions.get_rendition") as rendition_mock:
+            resp = client.get("/api/image/1/rendition/", data={"width": 80}, headers={"If-None-Match": etag})
+
+            assert resp.status_code == HTTPStatus.NOT_MODIFIED
+            # The rendition is not even looked for
+            rendition_mock.assert_not_called()
+
+        # Another size is another version
+        resp = client.get("/api/image/1/rendition/", data={"width": 90}, headers={"If-None-Match": etag})
+
+        assert resp.status_code == HTTPStatus.OK
+        resp.close()
+
+    def test_rendition_evicts_least_recently_used(self, client: Client, settings):
+        img = Image.objects.get(pk=1)
+        for width in (50, 60, 70):
+            resp = client.get("/api/image/1/rendition/", data={"width": width})
+            resp.close()
+
+        old = RenditionSpec(50, None).cache_path(img.full_size_checksum)
+        recent = RenditionSpec(60, None).cache_path(img.full_size_checksum)
+        newest = RenditionSpec(70, None).cache_path(img.full_size_checksum)
+        os.utime(old, (0, 0))
+        os.utime(recent, (1000, 1000))
+
+        # Room for only the two newest
+        budget = recent.stat().st_size + newest.stat().st_size
+        with mock.patch(
+            "scansteward.tasks.images.get_image_ops_settings",
+            return_value=ImageOpsSettings(rendition_cache_bytes=budget),
+        ):
+            evict_cached_renditions.call_local()
+
+        assert not old.exists()
+        assert recent.exists()
+        assert newest.exists()
+        assert not list(settings.RENDITION_DIR.glob("*/*.tmp"))
+
+    def test_rendition_no_size(self, client: Client):
+        resp = client.get("/api/image/1/rendition/")
+
+        assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_rendition_bad_parameters(self, client: Client):
+        resp = client.get("/api/image/1/rendition/", data={"width": 0})
+
+        assert resp.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+        resp = client.get("/api/image/1/rendition/", data={"width": 100, "format": "gif"})
+
+        assert resp.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+    def test_rendition_not_found(self, client: Client):
+        resp = client.get("/api/image/99/rendition/", data={"width": 100})
+
+        assert resp.status_code == HTTPStatus.NOT_FOUND
+
 
 @pytest.mark.usefixtures("sample_image_environment")
 @pytest.mark.django_db
@@ -305,6 +690,87 @@ class TestImageReadWithFiltersApi:
         assert resp.json() == {"count": 3, "items": [1, 2, 3]}
 
 
+@pytest.mark.usefixtures("sample_image_database")
+@pytest.mark.django_db
+class TestImageSimilarApi:
+    @staticmethod
+    def set_near_copy(image_id: int, phash: str, bits: int) -> None:
+        Image.objects.filter(pk=image_id).update(phash=f"{int(phash, 16) ^ bits:016x}")
+
+    def test_no_similar_images(self, client: Client):
+        resp = client.get("/api/image/1/similar/")
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.json() == []
+
+    def test_similar_images_closest_first(self, client: Client):
+        img = Image.objects.get(pk=1)
+        self.set_near_copy(3, img.phash, 0b1)
+        self.set_near_copy(2, img.phash, 0b1111)
+
+        resp = client.get("/api/image/1/similar/")
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.json() == [{"image_id": 3, "distance": 1}, {"image_id": 2, "distance": 4}]
+
+        resp = client.get("/api/image/1/similar/", data={"max_distance": 2})
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.json() == [{"image_id": 3, "distance": 1}]
+
+    def test_similar_images_after_index(self, client: Client):
+        img = Image.objects.get(pk=1)
+
+        resp = client.get("/api/image/1/similar/")
+        assert resp.json() == []
+
+        # An image indexed after the first search is found too
+        new_img = Image.objects.get(pk=4)
+        new_img.pk = None
+        new_img.original = "/new/rescan.jpg"
+        new_img.original_checksum = new_img.thumbnail_checksum = new_img.full_size_checksum = "rescan"
+        new_img.phash = f"{int(img.phash, 16) ^ 0b11:016x}"
+        new_img.save()
+
+        resp = client.get("/api/image/1/similar/")
+
+        assert resp.json() == [{"image_id": new_img.pk, "distance": 2}]
+
+    def test_similar_images_skips_deleted(self, client: Client):
+        img = Image.objects.get(pk=1)
+        self.set_near_copy(2, img.phash, 0b1)
+        Image.objects.filter(pk=2).update(deleted_at=timezone.now())
+
+        resp = client.get("/api/image/1/similar/")
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.json() == []
+
+    def test_similar_images_bad_distance(self, client: Client):
+        resp = client.get("/api/image/1/similar/", data={"max_distance": 64})
+
+        assert resp.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+    def test_similar_images_not_found(self, client: Client):
+        resp = client.get("/api/image/99/similar/")
+
+        assert resp.status_code == HTTPStatus.NOT_FOUND
+
+    def test_similar_images_warmed_index(self, client: Client):
+        warm_phash_index()
+
+        assert len(get_phash_index()) == Image.objects.count()
+
+        # The search only loads Images indexed after the warm up, of which there are none
+        with mock.patch("scansteward.imageops.similarity.PhashIndex._add") as add:
+            resp = client.get("/api/image/1/similar/")
+
+        add.assert_not_called()
+
+        assert resp.status_code == HTTPStatus.OK
+        assert resp.json() == []
+
+
 @pytest.mark.usefixtures("sample_image_environment")
 @pytest.mark.django_db
 class TestImageUpdateApi:
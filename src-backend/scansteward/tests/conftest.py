@@ -6,6 +6,7 @@ import pytest
 from django.core.management import call_command
 from django.db import models
 
+from scansteward.imageops.similarity import get_phash_index
 from scansteward.models import Image
 from scansteward.models import Person
 from scansteward.models import Pet
@@ -29,6 +30,16 @@ def _seed_random():
     random.seed(0)
 
 
+@pytest.fixture(autouse=True)
+def _clear_phash_index():
+    """
+    The similarity index lives as long as the process, but every test has its own database
+    """
+    get_phash_index.cache_clear()
+    yield
+    get_phash_index.cache_clear()
+
+
 @pytest.fixture(scope="session")
 def api_base_url() -> str:
     return "/api/"
@@ -227,6 +238,7 @@ def _django_directories_settings_override(django_directories: DjangoDirectories,
     settings.MEDIA_ROOT = django_directories.media_dir
     settings.THUMBNAIL_DIR = django_directories.thumbnail_dir
     settings.FULL_SIZE_DIR = django_directories.full_size_dir
+    settings.RENDITION_DIR = django_directories.rendition_dir
 
 
 @pytest.fixture(name="sample_image_database")
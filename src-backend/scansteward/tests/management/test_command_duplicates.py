@@ -0,0 +1,47 @@
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from scansteward.models import Image
+
+
+def flip_bits(phash: str, bits: int) -> str:
+    return f"{int(phash, 16) ^ bits:016x}"
+
+
+@pytest.mark.usefixtures("sample_image_database")
+@pytest.mark.django_db
+class TestDuplicatesCommand:
+    def test_no_duplicates(self):
+        stdout = StringIO()
+
+        call_command("duplicates", stdout=stdout)
+
+        assert stdout.getvalue() == ""
+
+    def test_groups_rescans(self):
+        first = Image.objects.get(pk=1)
+        # A rescan of the first image, a few bits away, and a rescan of that, a few more bits on
+        Image.objects.filter(pk=2).update(phash=flip_bits(first.phash, 0b111))
+        Image.objects.filter(pk=4).update(phash=flip_bits(first.phash, 0b111_1110_0000))
+
+        stdout = StringIO()
+        call_command("duplicates", stdout=stdout)
+
+        assert stdout.getvalue().splitlines() == ["1 2 4"]
+
+        stdout = StringIO()
+        call_command("duplicates", "--max-distance", "3", stdout=stdout)
+
+        assert stdout.getvalue().splitlines() == ["1 2"]
+
+    def test_skips_deleted(self):
+        first = Image.objects.get(pk=1)
+        Image.objects.filter(pk=2).update(phash=flip_bits(first.phash, 0b1), deleted_at=timezone.now())
+
+        stdout = StringIO()
+        call_command("duplicates", stdout=stdout)
+
+        assert stdout.getvalue() == ""
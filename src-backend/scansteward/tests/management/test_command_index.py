@@ -1,20 +1,49 @@
+import os
 import shutil
 from pathlib import Path
+from unittest import mock
 
 import pytest
+from django.conf import settings
 from django.core.management import call_command
-
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage
+
+from scansteward.imageops.index import handle_new_images
+from scansteward.imageops.ingest import ingest_image
+from scansteward.imageops.metadata import iter_image_metadata
 from scansteward.imageops.metadata import read_image_metadata
 from scansteward.imageops.metadata import write_image_metadata
 from scansteward.models import Image
+from scansteward.models import ImageFingerprint
+from scansteward.models import ImageSource
+from scansteward.models import IndexJob
+from scansteward.models import IndexJobItem
 from scansteward.models import Person
 from scansteward.models import PersonInImage
 from scansteward.models import Pet
 from scansteward.models import Tag
 from scansteward.models import TagOnImage
+from scansteward.tasks.images import index_image_batch
+from scansteward.tasks.images import index_single_image
+from scansteward.tests.types import DjangoDirectories
+from scansteward.utils import calculate_blake3_hash
+from scansteward.utils import calculate_image_phash
+
+
+@pytest.fixture()
+def django_directories(tmp_path_factory: pytest.TempPathFactory) -> DjangoDirectories:
+    """
+    The images being indexed live in tmp_path, so keep the generated files out of it
+    """
+    return DjangoDirectories(base_dir=tmp_path_factory.mktemp("django"))
 
 
 @pytest.mark.django_db
+@pytest.mark.usefixtures("django_directories_override")
 class TestIndexCommand:
     def test_call_command_no_files(self, tmp_path: Path):
         call_command("index", str(tmp_path))
@@ -124,6 +153,41 @@ class TestIndexCommand:
         # Only in 1 image
         assert Person.objects.filter(name="Hillary Clinton").first().images.count() == 1
 
+    @pytest.mark.parametrize("batch_size", [1, 3])
+    def test_index_command_batch_sizes(self, all_samples_copy: tuple[Path, list[Path]], batch_size: int):
+        base_dir, sample_images = all_samples_copy
+
+        call_command("index", str(base_dir), "--batch-size", str(batch_size))
+
+        assert Image.objects.count() == len(sample_images)
+        assert Person.objects.count() == 4
+        assert Person.objects.filter(name="Barack Obama").first().images.count() == 4
+        # Indexing never leaves images dirty
+        assert not Image.objects.filter(is_dirty=True).exists()
+        for img in Image.objects.all():
+            assert img.thumbnail_path.is_file()
+            assert img.full_size_path.is_file()
+            assert img.thumbnail_checksum != img.original_checksum
+            assert img.full_size_checksum != img.original_checksum
+            assert img.phash == calculate_image_phash(img.original_path)
+            assert img.thumbnail_checksum == calculate_blake3_hash(img.thumbnail_path)
+            assert img.full_size_checksum == calculate_blake3_hash(img.full_size_path)
+        # The staged derivatives were all moved into place
+        assert not list(settings.THUMBNAIL_DIR.glob("staging-*"))
+        assert not list(settings.FULL_SIZE_DIR.glob("staging-*"))
+
+    def test_index_command_batch_reads_metadata_once(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        with mock.patch(
+            "scansteward.imageops.index.iter_image_metadata",
+            wraps=iter_image_metadata,
+        ) as read_mock:
+            call_command("index", str(base_dir), "--batch-size", str(len(sample_images)))
+
+        read_mock.assert_called_once()
+        assert Image.objects.count() == len(sample_images)
+
     def test_index_command_with_region_description(self, sample_one_original_copy: Path):
         metadata = read_image_metadata(sample_one_original_copy)
 
@@ -145,6 +209,21 @@ class TestIndexCommand:
         assert person.name == "Barack Obama"
         assert person.description == "This is a description of a region"
 
+    def test_index_command_updates_region_description(self, sample_one_original_copy: Path):
+        metadata = read_image_metadata(sample_one_original_copy)
+        metadata.RegionInfo.RegionList[0].Description = "This is a description of a region"
+        write_image_metadata(metadata)
+
+        Person.objects.create(name="Barack Obama", description="An old description")
+        Person.objects.update(modified=timezone.now() - timezone.timedelta(days=1))
+        before = Person.objects.get().modified
+
+        call_command("index", str(sample_one_original_copy.parent))
+
+        person = Person.objects.get()
+        assert person.description == "This is a description of a region"
+        assert person.modified > before
+
     def test_index_command_with_pets(self, sample_one_original_copy: Path):
         call_command("index", str(sample_one_original_copy.parent))
 
@@ -153,3 +232,344 @@ class TestIndexCommand:
         assert instance is not None
         assert instance.name == "Bo"
         assert instance.description == "Bo was a pet dog of the Obama family"
+
+    def test_index_command_failed_batch_discards_derivatives(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, _ = all_samples_copy
+
+        with (
+            mock.patch("scansteward.tasks.images.handle_new_images", side_effect=RuntimeError("boom")),
+            pytest.raises(CommandError),
+        ):
+            call_command("index", str(base_dir))
+
+        assert Image.objects.count() == 0
+        assert not list(settings.THUMBNAIL_DIR.glob("staging-*"))
+        assert not list(settings.FULL_SIZE_DIR.glob("staging-*"))
+
+    def test_index_command_rolled_back_batch_removes_derivatives(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, _ = all_samples_copy
+
+        # Fails after the derivatives are moved to the names of the rolled back rows
+        with (
+            mock.patch("scansteward.imageops.index.parse_keywords", side_effect=RuntimeError("boom")),
+            pytest.raises(CommandError),
+        ):
+            call_command("index", str(base_dir))
+
+        assert Image.objects.count() == 0
+        assert not list(settings.THUMBNAIL_DIR.iterdir())
+        assert not list(settings.FULL_SIZE_DIR.iterdir())
+
+    def test_index_command_bad_file_fails_alone(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+        # A JPEG which was cut short, so it cannot be decoded
+        broken = base_dir / "broken.jpg"
+        broken.write_bytes(Path(sample_images[0]).read_bytes()[:2048])
+
+        with pytest.raises(CommandError, match="1 images"):
+            call_command("index", str(base_dir), "--batch-size", "5")
+
+        assert Image.objects.count() == len(sample_images)
+        job = IndexJob.objects.get()
+        failed = job.items.get(state=IndexJobItem.StateChoices.FAILED)
+        assert failed.path == str(broken.resolve())
+        assert failed.error
+        assert job.items.filter(state=IndexJobItem.StateChoices.DONE).count() == len(sample_images)
+        assert not list(settings.THUMBNAIL_DIR.glob("staging-*"))
+        assert not list(settings.FULL_SIZE_DIR.glob("staging-*"))
+
+    def test_index_image_batch_missing_file(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+        job = IndexJob.objects.create()
+        items = IndexJobItem.objects.bulk_create(
+            [
+                IndexJobItem(job=job, path=str(path))
+                for path in [*(Path(image).resolve() for image in sample_images), base_dir / "vanished.jpg"]
+            ],
+        )
+
+        index_image_batch.call_local([item.pk for item in items])
+
+        assert Image.objects.count() == len(sample_images)
+        failed = job.items.get(state=IndexJobItem.StateChoices.FAILED)
+        assert failed.pk == items[-1].pk
+        assert failed.error.startswith("FileNotFoundError")
+
+    def test_index_command_metadata_read_one_at_a_time(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+        failing = Path(sample_images[1]).resolve()
+
+        def read_or_fail(image_path: Path):
+            if image_path == failing:
+                msg = "unreadable"
+                raise RuntimeError(msg)
+            return read_image_metadata(image_path)
+
+        with (
+            mock.patch("scansteward.imageops.index.iter_image_metadata", side_effect=RuntimeError("batch failed")),
+            mock.patch("scansteward.imageops.index.read_image_metadata", side_effect=read_or_fail) as read_mock,
+            pytest.raises(CommandError),
+        ):
+            call_command("index", str(base_dir))
+
+        assert read_mock.call_count == len(sample_images)
+        assert Image.objects.count() == len(sample_images) - 1
+        assert IndexJobItem.objects.get(state=IndexJobItem.StateChoices.FAILED).error == "RuntimeError: unreadable"
+
+    def test_index_command_reads_originals_once(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        with (
+            mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock,
+            mock.patch("scansteward.imageops.derivatives.Image.open", wraps=PILImage.open) as open_mock,
+        ):
+            call_command("index", str(base_dir), "--batch-size", "1")
+
+        assert ingest_mock.call_count == len(sample_images)
+        # Each original is decoded once, from its path, so its contents are never held by the batch
+        assert open_mock.call_count == len(sample_images)
+        assert {call.args[0] for call in open_mock.call_args_list} == {Path(image).resolve() for image in sample_images}
+        for img in Image.objects.all():
+            assert img.file_size == img.original_path.stat().st_size
+            assert img.original_checksum == calculate_blake3_hash(img.original_path)
+
+    def test_index_command_skips_unchanged_files(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        call_command("index", str(base_dir))
+
+        assert ImageFingerprint.objects.count() == len(sample_images)
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", str(base_dir))
+
+        ingest_mock.assert_not_called()
+        assert Image.objects.count() == len(sample_images)
+
+    def test_index_command_rehashes_changed_files(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        call_command("index", str(base_dir))
+
+        changed = Path(sample_images[0])
+        stat = changed.stat()
+        os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", str(base_dir))
+
+        ingest_mock.assert_called_once()
+        assert ingest_mock.call_args.args[0] == changed.resolve()
+        assert ImageFingerprint.objects.get(path=str(changed.resolve())).mtime_ns == changed.stat().st_mtime_ns
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", str(base_dir), "--rehash")
+
+        assert ingest_mock.call_count == len(sample_images)
+        assert Image.objects.count() == len(sample_images)
+
+    def test_index_command_skips_unchanged_copies(self, sample_one_original_copy: Path):
+        copy = shutil.copy(sample_one_original_copy, sample_one_original_copy.with_name("copy.jpg"))
+
+        call_command("index", str(sample_one_original_copy.parent))
+
+        img = Image.objects.get()
+        assert set(ImageFingerprint.objects.values_list("path", flat=True)) == {
+            str(sample_one_original_copy.resolve()),
+            str(Path(copy).resolve()),
+        }
+        assert set(ImageFingerprint.objects.values_list("image", flat=True)) == {img.pk}
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", str(sample_one_original_copy.parent))
+
+        ingest_mock.assert_not_called()
+        assert Image.objects.get().original == img.original
+
+    def test_index_command_unchanged_copy_of_removed_original(self, sample_one_original_copy: Path):
+        copy = Path(shutil.copy(sample_one_original_copy, sample_one_original_copy.with_name("copy.jpg"))).resolve()
+
+        call_command("index", str(sample_one_original_copy.parent))
+        img = Image.objects.get()
+        remaining = copy if img.original_path != copy else sample_one_original_copy.resolve()
+        img.original_path.unlink()
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", str(sample_one_original_copy.parent))
+
+        # The copy is unchanged, so is not read again, but the Image now lives there
+        ingest_mock.assert_not_called()
+        assert Image.objects.get().original_path == remaining
+
+    @pytest.mark.parametrize("prefetch", [0, 2])
+    def test_index_command_nested_directories(
+        self,
+        tmp_path_factory: pytest.TempPathFactory,
+        all_samples_copy: tuple[Path, list[Path]],
+        prefetch: int,
+    ):
+        _, sample_images = all_samples_copy
+        root = tmp_path_factory.mktemp("nested")
+        nested = [
+            root / "a" / "sample1.jpg",
+            root / "a" / "b" / "sample2.JPG",
+            root / "c" / "sample3.jpg",
+            root / "sample4.jpg",
+        ]
+        for source, destination in zip(sample_images, nested, strict=True):
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy(source, destination)
+        (root / "c" / "notes.txt").write_text("not an image")
+
+        call_command("index", str(root), "--prefetch", str(prefetch), "--batch-size", "3")
+
+        assert Image.objects.count() == len(nested)
+        assert {img.original_path for img in Image.objects.all()} == {x.resolve() for x in nested}
+
+    def test_index_command_tags_created_in_bulk(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, _ = all_samples_copy
+
+        with CaptureQueriesContext(connection) as context:
+            call_command("index", str(base_dir))
+
+        tag_inserts = [x for x in context.captured_queries if 'INTO "scansteward_tag" ' in x["sql"]]
+        tag_on_image_inserts = [x for x in context.captured_queries if 'INTO "scansteward_tagonimage" ' in x["sql"]]
+        tag_selects = [x for x in context.captured_queries if 'FROM "scansteward_tag"' in x["sql"]]
+        # At most one insert per level of the tree, each fetched back once, and a single load of the existing tags
+        assert Tag.objects.exists()
+        assert 1 <= len(tag_inserts) <= 3
+        assert len(tag_on_image_inserts) == 1
+        assert len(tag_selects) == 1 + len(tag_inserts)
+        for tag_on_image in TagOnImage.objects.filter(tag__parent__isnull=False):
+            assert TagOnImage.objects.filter(tag=tag_on_image.tag.parent, image=tag_on_image.image).exists()
+
+    def test_index_command_entities_created_once(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        with CaptureQueriesContext(connection) as context:
+            call_command("index", str(base_dir))
+
+        def count_inserts(table: str) -> int:
+            # Conflicts are ignored, which can change the start of the statement
+            return len([x for x in context.captured_queries if f'INTO "{table}"' in x["sql"]])
+
+        # The same people appear in every sample, but each is created once and all boxes are inserted together
+        assert Person.objects.filter(name="Barack Obama").first().images.count() == len(sample_images)
+        assert count_inserts("scansteward_person") == 1
+        assert count_inserts("scansteward_personinimage") == 1
+        assert count_inserts("scansteward_roughlocation") <= 1
+        assert count_inserts("scansteward_roughdate") <= 1
+
+    def test_index_command_records_job(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        call_command("index", str(base_dir), "--batch-size", "2")
+
+        job = IndexJob.objects.get()
+        assert job.roots == [str(base_dir.resolve())]
+        assert job.discovery_complete
+        assert job.finished_at is not None
+        assert job.items.count() == len(sample_images)
+        assert not job.items.exclude(state=IndexJobItem.StateChoices.DONE).exists()
+
+    def test_index_command_resume_failed_items(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        with (
+            mock.patch("scansteward.tasks.images.handle_new_images", side_effect=RuntimeError("boom")),
+            pytest.raises(CommandError, match="--resume"),
+        ):
+            call_command("index", str(base_dir), "--batch-size", "2")
+
+        job = IndexJob.objects.get()
+        assert job.finished_at is None
+        assert job.items.filter(state=IndexJobItem.StateChoices.FAILED).count() == len(sample_images)
+        assert job.items.first().error == "RuntimeError: boom"
+
+        # Finish one of the items, so only the rest are picked up again
+        done = job.items.first()
+        done.state = IndexJobItem.StateChoices.DONE
+        done.save()
+
+        with mock.patch("scansteward.tasks.images.ingest_image", wraps=ingest_image) as ingest_mock:
+            call_command("index", "--resume")
+
+        assert ingest_mock.call_count == len(sample_images) - 1
+        assert Path(done.path) not in [call.args[0] for call in ingest_mock.call_args_list]
+        job.refresh_from_db()
+        assert job.finished_at is not None
+        assert not job.items.exclude(state=IndexJobItem.StateChoices.DONE).exists()
+        assert IndexJob.objects.count() == 1
+
+    def test_index_command_failed_batch_retried_one_at_a_time(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+        bad = Path(sample_images[2]).resolve()
+
+        def fail_with_bad(pkg, prepared):
+            if any(item.image_path == bad for item in prepared):
+                msg = "bad image"
+                raise RuntimeError(msg)
+            return handle_new_images(pkg, prepared)
+
+        with mock.patch("scansteward.tasks.images.handle_new_images", side_effect=fail_with_bad):
+            with pytest.raises(CommandError, match="1 images"):
+                call_command("index", str(base_dir), "--batch-size", "4")
+
+            assert Image.objects.count() == len(sample_images) - 1
+            failed = IndexJobItem.objects.get(state=IndexJobItem.StateChoices.FAILED)
+            assert failed.path == str(bad)
+            assert failed.error == "RuntimeError: bad image"
+
+            # Resuming only retries the bad image, which still fails alone
+            with pytest.raises(CommandError, match="1 images"):
+                call_command("index", "--resume", "--batch-size", "4")
+
+        assert Image.objects.count() == len(sample_images) - 1
+        assert IndexJobItem.objects.filter(state=IndexJobItem.StateChoices.DONE).count() == len(sample_images) - 1
+
+    def test_index_command_resume_interrupted_discovery(self, all_samples_copy: tuple[Path, list[Path]]):
+        base_dir, sample_images = all_samples_copy
+
+        # As if the run stopped after recording its first item
+        job = IndexJob.objects.create(roots=[str(base_dir.resolve())])
+        IndexJobItem.objects.create(job=job, path=str(Path(sample_images[0]).resolve()))
+
+        call_command("index", "--resume", "--batch-size", "2")
+
+        job.refresh_from_db()
+        assert job.discovery_complete
+        assert job.finished_at is not None
+        assert job.items.filter(state=IndexJobItem.StateChoices.DONE).count() == len(sample_images)
+        assert Image.objects.count() == len(sample_images)
+
+    def test_index_command_resume_without_job(self):
+        IndexJob.objects.create(roots=[], discovery_complete=True, finished_at=timezone.now())
+
+        with pytest.raises(CommandError, match="no unfinished index job"):
+            call_command("index", "--resume")
+
+    def test_index_command_requires_paths(self):
+        with pytest.raises(CommandError, match="No paths"):
+            call_command("index")
+
+    def test_index_image_batch_task_loads_items(self, all_samples_copy: tuple[Path, list[Path]]):
+        _, sample_images = all_samples_copy
+        source = ImageSource.objects.create(name="Queued source")
+        job = IndexJob.objects.create(source=source, hash_threads=2)
+        items = IndexJobItem.objects.bulk_create(
+            [IndexJobItem(job=job, path=str(Path(image).resolve())) for image in sample_images],
+        )
+
+        index_image_batch.call_local([item.pk for item in items])
+
+        assert Image.objects.filter(source=source).count() == len(sample_images)
+        assert job.items.filter(state=IndexJobItem.StateChoices.DONE).count() == len(sample_images)
+
+    def test_index_single_image_task(self, sample_one_original_copy: Path):
+        source = ImageSource.objects.create(name="Queued source")
+
+        index_single_image.call_local(str(sample_one_original_copy), source.pk)
+
+        img = Image.objects.get()
+        assert img.source == source
+        assert img.original_path == sample_one_original_copy.resolve()
@@ -1,8 +1,24 @@
+from datetime import timedelta
+from unittest import mock
+
 import pytest
 from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+from scansteward.config.settings import ImageOpsSettings
+from scansteward.imageops.locks import locked_files
+from scansteward.imageops.metadata import bulk_write_image_metadata
+from scansteward.imageops.sync import load_sync_snapshots
 from scansteward.models import Image
+from scansteward.models import ImageFingerprint
+from scansteward.models import PetInImage
 from scansteward.models import RoughDate
+from scansteward.signals.batching import batch_dirty_marking
+from scansteward.signals.batching import set_dirty
+from scansteward.tasks.images import auto_sync_dirty_images
+from scansteward.utils import calculate_blake3_hash
 
 
 @pytest.mark.usefixtures("sample_image_environment")
@@ -86,3 +102,228 @@ class TestSyncCommand:
         img.refresh_from_db()
 
         assert not img.is_dirty
+
+    def test_batched_dirty_marking(self):
+        images = list(Image.objects.all()[:2])
+        assert len(images) == 2
+
+        with CaptureQueriesContext(connection) as context, batch_dirty_marking():
+            for img in images:
+                img.description = "Changed in a batch"
+                img.save()
+            # Nothing is marked until the batch ends
+            assert not Image.objects.filter(is_dirty=True).exists()
+
+        dirty_updates = [x for x in context.captured_queries if 'SET "is_dirty"' in x["sql"]]
+        assert len(dirty_updates) == 1
+        assert Image.objects.filter(is_dirty=True).count() == 2
+
+    def test_batched_dirty_marking_discarded_on_error(self):
+        img = Image.objects.get(pk=1)
+
+        def _change_then_fail():
+            with batch_dirty_marking():
+                img.description = "Changed, then failed"
+                img.save()
+                raise RuntimeError
+
+        with pytest.raises(RuntimeError):
+            _change_then_fail()
+
+        img.refresh_from_db()
+        assert not img.is_dirty
+
+    def test_sync_rehashes_only_written_originals(self):
+        img = Image.objects.get(pk=1)
+        phash = img.phash
+        thumbnail_checksum = img.thumbnail_checksum
+        full_size_checksum = img.full_size_checksum
+
+        img.description = "Synced, then hashed again"
+        img.save()
+
+        with (
+            mock.patch("scansteward.tasks.images.calculate_blake3_hash", wraps=calculate_blake3_hash) as hash_mock,
+            CaptureQueriesContext(connection) as context,
+        ):
+            call_command("sync")
+
+        hash_mock.assert_called_once()
+        checksum_updates = [x for x in context.captured_queries if 'SET "original_checksum"' in x["sql"]]
+        assert len(checksum_updates) == 1
+
+        img.refresh_from_db()
+        assert not img.is_dirty
+        assert img.original_checksum == calculate_blake3_hash(img.original_path)
+        assert img.file_size == img.original_path.stat().st_size
+        # Only the original is written to, and not its pixels
+        assert img.phash == phash
+        assert img.thumbnail_checksum == thumbnail_checksum
+        assert img.full_size_checksum == full_size_checksum
+        assert ImageFingerprint.objects.get(image=img).size == img.file_size
+
+    def test_sync_snapshots_fixed_queries(self, django_assert_num_queries):
+        image_ids = list(Image.objects.values_list("pk", flat=True))
+
+        with django_assert_num_queries(3):
+            snapshots = load_sync_snapshots(image_ids)
+
+        assert sorted(snapshots) == sorted(image_ids)
+        for img in Image.objects.all():
+            snapshot = snapshots[img.pk]
+            assert {x.name for x in snapshot.people} == set(img.people.values_list("name", flat=True))
+            assert {x.name for x in snapshot.pets} == set(img.pets.values_list("name", flat=True))
+            assert (snapshot.location is None) == (img.location is None)
+            assert (snapshot.date is None) == (img.date is None)
+
+        pet_box = PetInImage.objects.select_related("pet").get()
+        pet = snapshots[pet_box.image_id].pets[0]
+        assert pet.description == pet_box.description
+        assert (pet.center_x, pet.center_y, pet.height, pet.width) == (
+            pet_box.center_x,
+            pet_box.center_y,
+            pet_box.height,
+            pet_box.width,
+        )
+
+    def test_sync_keyset_batches(self):
+        Image.objects.update(is_dirty=True)
+
+        with CaptureQueriesContext(connection) as context:
+            call_command("sync", "--batch-size", "1")
+
+        assert not Image.objects.filter(is_dirty=True).exists()
+        for query in context.captured_queries:
+            assert "OFFSET" not in query["sql"]
+            assert "COUNT(" not in query["sql"]
+
+    def test_auto_sync_waits_for_delay(self):
+        img = Image.objects.get(pk=1)
+        img.description = "Changed, then left alone"
+        img.save()
+
+        with mock.patch(
+            "scansteward.tasks.images.get_image_ops_settings",
+            return_value=ImageOpsSettings(auto_sync_delay=60),
+        ):
+            auto_sync_dirty_images.call_local()
+
+            img.refresh_from_db()
+            assert img.is_dirty
+
+            Image.objects.filter(pk=img.pk).update(dirtied_at=timezone.now() - timedelta(minutes=2))
+            auto_sync_dirty_images.call_local()
+
+        img.refresh_from_db()
+        assert not img.is_dirty
+
+    def test_auto_sync_disabled(self):
+        Image.objects.filter(pk=1).update(is_dirty=True, dirtied_at=timezone.now() - timedelta(days=1))
+
+        with mock.patch(
+            "scansteward.tasks.images.get_image_ops_settings",
+            return_value=ImageOpsSettings(auto_sync=False),
+        ):
+            auto_sync_dirty_images.call_local()
+
+        assert Image.objects.get(pk=1).is_dirty
+
+    def test_sync_keeps_images_edited_during_write(self):
+        img = Image.objects.get(pk=1)
+        img.description = "Changed before the sync"
+        img.save()
+
+        def _edit_while_writing(*args, **kwargs):
+            set_dirty(Image.objects.filter(pk=img.pk))
+
+        with mock.patch("scansteward.imageops.metadata.bulk_write_image_metadata", side_effect=_edit_while_writing):
+            call_command("sync")
+
+        img.refresh_from_db()
+        assert img.is_dirty
+
+    def test_sync_skips_locked_files(self):
+        img = Image.objects.get(pk=1)
+        img.description = "Changed while the file is in use"
+        img.save()
+
+        with locked_files([img.original_path]):
+            call_command("sync")
+
+        img.refresh_from_db()
+        assert img.is_dirty
+
+        call_command("sync")
+
+        img.refresh_from_db()
+        assert not img.is_dirty
+
+    def test_sync_concurrent_writers(self):
+        for img in Image.objects.all():
+            img.description = "Written by one of several writers"
+            img.save()
+
+        with (
+            mock.patch(
+                "scansteward.tasks.images.get_image_ops_settings",
+                return_value=ImageOpsSettings(sync_writers=2),
+            ),
+            mock.patch(
+                "scansteward.imageops.metadata.bulk_write_image_metadata",
+                wraps=bulk_write_image_metadata,
+            ) as write_mock,
+        ):
+            call_command("sync")
+
+        assert write_mock.call_count == 2
+        written = [metadata.SourceFile for call in write_mock.call_args_list for metadata in call.args[0]]
+        assert sorted(written) == sorted(img.original_path for img in Image.objects.all())
+        assert not Image.objects.filter(is_dirty=True).exists()
+
+    @pytest.mark.parametrize("writers", [1, 2])
+    def test_sync_bad_file_fails_alone(self, writers: int):
+        for img in Image.objects.all():
+            img.description = "Written around a bad file"
+            img.save()
+        bad = Image.objects.get(pk=1)
+
+        def _fail_with_bad(metadata, **kwargs):
+            if any(item.SourceFile == bad.original_path for item in metadata):
+                msg = "cannot write"
+                raise RuntimeError(msg)
+            return bulk_write_image_metadata(metadata, **kwargs)
+
+        with (
+            mock.patch(
+                "scansteward.tasks.images.get_image_ops_settings",
+                return_value=ImageOpsSettings(sync_writers=writers),
+            ),
+            mock.patch("scansteward.imageops.metadata.bulk_write_image_metadata", side_effect=_fail_with_bad),
+        ):
+            call_command("sync")
+
+        assert list(Image.objects.filter(is_dirty=True).values_list("pk", flat=True)) == [bad.pk]
+        # The files written along with the bad one have their new checksums recorded
+        for img in Image.objects.exclude(pk=bad.pk):
+            assert img.original_checksum == calculate_blake3_hash(img.original_path)
+
+    def test_auto_sync_continues_after_failed_batch(self):
+        Image.objects.update(is_dirty=True, dirtied_at=timezone.now() - timedelta(days=1))
+
+        def _fail_first(image_ids):
+            image_ids = list(image_ids)
+            if 1 in image_ids:
+                msg = "failed batch"
+                raise RuntimeError(msg)
+            return load_sync_snapshots(image_ids)
+
+        with (
+            mock.patch(
+                "scansteward.tasks.images.get_image_ops_settings",
+                return_value=ImageOpsSettings(sync_batch_size=1),
+            ),
+            mock.patch("scansteward.tasks.images.load_sync_snapshots", side_effect=_fail_first),
+        ):
+            auto_sync_dirty_images.call_local()
+
+        assert list(Image.objects.filter(is_dirty=True).values_list("pk", flat=True)) == [1]
@@ -0,0 +1,178 @@
+import os
+import signal
+import sys
+from collections.abc import Generator
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from scansteward.imageops.errors import ExifToolError
+from scansteward.imageops.errors import ExifToolProcessError
+from scansteward.imageops.exiftool import ExifToolPool
+from scansteward.imageops.exiftool import ExifToolProcess
+from scansteward.imageops.exiftool import get_exiftool_pool
+from scansteward.tasks.images import check_exiftool_health
+
+
+@pytest.fixture()
+def exiftool_process() -> Generator[ExifToolProcess, None, None]:
+    process = ExifToolProcess()
+    process.start()
+    yield process
+    process.terminate()
+
+
+@pytest.fixture()
+def exiftool_pool() -> Generator[ExifToolPool, None, None]:
+    pool = ExifToolPool(max_size=1)
+    yield pool
+    pool.close()
+
+
+class TestExifToolProcess:
+    def test_version(self, exiftool_process: ExifToolProcess):
+        result = exiftool_process.execute(["-ver"])
+
+        assert result.status == 0
+        assert result.stdout.strip()
+        assert exiftool_process.check_health()
+
+    def test_multiple_commands(self, exiftool_process: ExifToolProcess, sample_one_original_file: Path):
+        pid = exiftool_process.pid
+
+        for _ in range(3):
+            result = exiftool_process.execute(["-json", "-Title", str(sample_one_original_file.resolve())])
+            assert result.status == 0
+            assert str(sample_one_original_file.resolve()) in result.stdout.decode("utf-8")
+
+        assert exiftool_process.pid == pid
+
+    def test_error_status(self, exiftool_process: ExifToolProcess, tmp_path: Path):
+        result = exiftool_process.execute(["-json", str(tmp_path / "missing.jpg")])
+
+        assert result.status != 0
+        with pytest.raises(ExifToolError) as e:
+            result.check_status()
+        assert e.value.result is result
+
+        # The process is still usable after a failed command
+        assert exiftool_process.execute(["-ver"]).status == 0
+
+    def test_submit_ahead(self, exiftool_process: ExifToolProcess, sample_one_original_file: Path):
+        first = exiftool_process.submit(["-ver"])
+        second = exiftool_process.submit(["-json", "-Title", str(sample_one_original_file.resolve())])
+
+        assert exiftool_process.collect(first).stdout.strip()
+        assert str(sample_one_original_file.resolve()) in exiftool_process.collect(second).stdout.decode("utf-8")
+
+    def test_not_started(self):
+        with pytest.raises(ExifToolProcessError):
+            ExifToolProcess().execute(["-ver"])
+
+    def test_rejects_line_breaks(self, exiftool_process: ExifToolProcess):
+        with pytest.raises(ValueError, match="line breaks"):
+            exiftool_process.execute(["-Title=one\ntwo"])
+
+
+class TestExifToolPool:
+    def test_process_reused(self, exiftool_pool: ExifToolPool):
+        with exiftool_pool.acquire() as process:
+            first_pid = process.pid
+        with exiftool_pool.acquire() as process:
+            second_pid = process.pid
+
+        assert first_pid is not None
+        assert first_pid == second_pid
+
+    def test_dead_process_restarted(self, exiftool_pool: ExifToolPool):
+        with exiftool_pool.acquire() as process:
+            first_pid = process.pid
+            process._process.kill()  # type: ignore[union-attr] # noqa: SLF001
+            process._process.wait()  # type: ignore[union-attr] # noqa: SLF001
+
+        result = exiftool_pool.execute(["-ver"])
+
+        assert result.status == 0
+        with exiftool_pool.acquire() as process:
+            assert process.pid != first_pid
+
+    def test_health_check(self, exiftool_pool: ExifToolPool):
+        exiftool_pool.execute(["-ver"])
+
+        exiftool_pool.check_health()
+
+        assert exiftool_pool.execute(["-ver"]).status == 0
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Stopping a process needs SIGSTOP")
+    def test_unhealthy_process_restarted(self, exiftool_pool: ExifToolPool):
+        with exiftool_pool.acquire() as process:
+            first_pid = process.pid
+            # Stopped, so it is still alive, but never answers
+            os.kill(first_pid, signal.SIGSTOP)  # type: ignore[arg-type]
+
+        exiftool_pool.check_health(timeout=0.5)
+
+        with exiftool_pool.acquire() as process:
+            assert process.pid != first_pid
+        assert exiftool_pool.execute(["-ver"]).status == 0
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="Stopping a process needs SIGSTOP")
+    def test_hung_command_restarted(self):
+        pool = ExifToolPool(max_size=1, timeout=0.5)
+        try:
+            with pool.acquire() as process:
+                first_pid = process.pid
+                os.kill(first_pid, signal.SIGSTOP)  # type: ignore[arg-type]
+
+            result = pool.execute(["-ver"])
+
+            assert result.status == 0
+            with pool.acquire() as process:
+                assert process.pid != first_pid
+        finally:
+            pool.close()
+
+    def test_health_check_holds_slot(self):
+        pool = ExifToolPool(max_size=1)
+        try:
+            pool.execute(["-ver"])
+            check_health = ExifToolProcess.check_health
+
+            def acquire_while_checked(process: ExifToolProcess, timeout: float) -> bool:
+                # The only slot is held by the check, so no second process can be started meanwhile
+                with pytest.raises(ExifToolProcessError), pool.acquire(timeout=0):
+                    pass  # pragma: no cover
+                return check_health(process, timeout=timeout)
+
+            with mock.patch.object(ExifToolProcess, "check_health", autospec=True, side_effect=acquire_while_checked):
+                pool.check_health()
+
+            assert len(pool._all) == 1  # noqa: SLF001
+            assert pool.execute(["-ver"]).status == 0
+        finally:
+            pool.close()
+
+    def test_timeout_per_file(self):
+        pool = ExifToolPool(max_size=1, timeout=2.0)
+        try:
+            with mock.patch.object(ExifToolProcess, "execute") as execute_mock:
+                pool.execute(["-ver"], files=3)
+
+            execute_mock.assert_called_once_with(["-ver"], timeout=6.0)
+            assert ExifToolPool(timeout=None).timeout_for(3) is None
+        finally:
+            pool.close()
+
+    def test_scheduled_health_check(self):
+        with mock.patch("scansteward.tasks.images.get_exiftool_pool") as pool_mock:
+            check_exiftool_health.call_local()
+
+        pool_mock.return_value.check_health.assert_called_once()
+
+    def test_invalid_size(self):
+        with pytest.raises(ValueError, match="at least 1"):
+            ExifToolPool(max_size=0)
+
+    def test_pool_per_process(self):
+        assert get_exiftool_pool() is get_exiftool_pool()
@@ -0,0 +1,40 @@
+from pathlib import Path
+
+import pytest
+
+from scansteward.imageops.locks import lock_stripe
+from scansteward.imageops.locks import locked_files
+
+
+@pytest.fixture()
+def lock_paths(settings, tmp_path: Path) -> tuple[Path, Path]:
+    settings.DATA_DIR = tmp_path / "data"
+    first = tmp_path / "first.jpg"
+    # Any path which does not share the lock of the first
+    second = next(
+        path for path in (tmp_path / f"{i}.jpg" for i in range(100)) if lock_stripe(path) != lock_stripe(first)
+    )
+    return first, second
+
+
+class TestLockedFiles:
+    def test_locks_resolved_paths(self, lock_paths: tuple[Path, Path]):
+        first, second = lock_paths
+
+        with locked_files([first, second]) as locked:
+            assert locked == {first.resolve(), second.resolve()}
+
+    def test_held_lock_skipped(self, lock_paths: tuple[Path, Path]):
+        first, second = lock_paths
+
+        with locked_files([first]), locked_files([first, second], blocking=False) as locked:
+            assert locked == {second.resolve()}
+
+        with locked_files([first], blocking=False) as locked:
+            assert locked == {first.resolve()}
+
+    def test_namespaces_separate(self, lock_paths: tuple[Path, Path]):
+        first, _ = lock_paths
+
+        with locked_files([first]), locked_files([first], blocking=False, namespace="other") as locked:
+            assert locked == {first.resolve()}
@@ -8,6 +8,7 @@ from scansteward.imageops.errors import NoImagePathsError
 from scansteward.imageops.metadata import bulk_read_image_metadata
 from scansteward.imageops.metadata import bulk_write_image_metadata
 from scansteward.imageops.metadata import clear_existing_metadata
+from scansteward.imageops.metadata import iter_image_metadata
 from scansteward.imageops.metadata import read_image_metadata
 from scansteward.imageops.metadata import write_image_metadata
 from scansteward.imageops.models import ImageMetadata
@@ -44,6 +45,25 @@ class TestReadImageMetadata(MetadataVerifyMixin):
         self.verify_expected_vs_actual_metadata(sample_one_metadata_copy, metadata[0])
         self.verify_expected_vs_actual_metadata(sample_two_metadata_copy, metadata[1])
 
+    def test_stream_image_metadata(self, sample_one_original_file: Path, sample_two_original_file: Path):
+        images = [sample_one_original_file, sample_two_original_file, sample_one_original_file]
+
+        stream = iter_image_metadata(images, chunk_size=1)
+        assert next(stream).SourceFile == sample_one_original_file.resolve()
+        assert [x.SourceFile for x in stream] == [
+            sample_two_original_file.resolve(),
+            sample_one_original_file.resolve(),
+        ]
+
+    def test_stream_stopped_early(self, sample_one_original_file: Path, sample_two_original_file: Path):
+        stream = iter_image_metadata([sample_one_original_file, sample_two_original_file] * 2, chunk_size=1)
+        assert next(stream).SourceFile == sample_one_original_file.resolve()
+        stream.close()
+
+        # The output still queued was drained, and is not mixed into the next read
+        metadata = bulk_read_image_metadata([sample_two_original_file])
+        assert [x.SourceFile for x in metadata] == [sample_two_original_file.resolve()]
+
 
 class TestWriteImageMetadata(MetadataVerifyMixin):
     def test_change_single_image_metadata(self, sample_one_metadata_copy: ImageMetadata):
@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from scansteward.imageops.keywords import keyword_trie
+from scansteward.imageops.metadata import combine_keyword_structures
+from scansteward.imageops.metadata import expand_keyword_structures
+from scansteward.imageops.models import ImageMetadata
+from scansteward.imageops.models import KeywordInfoModel
+from scansteward.imageops.models import KeywordStruct
+
+
+class TestKeywordTrie:
+    def test_merge_duplicate_trees(self):
+        trie = keyword_trie(
+            [
+                KeywordStruct(Keyword="People", Children=[KeywordStruct(Keyword="Alice")]),
+                KeywordStruct(Keyword="Places"),
+                KeywordStruct(Keyword="People", Children=[KeywordStruct(Keyword="Bob")]),
+                KeywordStruct(Keyword="People", Children=[KeywordStruct(Keyword="Alice")]),
+            ],
+        )
+
+        assert trie.to_structs() == [
+            KeywordStruct(
+                Keyword="People",
+                Children=[KeywordStruct(Keyword="Alice"), KeywordStruct(Keyword="Bob")],
+            ),
+            KeywordStruct(Keyword="Places"),
+        ]
+
+    def test_merge_applied(self):
+        trie = keyword_trie(
+            [
+                KeywordStruct(Keyword="Unknown"),
+                KeywordStruct(Keyword="Unknown"),
+                KeywordStruct(Keyword="Explicit"),
+                KeywordStruct(Keyword="Explicit", Applied=False),
+                KeywordStruct(Keyword="Applied", Applied=True),
+                KeywordStruct(Keyword="Applied", Applied=False),
+            ],
+        )
+
+        assert [(child.keyword, child.applied) for child in trie.children.values()] == [
+            ("Unknown", None),
+            ("Explicit", False),
+            ("Applied", True),
+        ]
+
+    def test_add_path_walks_existing(self):
+        trie = keyword_trie([KeywordStruct(Keyword="People", Applied=True)])
+
+        trie.add_path(["People", "Alice"])
+        trie.add_path(["People", "Alice"])
+        trie.add_path(["People", "Bob"])
+
+        people = trie.children["People"]
+        assert list(trie.children) == ["People"]
+        assert people.applied
+        assert list(people.children) == ["Alice", "Bob"]
+        assert not people.children["Alice"].children
+
+    def test_iter_paths(self):
+        trie = keyword_trie(
+            [
+                KeywordStruct(
+                    Keyword="Dates",
+                    Children=[
+                        KeywordStruct(Keyword="1990", Children=[KeywordStruct(Keyword="May")]),
+                        KeywordStruct(Keyword="1991"),
+                    ],
+                ),
+                KeywordStruct(Keyword="Pets"),
+            ],
+        )
+
+        assert list(trie.iter_paths()) == [["Dates", "1990", "May"], ["Dates", "1991"], ["Pets"]]
+
+
+class TestKeywordStructures:
+    def test_combine_flat_with_hierarchy(self):
+        metadata = ImageMetadata(
+            SourceFile=Path(__file__),
+            KeywordInfo=KeywordInfoModel(
+                Hierarchy=[KeywordStruct(Keyword="People", Children=[KeywordStruct(Keyword="Alice")])],
+            ),
+            HierarchicalSubject=["People|Alice", "People|Bob"],
+            TagsList=["People/Bob", "Pets/Dog"],
+        )
+
+        combine_keyword_structures(metadata)
+
+        if TYPE_CHECKING:
+            assert metadata.KeywordInfo is not None
+        assert metadata.KeywordInfo.Hierarchy == [
+            KeywordStruct(
+                Keyword="People",
+                Children=[KeywordStruct(Keyword="Alice"), KeywordStruct(Keyword="Bob")],
+            ),
+            KeywordStruct(Keyword="Pets", Children=[KeywordStruct(Keyword="Dog")]),
+        ]
+
+    def test_expand_leaf_paths(self):
+        metadata = ImageMetadata(
+            SourceFile=Path(__file__),
+            KeywordInfo=KeywordInfoModel(
+                Hierarchy=[
+                    KeywordStruct(
+                        Keyword="People",
+                        Children=[
+                            KeywordStruct(Keyword="Family", Children=[KeywordStruct(Keyword="Alice")]),
+                            KeywordStruct(Keyword="Bob"),
+                        ],
+                    ),
+                ],
+            ),
+        )
+
+        expand_keyword_structures(metadata)
+
+        assert metadata.HierarchicalSubject == ["People|Family|Alice", "People|Bob"]
+        assert metadata.CatalogSets == ["People|Family|Alice", "People|Bob"]
+        assert metadata.TagsList == ["People/Family/Alice", "People/Bob"]
+        assert metadata.LastKeywordXMP == ["People/Family/Alice", "People/Bob"]
@@ -0,0 +1,129 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from scansteward.imageops.locks import locked_files
+from scansteward.imageops.renditions import RenditionFormat
+from scansteward.imageops.renditions import RenditionSpec
+from scansteward.imageops.renditions import evict_renditions
+from scansteward.imageops.renditions import generate_rendition
+from scansteward.imageops.renditions import get_rendition
+from scansteward.tests.types import SampleFile
+
+
+@pytest.fixture()
+def rendition_dir(settings, tmp_path: Path) -> Path:
+    settings.DATA_DIR = tmp_path / "data"
+    settings.RENDITION_DIR = tmp_path / "renditions"
+    settings.RENDITION_DIR.mkdir()
+    return settings.RENDITION_DIR
+
+
+def write_rendition(rendition_dir: Path, name: str, size: int, mtime: float) -> Path:
+    path = rendition_dir / name[:2] / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"\0" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+class TestGetRendition:
+    def test_generates_once(self, rendition_dir: Path, sample_one_info: SampleFile):
+        spec = RenditionSpec(32, 32, RenditionFormat.PNG)
+
+        def slow_generate(*args):
+            # Long enough for every other request to be waiting on the lock
+            time.sleep(0.2)
+            generate_rendition(*args)
+
+        with (
+            mock.patch("scansteward.imageops.renditions.generate_rendition", side_effect=slow_generate) as generate,
+            ThreadPoolExecutor(max_workers=4) as pool,
+        ):
+            paths = list(pool.map(lambda _: get_rendition(sample_one_info.full_size, "abcdef", spec), range(4)))
+
+        assert generate.call_count == 1
+        assert len(set(paths)) == 1
+        assert paths[0].parent == (rendition_dir / "ab").resolve()
+        with Image.open(paths[0]) as im_file:
+            assert im_file.format == "PNG"
+            assert max(im_file.size) == 32
+
+    @pytest.mark.usefixtures("rendition_dir")
+    def test_not_blocked_by_original_lock(self, sample_one_info: SampleFile):
+        spec = RenditionSpec(16, None)
+        target = spec.cache_path("abcdef")
+
+        # Holding the lock stripe of the rendition path for the originals does not hold up the rendition
+        with locked_files([target]), ThreadPoolExecutor(max_workers=1) as pool:
+            assert pool.submit(get_rendition, sample_one_info.full_size, "abcdef", spec).result(timeout=10) == target
+
+    @pytest.mark.usefixtures("rendition_dir")
+    def test_use_marks_recent(self, sample_one_info: SampleFile):
+        spec = RenditionSpec(16, None)
+        path = get_rendition(sample_one_info.full_size, "abcdef", spec)
+        os.utime(path, (0, 0))
+
+        assert get_rendition(sample_one_info.full_size, "abcdef", spec) == path
+        assert path.stat().st_mtime > 0
+
+
+class TestEvictRenditions:
+    def test_evicts_oldest_first(self, rendition_dir: Path):
+        oldest = write_rendition(rendition_dir, "aa-1.webp", 100, 1000)
+        middle = write_rendition(rendition_dir, "bb-1.webp", 100, 2000)
+        newest = write_rendition(rendition_dir, "cc-1.webp", 100, 3000)
+
+        assert evict_renditions(200) == 100
+
+        assert not oldest.exists()
+        assert middle.exists()
+        assert newest.exists()
+
+    def test_within_budget(self, rendition_dir: Path):
+        path = write_rendition(rendition_dir, "aa-1.webp", 100, 1000)
+
+        assert evict_renditions(100) == 0
+        assert path.exists()
+
+    def test_keeps_recently_used(self, rendition_dir: Path):
+        old = write_rendition(rendition_dir, "aa-1.webp", 100, 1000)
+        recent = write_rendition(rendition_dir, "bb-1.webp", 100, time.time())
+
+        assert evict_renditions(0) == 100
+
+        assert not old.exists()
+        assert recent.exists()
+
+    def test_skips_partial(self, rendition_dir: Path):
+        partial = write_rendition(rendition_dir, "aa-1.tmp", 100, time.time())
+
+        assert evict_renditions(0) == 0
+        assert partial.exists()
+
+    def test_removes_stale_partial(self, rendition_dir: Path):
+        stale = write_rendition(rendition_dir, "aa-1.tmp", 100, 1000)
+        kept = write_rendition(rendition_dir, "bb-1.webp", 100, 1000)
+
+        # The partial file does not count towards the budget
+        assert evict_renditions(100) == 100
+
+        assert not stale.exists()
+        assert kept.exists()
+
+
+class TestRenditionSpec:
+    @pytest.mark.parametrize(
+        ("image_format", "shared"),
+        [(RenditionFormat.PNG, True), (RenditionFormat.WEBP, False), (RenditionFormat.JPEG, False)],
+    )
+    def test_quality_in_cache_name(self, image_format: RenditionFormat, *, shared: bool):
+        low = RenditionSpec(32, None, image_format, quality=50)
+        high = RenditionSpec(32, None, image_format, quality=90)
+
+        assert (low.cache_name("abcdef") == high.cache_name("abcdef")) is shared
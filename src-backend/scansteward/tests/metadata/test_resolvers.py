@@ -0,0 +1,47 @@
+import pytest
+from django.db import IntegrityError
+from django.db import transaction
+
+from scansteward.imageops.resolvers import TagTreeResolver
+from scansteward.models import Tag
+
+
+@pytest.mark.django_db
+class TestTagTreeResolver:
+    def test_creates_missing_tags(self):
+        resolver = TagTreeResolver()
+
+        resolver.ensure([(None, "Root")])
+        root = resolver.get(None, "Root")
+        resolver.ensure([(root.pk, "Child")])
+
+        assert resolver.get(root, "Child").parent == root
+        assert Tag.objects.count() == 2
+
+    def test_tags_created_concurrently(self):
+        resolver = TagTreeResolver()
+        resolver.ensure([(None, "Existing")])
+
+        # Another worker creates the same tags, after this one loaded its copy of the tree
+        other = TagTreeResolver()
+        other.ensure([(None, "Root")])
+        root = other.get(None, "Root")
+        other.ensure([(root.pk, "Child")])
+
+        resolver.ensure([(None, "Root")])
+        resolver.ensure([(root.pk, "Child"), (root.pk, "New")])
+
+        assert resolver.get(None, "Root") == root
+        assert resolver.get(root, "Child") == other.get(root, "Child")
+        assert resolver.get(root, "New").parent == root
+        assert Tag.objects.filter(name="Root").count() == 1
+        assert Tag.objects.count() == 4
+
+    def test_root_names_unique(self):
+        Tag.objects.create(name="Root")
+
+        with pytest.raises(IntegrityError), transaction.atomic():
+            Tag.objects.create(name="Root")
+
+        # The same name under a different parent is still allowed
+        Tag.objects.create(name="Root", parent=Tag.objects.get(name="Root"))
@@ -0,0 +1,82 @@
+import random
+from itertools import combinations
+
+from scansteward.imageops.similarity import PHASH_BITS
+from scansteward.imageops.similarity import PhashIndex
+
+
+def near_copy(rng: random.Random, phash: int, distance: int) -> int:
+    for bit in rng.sample(range(PHASH_BITS), distance):
+        phash ^= 1 << bit
+    return phash
+
+
+def random_library(count: int) -> dict[int, int]:
+    """
+    Random phashes, with some near copies of earlier ones
+    """
+    rng = random.Random(7)  # noqa: S311
+    phashes: dict[int, int] = {}
+    for image_id in range(1, count + 1):
+        if phashes and rng.random() < 0.3:
+            phashes[image_id] = near_copy(rng, rng.choice(list(phashes.values())), rng.randint(0, 9))
+        else:
+            phashes[image_id] = rng.getrandbits(PHASH_BITS)
+    return phashes
+
+
+def brute_force_clusters(phashes: dict[int, int], max_distance: int) -> list[list[int]]:
+    parents = {image_id: image_id for image_id in phashes}
+
+    def find(image_id: int) -> int:
+        while parents[image_id] != image_id:
+            image_id = parents[image_id]
+        return image_id
+
+    for (first, first_hash), (second, second_hash) in combinations(phashes.items(), 2):
+        if (first_hash ^ second_hash).bit_count() <= max_distance:
+            parents[max(find(first), find(second))] = min(find(first), find(second))
+
+    groups: dict[int, list[int]] = {}
+    for image_id in phashes:
+        groups.setdefault(find(image_id), []).append(image_id)
+    return sorted((group for group in groups.values() if len(group) > 1), key=lambda group: group[0])
+
+
+def build_index(phashes: dict[int, int]) -> PhashIndex:
+    index = PhashIndex()
+    for image_id, phash in phashes.items():
+        index.add(image_id, phash)
+    return index
+
+
+class TestPhashIndex:
+    def test_search_matches_brute_force(self):
+        phashes = random_library(300)
+        index = build_index(phashes)
+
+        for max_distance in (0, 3, 6, 9):
+            for phash in list(phashes.values())[:50]:
+                expected = sorted(
+                    ((image_id, (phash ^ other).bit_count()) for image_id, other in phashes.items()),
+                    key=lambda item: (item[1], item[0]),
+                )
+                assert index.search(phash, max_distance) == [item for item in expected if item[1] <= max_distance]
+
+    def test_identical_phashes(self):
+        index = PhashIndex()
+        index.add(1, 0xDCD3A1250FA4E2CD)
+        index.add(2, 0xDCD3A1250FA4E2CD)
+        # Adding an image again does nothing
+        index.add(1, 0xDCD3A1250FA4E2CD)
+
+        assert len(index) == 2
+        assert index.search(0xDCD3A1250FA4E2CD, 0) == [(1, 0), (2, 0)]
+        assert index.clusters(0) == [[1, 2]]
+
+    def test_clusters_match_brute_force(self):
+        phashes = random_library(300)
+        index = build_index(phashes)
+
+        for max_distance in (2, 6, 12):
+            assert index.clusters(max_distance) == brute_force_clusters(phashes, max_distance)
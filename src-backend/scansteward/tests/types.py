@@ -10,6 +10,7 @@ class DjangoDirectories:
     media_dir: Path = dataclasses.field(init=False)
     thumbnail_dir: Path = dataclasses.field(init=False)
     full_size_dir: Path = dataclasses.field(init=False)
+    rendition_dir: Path = dataclasses.field(init=False)
 
     def __post_init__(self) -> None:
         self.data_dir = self.base_dir / "data"
@@ -17,6 +18,7 @@ class DjangoDirectories:
         self.media_dir = self.base_dir / "media"
         self.thumbnail_dir = self.media_dir / "thumbnails"
         self.full_size_dir = self.media_dir / "fullsize"
+        self.rendition_dir = self.media_dir / "renditions"
 
         for x in [self.data_dir, self.logs_dir, self.media_dir, self.thumbnail_dir, self.full_size_dir]:
             x.mkdir(parents=True, exist_ok=True)
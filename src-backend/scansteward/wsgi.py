@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "scansteward.settings")
 
 application = get_wsgi_application()
+
+# Only importable once the apps are loaded.  Built before the first request, rather than by it
+from scansteward.imageops.similarity import warm_phash_index  # noqa: E402
+
+warm_phash_index()